@@ -4,16 +4,31 @@ Homebrew Updater with Discord Notifications
 Automatically updates Homebrew formulae and casks with intelligent sudo handling
 """
 
+import argparse
+import atexit
+import hashlib
+import http.client
 import json
+import mmap
 import os
+import queue
+import random
 import re
+import resource
+import shutil
+import signal
+import ssl
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple, List
-import urllib.request
-import urllib.error
+from typing import Callable, Dict, Optional, Tuple, List
+import urllib.parse
 
 # ============================================================================
 # ENVIRONMENT CONFIGURATION
@@ -50,18 +65,121 @@ SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL", "")
 # Determines which webhook(s) to use for notifications
 NOTIFICATION_PLATFORM = os.getenv("NOTIFICATION_PLATFORM", "discord").lower()
 
+# Webhook client: request timeout, and the longest a send waits for a rate limit to
+# reset before leaving the message to the outbox
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_RATE_LIMIT_WAIT = float(os.getenv("WEBHOOK_MAX_RATE_LIMIT_WAIT", "30"))
+
+# Post one Discord message per run and edit it with phase progress and the summary,
+# at most one edit per DISCORD_EDIT_INTERVAL seconds
+DISCORD_LIVE_PROGRESS = os.getenv("DISCORD_LIVE_PROGRESS", "false").lower() in ("true", "yes", "1")
+DISCORD_EDIT_INTERVAL = float(os.getenv("DISCORD_EDIT_INTERVAL", "2"))
+
+# Seconds to wait for queued notifications before the updater exits
+NOTIFICATION_DRAIN_TIMEOUT = float(os.getenv("NOTIFICATION_DRAIN_TIMEOUT", "30"))
+
+# Failed webhook sends are kept in an outbox and retried with exponential backoff
+# (seconds, with jitter) during the run and at the start of later runs
+NOTIFICATION_RETRY_BASE = float(os.getenv("NOTIFICATION_RETRY_BASE", "30"))
+NOTIFICATION_RETRY_MAX = float(os.getenv("NOTIFICATION_RETRY_MAX", "3600"))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", "8"))
+
+# Notification mode: "immediate" posts every run summary, "digest" collects them and
+# posts one consolidated digest every DIGEST_INTERVAL_HOURS (failures still go out at once)
+NOTIFICATION_MODE = os.getenv("NOTIFICATION_MODE", "immediate").lower()
+DIGEST_INTERVAL_HOURS = float(os.getenv("DIGEST_INTERVAL_HOURS", "24"))
+
+# Messages too long for one Discord embed (4096 chars) or Slack section (3000 chars)
+# are split into at most NOTIFICATION_MAX_PARTS messages; longer lists are collapsed
+# to counts (the full lists stay in the run log)
+NOTIFICATION_MAX_PARTS = int(os.getenv("NOTIFICATION_MAX_PARTS", "3"))
+DISCORD_EMBED_LIMIT = 4096
+SLACK_SECTION_LIMIT = 3000
+
 # Homebrew paths
 BREW_PATH = os.getenv("BREW_PATH", "/opt/homebrew/bin/brew")
+HOMEBREW_PREFIX = Path(os.getenv("HOMEBREW_PREFIX", str(Path(BREW_PATH).parent.parent)))
+CELLAR_PATH = HOMEBREW_PREFIX / "Cellar"
+CASKROOM_PATH = HOMEBREW_PREFIX / "Caskroom"
 
 # Logging
 LOG_DIR = Path.home() / "Library/Logs/homebrew-updater"
 MAX_LOG_FILES = int(os.getenv("MAX_LOG_FILES", "10"))
 
+# Directory watched by node_exporter's textfile collector; each update run writes
+# homebrew_updater.prom there (empty = disabled)
+PROMETHEUS_TEXTFILE_DIR = os.getenv("PROMETHEUS_TEXTFILE_DIR", "")
+
+# Log writer: lines at or above LOG_FLUSH_LEVEL are flushed to disk immediately,
+# everything else at most every LOG_FLUSH_INTERVAL seconds
+LOG_FLUSH_LEVEL = os.getenv("LOG_FLUSH_LEVEL", "ERROR").upper()
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_TO_STDOUT = os.getenv("LOG_TO_STDOUT", "true").lower() in ("true", "yes", "1")
+LOG_BACKGROUND_WRITER = os.getenv("LOG_BACKGROUND_WRITER", "false").lower() in ("true", "yes", "1")
+
+# Number of trailing output lines kept for brew commands run without full capture
+BREW_OUTPUT_TAIL_LINES = int(os.getenv("BREW_OUTPUT_TAIL_LINES", "200"))
+
+# Parallel upgrades: number of formulae upgraded concurrently, in dependency order
+# (1 = single `brew upgrade --formula` run)
+FORMULA_UPGRADE_WORKERS = int(os.getenv("FORMULA_UPGRADE_WORKERS", "1"))
+
+# Parallel upgrades: number of casks upgraded concurrently (1 = single `brew upgrade --cask` run)
+CASK_UPGRADE_WORKERS = int(os.getenv("CASK_UPGRADE_WORKERS", "1"))
+
+# Where outdated packages come from: "auto" compares the Cellar/Caskroom with the
+# local API cache and only runs `brew outdated` when that is ambiguous; "brew" always runs it
+OUTDATED_SOURCE = os.getenv("OUTDATED_SOURCE", "auto").lower()
+
+# Concurrent `brew fetch` workers run before the upgrade phases (0 = no prefetch stage)
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "0"))
+
+# `brew info` for casks missing from the API cache: casks per call, concurrent calls,
+# and the timeout (seconds) for each call
+BREW_INFO_CHUNK_SIZE = int(os.getenv("BREW_INFO_CHUNK_SIZE", "40"))
+BREW_INFO_WORKERS = int(os.getenv("BREW_INFO_WORKERS", "4"))
+BREW_INFO_TIMEOUT = int(os.getenv("BREW_INFO_TIMEOUT", "120"))
+
+# Stale-state sweep before upgrades (partial upgrades, empty version dirs, broken
+# links in bin/opt): "partials" (remove partials, report the rest), "report",
+# "repair" or "off"
+STALE_STATE_SWEEP = os.getenv("STALE_STATE_SWEEP", "partials").lower()
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", "8"))
+
+# Retries when another brew process holds a package lock
+BREW_LOCK_RETRIES = int(os.getenv("BREW_LOCK_RETRIES", "3"))
+BREW_LOCK_RETRY_DELAY = float(os.getenv("BREW_LOCK_RETRY_DELAY", "15"))
+
 # Monthly cleanup reminder
 MONTHLY_CLEANUP_REMINDER_DAY = int(os.getenv("MONTHLY_CLEANUP_REMINDER_DAY", "15"))
 ENABLE_MONTHLY_CLEANUP_REMINDER = os.getenv("ENABLE_MONTHLY_CLEANUP_REMINDER", "true").lower() in ("true", "yes", "1")
 MONTHLY_REMINDER_STATE_FILE = LOG_DIR / ".last_monthly_reminder"
 
+# Webhook notifications waiting to be retried
+NOTIFICATION_OUTBOX_FILE = LOG_DIR / ".notification_outbox.json"
+
+# Run summaries waiting for the next digest (NOTIFICATION_MODE=digest)
+DIGEST_STORE_FILE = LOG_DIR / ".notification_digest.json"
+
+# Packages downloaded by the last --fetch-only run, consumed by --apply-cached
+PREFETCH_MANIFEST_FILE = LOG_DIR / ".prefetch_manifest.json"
+
+# No-op fast path: skip the run when taps, the API cache and the installed packages are
+# unchanged since the last successful run and nothing was left outdated
+ENABLE_NOOP_FAST_PATH = os.getenv("ENABLE_NOOP_FAST_PATH", "true").lower() in ("true", "yes", "1")
+# Force a full run (cleanup, doctor) at least this often even when nothing changed
+NOOP_MAX_AGE_HOURS = float(os.getenv("NOOP_MAX_AGE_HOURS", "168"))
+# Minimum hours between `brew update` runs (0 = update on every run). Within it an
+# unchanged system exits before any brew call; daily runs still update every time
+BREW_UPDATE_TTL_HOURS = float(os.getenv("BREW_UPDATE_TTL_HOURS", "12"))
+RUN_STATE_FILE = LOG_DIR / ".run_state.json"
+
+# Per-cask results of the last ghost scan; unchanged casks are not re-verified
+GHOST_SCAN_STATE_FILE = LOG_DIR / ".ghost_scan.json"
+
+# Where cask apps are installed
+APPLICATION_DIRS = [Path("/Applications"), Path.home() / "Applications"]
+
 # Environment setup
 BREW_ENV = {
     "PATH": "/opt/homebrew/bin:/opt/homebrew/sbin:/usr/local/bin:/usr/bin:/bin:/usr/sbin:/sbin",
@@ -70,6 +188,9 @@ BREW_ENV = {
     "HOMEBREW_LOGS": str(Path.home() / "Library/Logs/Homebrew"),
 }
 
+# Homebrew's cached API definitions (formula.jws.json / cask.jws.json)
+HOMEBREW_API_CACHE = Path(BREW_ENV["HOMEBREW_CACHE"]) / "api"
+
 # ============================================================================
 # LOGGING SETUP
 # ============================================================================
@@ -78,24 +199,384 @@ LOG_DIR.mkdir(parents=True, exist_ok=True)
 TIMESTAMP = datetime.now().strftime("%Y%m%d-%H%M%S")
 LOG_FILE = LOG_DIR / f"homebrew-updater-{TIMESTAMP}.log"
 
+# Phase and brew command timings of this run, kept alongside the run log
+METRICS_FILE = LOG_DIR / f"homebrew-updater-{TIMESTAMP}.metrics.json"
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+
+
+class LogWriter:
+    """Log sink that keeps one handle open on the run log for the whole run.
+
+    Lines are buffered and flushed within ``flush_interval`` seconds, even when no
+    further line follows, or immediately for levels at or above ``flush_level``.
+    With ``background=True`` file writes
+    happen on a writer thread so callers never block on disk I/O; urgent lines
+    still wait until they have been flushed.
+    """
+
+    def __init__(self, path: Path, mirror_stdout: bool = True, flush_level: str = "ERROR",
+                 flush_interval: float = 1.0, background: bool = False):
+        self.path = path
+        self.mirror_stdout = mirror_stdout
+        self.flush_level = LOG_LEVELS.get(flush_level.upper(), LOG_LEVELS["ERROR"])
+        self.flush_interval = flush_interval
+        self.background = background
+        self._handle = None
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._timer: Optional[threading.Timer] = None
+        self._stamp_second = None
+        self._stamp_text = ""
+
+    def _timestamp(self) -> str:
+        # Formatting a timestamp is comparatively expensive; do it once per second
+        now = int(time.time())
+        if now != self._stamp_second:
+            self._stamp_second = now
+            self._stamp_text = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+        return self._stamp_text
+
+    def _ensure_open(self):
+        if self._handle is None:
+            self._handle = open(self.path, "a", buffering=64 * 1024)
+            self._last_flush = time.monotonic()
+            if self.background:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._drain, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _write_line(self, line: str, urgent: bool):
+        self._handle.write(line)
+        now = time.monotonic()
+        if urgent or now - self._last_flush >= self.flush_interval:
+            self._handle.flush()
+            self._last_flush = now
+        elif self._queue is None and self._timer is None:
+            # A burst may be followed by minutes of silence: flush it on a timer
+            self._timer = threading.Timer(self.flush_interval - (now - self._last_flush),
+                                          self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+            if self._handle is not None:
+                self._handle.flush()
+                self._last_flush = time.monotonic()
+
+    def _drain(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._handle.flush()
+                self._last_flush = time.monotonic()
+                continue
+            try:
+                if item is None:
+                    return
+                self._write_line(*item)
+            finally:
+                self._queue.task_done()
+
+    def write(self, message: str, level: str = "INFO"):
+        """Write one formatted log line"""
+        urgent = LOG_LEVELS.get(level, LOG_LEVELS["INFO"]) >= self.flush_level
+        with self._lock:
+            log_line = f"[{self._timestamp()}] [{level}] {message}\n"
+            if self.mirror_stdout:
+                sys.stdout.write(log_line)
+            self._ensure_open()
+            pending = self._queue
+            if pending is None:
+                self._write_line(log_line, urgent)
+                return
+            pending.put((log_line, urgent))
+        if urgent:
+            pending.join()
+
+    def flush(self):
+        """Flush everything written so far to disk"""
+        with self._lock:
+            if self._queue is not None:
+                self._queue.join()
+            if self._handle is not None:
+                self._handle.flush()
+                self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and close the log file; a later write reopens it"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._queue is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._queue = None
+                self._thread = None
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+        if self.mirror_stdout:
+            sys.stdout.flush()
+
+
+LOG_WRITER = LogWriter(
+    LOG_FILE,
+    mirror_stdout=LOG_TO_STDOUT,
+    flush_level=LOG_FLUSH_LEVEL,
+    flush_interval=LOG_FLUSH_INTERVAL,
+    background=LOG_BACKGROUND_WRITER
+)
+
 def log(message: str, level: str = "INFO"):
     """Log message to both file and stdout"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_line = f"[{timestamp}] [{level}] {message}"
-    print(log_line)
-    with open(LOG_FILE, "a") as f:
-        f.write(log_line + "\n")
+    LOG_WRITER.write(message, level)
+
+def shutdown_logging():
+    """Flush and close the run log (safe to call more than once)"""
+    LOG_WRITER.close()
+
+atexit.register(shutdown_logging)
 
 def cleanup_old_logs():
-    """Keep only the most recent MAX_LOG_FILES log files"""
+    """Keep only the most recent MAX_LOG_FILES log (and metrics) files"""
     log_files = sorted(LOG_DIR.glob("homebrew-updater-*.log"), reverse=True)
-    for old_log in log_files[MAX_LOG_FILES:]:
+    metrics_files = sorted(LOG_DIR.glob("homebrew-updater-*.metrics.json"), reverse=True)
+    for old_log in log_files[MAX_LOG_FILES:] + metrics_files[MAX_LOG_FILES:]:
         try:
             old_log.unlink()
             log(f"Removed old log file: {old_log.name}")
         except Exception as e:
             log(f"Failed to remove old log {old_log.name}: {e}", "WARN")
 
+# ============================================================================
+# RUN METRICS
+# ============================================================================
+
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KiB on Linux
+
+
+def _children_cpu() -> float:
+    """CPU seconds used by all finished child processes so far"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _reap(process: subprocess.Popen) -> Tuple[int, Optional[float], int]:
+    """Wait for a child with wait4 and return (exit code, its CPU seconds, its peak RSS in bytes).
+
+    Unlike RUSAGE_CHILDREN, wait4 reports this child (and the processes it waited
+    for) alone, so concurrent brew commands are measured separately. Falls back to
+    ``wait()`` without usage when the process cannot be reaped this way.
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), None, 0
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * _RSS_UNIT
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+
+class RunMetrics:
+    """Wall time, child CPU time and peak child RSS of each phase and brew command,
+    plus webhook round trips and the run's outcome.
+
+    Each brew command's CPU time and peak RSS come from reaping it with wait4. A
+    phase's CPU time is the ``getrusage(RUSAGE_CHILDREN)`` delta over the phase
+    (phases run one at a time) and its peak RSS is the largest of its commands.
+    """
+
+    def __init__(self, export: bool = True):
+        self.export = export
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.success = False
+        self.packages: Dict[str, int] = {}
+        self.phases: Dict[str, dict] = {}
+        self.commands: List[dict] = []
+        self.webhooks: Dict[str, dict] = {}
+        self._open: Dict[str, Tuple[float, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def start_phase(self, name: str):
+        cpu = _children_cpu()
+        with self._lock:
+            self._open[name] = (time.monotonic(), cpu, len(self.commands))
+
+    def end_phase(self, name: str, state: str):
+        cpu = _children_cpu()
+        with self._lock:
+            opened = self._open.pop(name, None)
+            if opened is None:
+                return
+            started, cpu_before, commands_before = opened
+            commands = self.commands[commands_before:]
+            self.phases[name] = {"state": state, "wall": round(time.monotonic() - started, 3),
+                                 "cpu": round(cpu - cpu_before, 3),
+                                 "peak_rss": max((c["peak_rss"] for c in commands), default=0),
+                                 "brew_commands": len(commands)}
+
+    def record_command(self, args: List[str], wall: float, cpu: float, rss: int, success: bool):
+        with self._lock:
+            self.commands.append({"command": _clip(" ".join(args), 200), "wall": round(wall, 3),
+                                  "cpu": round(cpu, 3), "peak_rss": rss, "success": success})
+
+    def record_webhook(self, host: str, seconds: float):
+        with self._lock:
+            stats = self.webhooks.setdefault(host, {"requests": 0, "seconds": 0.0})
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+
+    def record_outcome(self, summary: "RunSummary"):
+        """Mark the run as completed with the package counts of its summary"""
+        self.success = True
+        self.packages = {"formulae_upgraded": len(summary.upgraded_formulae),
+                         "formulae_failed": len(summary.failed_formulae),
+                         "casks_upgraded": len(summary.upgraded_casks),
+                         "casks_failed": len(summary.failed_casks),
+                         "ghosts_removed": len(summary.removed_ghosts)}
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self._start
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).astimezone().isoformat(),
+                "duration": round(self.duration, 3),
+                "success": self.success,
+                "packages": dict(self.packages),
+                "phases": [{"name": name, **phase} for name, phase in self.phases.items()],
+                "brew": {"spawns": len(self.commands),
+                         "wall": round(sum(c["wall"] for c in self.commands), 3),
+                         "cpu": round(sum(c["cpu"] for c in self.commands), 3)},
+                "webhooks": {host: dict(stats) for host, stats in self.webhooks.items()},
+                "commands": list(self.commands),
+            }
+
+    def render(self) -> str:
+        """Compact timing section for the run summary"""
+        with self._lock:
+            phases = list(self.phases.items())
+            spawns = len(self.commands)
+        text = f"⏱️ **Timing ({_format_duration(self.duration)}, {spawns} brew command(s)):**"
+        for name, phase in phases:
+            peak = f", peak {phase['peak_rss'] / 2 ** 20:.0f} MB" if phase["peak_rss"] else ""
+            text += f"\n  • {name}: {_format_duration(phase['wall'])} (cpu {_format_duration(phase['cpu'])}{peak})"
+        return text
+
+
+def _dir_size(path: Path) -> int:
+    """Total size in bytes of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _prom_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(data: dict, cache_size: int, finished: float) -> str:
+    """Metrics of one run in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP homebrew_updater_{name} {help_text}")
+        lines.append(f"# TYPE homebrew_updater_{name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_prom_label(str(val))}"' for key, val in labels.items())
+            value = int(value) if float(value).is_integer() else float(value)
+            lines.append(f"homebrew_updater_{name}{suffix}{{{label_text}}} {value}" if label_text
+                         else f"homebrew_updater_{name}{suffix} {value}")
+
+    metric("last_run_timestamp_seconds", "gauge", "Unix time the last update run finished.",
+           [("", {}, round(finished, 3))])
+    metric("last_run_success", "gauge", "1 if the last update run completed, 0 if it failed.",
+           [("", {}, int(data["success"]))])
+    metric("last_run_duration_seconds", "gauge", "Wall time of the last update run.",
+           [("", {}, data["duration"])])
+    phases = [(phase["name"].lower().replace(" ", "_"), phase) for phase in data["phases"]]
+    metric("phase_duration_seconds", "gauge", "Wall time of each phase of the last run.",
+           [("", {"phase": name}, phase["wall"]) for name, phase in phases])
+    metric("phase_cpu_seconds", "gauge", "CPU time of brew processes in each phase of the last run.",
+           [("", {"phase": name}, phase["cpu"]) for name, phase in phases])
+    packages = data["packages"]
+    metric("packages", "gauge", "Packages upgraded or failed in the last run.",
+           [("", {"kind": kind, "result": result}, packages.get(f"{plural}_{result}", 0))
+            for kind, plural in (("formula", "formulae"), ("cask", "casks"))
+            for result in ("upgraded", "failed")])
+    metric("ghost_casks_removed", "gauge", "Ghost casks removed in the last run.",
+           [("", {}, packages.get("ghosts_removed", 0))])
+    metric("brew_spawns", "gauge", "brew processes started by the last run.",
+           [("", {}, data["brew"]["spawns"])])
+    metric("brew_seconds", "gauge", "Total wall time of brew processes in the last run.",
+           [("", {}, data["brew"]["wall"])])
+    metric("webhook_latency_seconds", "summary", "Webhook request round trips in the last run.",
+           [sample for host, stats in data["webhooks"].items()
+            for sample in (("_sum", {"host": host}, round(stats["seconds"], 3)),
+                           ("_count", {"host": host}, stats["requests"]))])
+    metric("cache_size_bytes", "gauge", "Size of HOMEBREW_CACHE after the last run.",
+           [("", {}, cache_size)])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(metrics: RunMetrics):
+    """Publish the run's metrics for node_exporter's textfile collector"""
+    path = Path(PROMETHEUS_TEXTFILE_DIR).expanduser() / "homebrew_updater.prom"
+    text = render_prometheus(metrics.to_dict(), _dir_size(Path(BREW_ENV["HOMEBREW_CACHE"])), time.time())
+    try:
+        write_text_atomic(path, text)
+    except OSError as e:
+        log(f"Failed to write Prometheus textfile {path}: {e}", "WARN")
+
+
+RUN_METRICS: Optional[RunMetrics] = None
+
+
+def start_metrics(export: bool = True):
+    """Start timing this run's phases, brew commands and webhook requests.
+
+    ``export`` runs also publish the metrics to PROMETHEUS_TEXTFILE_DIR when set.
+    """
+    global RUN_METRICS
+    RUN_METRICS = RunMetrics(export)
+
+
+def stop_metrics():
+    """Write this run's metrics to METRICS_FILE (and the Prometheus textfile)"""
+    global RUN_METRICS
+    metrics, RUN_METRICS = RUN_METRICS, None
+    if metrics is None:
+        return
+    try:
+        write_json_atomic(METRICS_FILE, metrics.to_dict())
+    except OSError as e:
+        log(f"Failed to save run metrics: {e}", "WARN")
+    if metrics.export and PROMETHEUS_TEXTFILE_DIR:
+        write_prometheus_textfile(metrics)
+
 # ============================================================================
 # WEBHOOK NOTIFICATIONS (Discord & Slack)
 # ============================================================================
@@ -120,12 +601,317 @@ def send_macos_notification(title: str, message: str, sound: str = "default"):
         log(f"Failed to send macOS notification: {e}", "ERROR")
 
 
+@dataclass
+class WebhookResponse:
+    status: int
+    headers: Dict[str, str] = field(default_factory=dict)  # lower-cased names
+    body: bytes = b""
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            return None
+
+
+class RateLimitBucket:
+    """Token bucket for one webhook, refilled from the server's rate-limit headers.
+
+    Discord sends ``X-RateLimit-Limit`` / ``-Remaining`` / ``-Reset-After``; a 429
+    (from Discord or Slack) carries ``Retry-After``. Until a server has said
+    anything the bucket does not pace at all.
+    """
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, now: float) -> float:
+        """Take a token; return how long to wait before using it"""
+        with self._lock:
+            if self.remaining is None:
+                return 0.0
+            if now >= self.reset_at:
+                self.remaining = self.limit if self.limit is not None else self.remaining + 1
+            if self.remaining > 0:
+                self.remaining -= 1
+                return 0.0
+            return self.reset_at - now
+
+    def update(self, headers: Dict[str, str], now: float):
+        with self._lock:
+            try:
+                if "x-ratelimit-limit" in headers:
+                    self.limit = int(headers["x-ratelimit-limit"])
+                if "x-ratelimit-remaining" in headers:
+                    self.remaining = int(headers["x-ratelimit-remaining"])
+                if "x-ratelimit-reset-after" in headers:
+                    self.reset_at = now + float(headers["x-ratelimit-reset-after"])
+            except ValueError:
+                pass
+
+    def block(self, seconds: float, now: float):
+        """Hold every request until ``seconds`` from now (after a 429)"""
+        with self._lock:
+            self.remaining = 0
+            self.reset_at = max(self.reset_at, now + seconds)
+
+
+class WebhookClient:
+    """Shared HTTP client for webhook posts.
+
+    Keeps one keep-alive connection per host (requests to a host are serialized on
+    it, different hosts run in parallel) and paces each webhook URL with a
+    RateLimitBucket. A 429 is retried once when its Retry-After fits within
+    WEBHOOK_MAX_RATE_LIMIT_WAIT; longer waits are returned to the caller as the 429.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self._connections: Dict[tuple, http.client.HTTPConnection] = {}
+        self._host_locks: Dict[tuple, threading.Lock] = {}
+        self._buckets: Dict[str, RateLimitBucket] = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, key: tuple) -> http.client.HTTPConnection:
+        connection = self._connections.get(key)
+        if connection is None:
+            scheme, host, port = key
+            timeout = WEBHOOK_TIMEOUT if self.timeout is None else self.timeout
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(host, port, timeout=timeout,
+                                                         context=ssl.create_default_context())
+            else:
+                connection = http.client.HTTPConnection(host, port, timeout=timeout)
+            self._connections[key] = connection
+        return connection
+
+    def _send(self, key: tuple, method: str, target: str, body: Optional[bytes]) -> WebhookResponse:
+        headers = {"Content-Type": "application/json", "User-Agent": "Homebrew-Updater/1.0 (Python)",
+                   "Connection": "keep-alive"}
+        for attempt in range(2):
+            connection = self._connection(key)
+            try:
+                started = time.monotonic()
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                if RUN_METRICS is not None:
+                    RUN_METRICS.record_webhook(key[1], time.monotonic() - started)
+                result = WebhookResponse(response.status,
+                                         {name.lower(): value for name, value in response.getheaders()}, data)
+                if response.will_close:
+                    connection.close()
+                    self._connections.pop(key, None)
+                return result
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed the idle keep-alive connection; reconnect once
+                connection.close()
+                self._connections.pop(key, None)
+                if attempt:
+                    raise
+            except Exception:
+                connection.close()
+                self._connections.pop(key, None)
+                raise
+
+    def request(self, method: str, url: str, payload=None) -> WebhookResponse:
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        target = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        bucket_key = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        with self._lock:
+            bucket = self._buckets.setdefault(bucket_key, RateLimitBucket())
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+
+        for attempt in range(2):
+            wait = bucket.reserve(time.monotonic())
+            if wait > WEBHOOK_MAX_RATE_LIMIT_WAIT:
+                log(f"Webhook rate limited for {wait:.0f}s, not waiting", "WARN")
+                return WebhookResponse(429, {"retry-after": f"{wait:.3f}"})
+            if wait > 0:
+                log(f"Webhook rate limit: waiting {wait:.1f}s")
+                time.sleep(wait)
+            with host_lock:
+                response = self._send(key, method, target, body)
+            now = time.monotonic()
+            bucket.update(response.headers, now)
+            if response.status != 429:
+                return response
+            retry_after = _retry_after(response)
+            bucket.block(retry_after, now)
+            if attempt or retry_after > WEBHOOK_MAX_RATE_LIMIT_WAIT:
+                return response
+            log(f"Webhook returned 429, retrying in {retry_after:.1f}s", "WARN")
+        return response
+
+    def post(self, url: str, payload) -> WebhookResponse:
+        return self.request("POST", url, payload)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+
+def _retry_after(response: WebhookResponse) -> float:
+    """Seconds a 429 asks us to wait (Retry-After header, or Discord's JSON retry_after)"""
+    for value in (response.headers.get("retry-after"),
+                  (response.json() or {}).get("retry_after") if response.body else None):
+        try:
+            if value is not None:
+                return max(float(value), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return 1.0
+
+
+WEBHOOK_CLIENT = WebhookClient()
+
+
+@dataclass
+class MessageSection:
+    """A blank-line separated block of a notification: heading lines, bullet items, trailing lines"""
+    head: List[str] = field(default_factory=list)
+    items: List[str] = field(default_factory=list)
+    tail: List[str] = field(default_factory=list)
+
+    def render(self, items: Optional[List[str]] = None, head: Optional[List[str]] = None,
+               tail: bool = True) -> str:
+        lines = (self.head if head is None else head) + (self.items if items is None else items)
+        return "\n".join(lines + (self.tail if tail else []))
+
+
+def parse_sections(message: str) -> List[MessageSection]:
+    """Split a notification into sections; list items are the lines starting with •"""
+    sections = []
+    for block in re.split(r"\n\s*\n", message.strip("\n")):
+        section = MessageSection()
+        for line in block.split("\n"):
+            if line.strip().startswith("•") and not section.tail:
+                section.items.append(line)
+            elif section.items:
+                section.tail.append(line)
+            else:
+                section.head.append(line)
+        sections.append(section)
+    return sections
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _pack_sections(sections: List[MessageSection], limit: int, cap: Optional[int]) -> List[str]:
+    """Pack sections into pages of at most ``limit`` chars, keeping at most ``cap`` items per list.
+
+    A section moves to the next page when it does not fit the current one; only a
+    section too long for a page of its own is split, continuing under its heading.
+    """
+    pages, current = [], ""
+
+    def add(part: str):
+        nonlocal current
+        current = f"{current}\n\n{part}" if current else part
+
+    def flush():
+        nonlocal current
+        pages.append(current)
+        current = ""
+
+    for section in sections:
+        items = section.items
+        if cap is not None and len(items) > cap:
+            items = items[:cap] + [f"  • … and {len(items) - cap} more (full list in {LOG_FILE.name})"]
+        head, start = section.head, 0
+        while True:
+            room = limit - len(current) - 2 if current else limit
+            whole = section.render(items[start:], head)
+            if len(whole) <= room:
+                add(whole)
+                break
+            if current and len(whole) <= limit:
+                flush()
+                continue
+
+            # Fill the page with as many items as fit
+            end = start
+            while end < len(items) and len(section.render(items[start:end + 1], head, tail=False)) <= room:
+                end += 1
+            if end == start:
+                if current:
+                    flush()
+                    continue
+                if start == len(items):
+                    add(_clip(whole, limit))
+                    break
+                end = start + 1
+            add(_clip(section.render(items[start:end], head, tail=False), limit))
+            flush()
+            start = end
+            if start == len(items) and not section.tail:
+                break
+            head = [f"{section.head[0]} (continued)"] if section.head else []
+    if current:
+        pages.append(current)
+    return pages
+
+
+def paginate_message(message: str, limit: int, max_parts: Optional[int] = None) -> List[str]:
+    """Fit a notification into at most ``max_parts`` pages of ``limit`` chars.
+
+    Sections are packed whole where they fit and long lists are continued on the
+    next page; if that still needs too many pages, every list is cut down (halving
+    until only the counts in the headings remain) with an "… and N more" line.
+    """
+    max_parts = max(NOTIFICATION_MAX_PARTS if max_parts is None else max_parts, 1)
+    if len(message) <= limit:
+        return [message]
+    sections = parse_sections(message)
+    cap = None
+    while True:
+        pages = _pack_sections(sections, limit, cap)
+        if len(pages) <= max_parts or cap == 0:
+            break
+        cap = (max(len(s.items) for s in sections) if cap is None else cap) // 2
+    if len(pages) > max_parts:
+        log(f"Notification needs {len(pages)} messages, sending the first {max_parts}", "WARN")
+    return pages[:max_parts]
+
+
 def _send_discord(message: str, error: bool = False) -> bool:
     """Send notification to Discord webhook (internal helper)"""
     if not DISCORD_WEBHOOK_URL or DISCORD_WEBHOOK_URL == "YOUR_WEBHOOK_ID/YOUR_WEBHOOK_TOKEN":
         log("Discord webhook not configured, skipping Discord notification", "WARN")
         return False
 
+    return _post_discord(DISCORD_WEBHOOK_URL, _discord_payloads(message, error))
+
+
+def _post_discord(url: str, payloads: List[dict]) -> bool:
+    """Post each payload of a (possibly continued) message to a Discord webhook"""
+    try:
+        for payload in payloads:
+            response = WEBHOOK_CLIENT.post(url, payload)
+            if response.status != 204:
+                log(f"Discord notification returned status {response.status}", "WARN")
+                return False
+        log("Discord notification sent successfully")
+        return True
+    except (OSError, http.client.HTTPException) as e:
+        log(f"Failed to send Discord notification: {e}", "ERROR")
+        return False
+    except Exception as e:
+        log(f"Unexpected error sending Discord notification: {e}", "ERROR")
+        return False
+
+
+def _discord_payload(message: str, error: bool = False) -> dict:
+    """Webhook payload for a message: a mention line in content plus the full embed"""
     color = 0xFF0000 if error else 0x00FF00  # Red for errors, green for success
 
     # Extract first line or create summary for content field
@@ -149,125 +935,248 @@ def _send_discord(message: str, error: bool = False) -> bool:
             "footer": {"text": os.uname().nodename}
         }]
     }
+    return payload
 
-    # Send to Discord
-    try:
-        req = urllib.request.Request(
-            DISCORD_WEBHOOK_URL,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={
-                'Content-Type': 'application/json',
-                'User-Agent': 'Homebrew-Updater/1.0 (Python)'
-            }
-        )
-        with urllib.request.urlopen(req, timeout=10) as response:
-            if response.status == 204:
-                log("Discord notification sent successfully")
-                return True
+
+def _discord_payloads(message: str, error: bool = False) -> List[dict]:
+    """Payloads for a message, split into continuations that fit the embed limit"""
+    pages = paginate_message(message, DISCORD_EMBED_LIMIT)
+    payloads = [_discord_payload(page, error) for page in pages]
+    for number, payload in enumerate(payloads[1:], 2):
+        # Only the first part mentions the user
+        del payload["content"]
+        payload["embeds"][0]["title"] = f"Homebrew Updater ({number}/{len(payloads)})"
+    return payloads
+
+
+def _webhook_url(base: str, path: str = "", **params) -> str:
+    """Extend a webhook URL's path and query (keeping e.g. an existing thread_id)"""
+    parts = urllib.parse.urlsplit(base)
+    query = urllib.parse.parse_qsl(parts.query) + list(params.items())
+    return urllib.parse.urlunsplit(parts._replace(path=parts.path + path,
+                                                  query=urllib.parse.urlencode(query)))
+
+
+PHASE_ICONS = {"running": "⏳", "done": "✅", "failed": "❌", "skipped": "⏭️"}
+
+
+class DiscordLiveMessage:
+    """One Discord message per run, edited in place as the run progresses.
+
+    The first notification of the run creates the message (``?wait=true`` returns
+    its id), ``progress`` edits it with the phase list, and the next notification
+    (the summary, or an error) becomes its final content. Progress edits are
+    coalesced: at most one PATCH per ``interval`` seconds, carrying the latest state.
+    """
+
+    def __init__(self, url: str, interval: float):
+        self.url = url
+        self.interval = interval
+        self.message_id: Optional[str] = None
+        self.finished = False
+        self.headline = ""
+        self.phases: Dict[str, str] = {}
+        self._last_edit = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._edit_lock = threading.Lock()
+
+    @property
+    def accepting(self) -> bool:
+        return not self.finished
+
+    def _render(self) -> str:
+        lines = [f"{PHASE_ICONS.get(state, '•')} {phase}" for phase, state in self.phases.items()]
+        return _clip(self.headline + ("\n\n" + "\n".join(lines) if lines else ""), DISCORD_EMBED_LIMIT)
+
+    def _patch(self, payload: dict) -> bool:
+        try:
+            response = WEBHOOK_CLIENT.request("PATCH", _webhook_url(self.url, f"/messages/{self.message_id}"),
+                                              payload)
+        except (OSError, http.client.HTTPException) as e:
+            log(f"Failed to edit Discord message: {e}", "ERROR")
+            return False
+        self._last_edit = time.monotonic()
+        if response.status != 200:
+            log(f"Discord message edit returned status {response.status}", "WARN")
+        return response.status == 200
+
+    def post(self, message: str, error: bool = False) -> bool:
+        """Create the message, or finish it with this notification as final content"""
+        with self._lock:
+            creating = self.message_id is None
+            if creating:
+                self.headline = message
             else:
-                log(f"Discord notification returned status {response.status}", "WARN")
+                self.finished = True
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+        if creating:
+            try:
+                response = WEBHOOK_CLIENT.post(_webhook_url(self.url, wait="true"),
+                                               _discord_payload(self._render(), error))
+            except (OSError, http.client.HTTPException) as e:
+                log(f"Failed to send Discord notification: {e}", "ERROR")
+                self.finished = True
                 return False
-    except urllib.error.URLError as e:
-        log(f"Failed to send Discord notification: {e}", "ERROR")
-        return False
-    except Exception as e:
-        log(f"Unexpected error sending Discord notification: {e}", "ERROR")
-        return False
-
+            data = response.json() if response.status == 200 else None
+            if not isinstance(data, dict) or not data.get("id"):
+                log(f"Discord live message could not be created (status {response.status})", "WARN")
+                self.finished = True
+                return False
+            self.message_id = str(data["id"])
+            self._last_edit = time.monotonic()
+            log("Discord notification sent successfully")
+            with self._lock:
+                if self.phases and not self.finished:
+                    self._schedule()
+            return True
+        payloads = _discord_payloads(message, error)
+        with self._edit_lock:
+            sent = self._patch(payloads[0])
+        if sent and len(payloads) > 1:
+            return _post_discord(self.url, payloads[1:])
+        if sent:
+            log("Discord notification sent successfully")
+        return sent
+
+    def progress(self, phase: str, state: str):
+        with self._lock:
+            if self.finished:
+                return
+            self.phases[phase] = state
+            if self.message_id is not None:
+                self._schedule()
+
+    def _schedule(self):
+        """Arrange one edit carrying whatever the state is when it fires (caller holds _lock)"""
+        if self._timer is not None:
+            return
+        delay = max(self._last_edit + self.interval - time.monotonic(), 0)
+        self._timer = threading.Timer(delay, self._flush_progress)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_progress(self):
+        with self._edit_lock:
+            with self._lock:
+                self._timer = None
+                if self.finished:
+                    return
+                content = self._render()
+            self._patch({"embeds": _discord_payload(content)["embeds"]})
+
+    def close(self):
+        with self._lock:
+            self.finished = True
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+
+LIVE_MESSAGE: Optional[DiscordLiveMessage] = None
+
+
+def start_live_progress():
+    """Use one live-edited Discord message for this run (DISCORD_LIVE_PROGRESS)"""
+    global LIVE_MESSAGE
+    if (DISCORD_LIVE_PROGRESS and NOTIFICATION_PLATFORM in ("discord", "both")
+            and _webhook_configured("discord")):
+        LIVE_MESSAGE = DiscordLiveMessage(DISCORD_WEBHOOK_URL, DISCORD_EDIT_INTERVAL)
+
+
+def stop_live_progress():
+    global LIVE_MESSAGE
+    live, LIVE_MESSAGE = LIVE_MESSAGE, None
+    if live:
+        live.close()
+
+
+def report_progress(phase: str, state: str):
+    """Time a phase in the run metrics and show its state on the live Discord message"""
+    if RUN_METRICS is not None:
+        if state == "running":
+            RUN_METRICS.start_phase(phase)
+        else:
+            RUN_METRICS.end_phase(phase, state)
+    if LIVE_MESSAGE is not None:
+        LIVE_MESSAGE.progress(phase, state)
 
-def _send_slack(message: str, error: bool = False) -> bool:
-    """Send notification to Slack webhook using blocks (internal helper)"""
-    if not SLACK_WEBHOOK_URL:
-        log("Slack webhook not configured, skipping Slack notification", "WARN")
-        return False
 
+def _slack_payloads(message: str, error: bool = False) -> List[dict]:
+    """Slack block payloads for a message, split into continuations that fit the section limit"""
     # Parse message into structured sections
     lines = message.split('\n')
-    first_line = lines[0].strip() if lines else "Homebrew Updater Notification"
-
-    # Build Slack blocks for rich formatting
-    blocks = []
-
-    # Header block with first line (emoji + title)
-    blocks.append({
-        "type": "header",
-        "text": {
-            "type": "plain_text",
-            "text": first_line,
-            "emoji": True
-        }
-    })
+    first_line = lines[0].strip() or "Homebrew Updater Notification"
+    body = "\n".join(lines[1:])
+    pages = paginate_message(body, SLACK_SECTION_LIMIT) if body.strip() else [""]
+
+    payloads = []
+    for number, page in enumerate(pages, 1):
+        title = first_line if len(pages) == 1 else f"{first_line} ({number}/{len(pages)})"
+
+        # Header block with first line (emoji + title)
+        blocks = [{
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": _clip(title, 150),
+                "emoji": True
+            }
+        }]
 
-    # Parse remaining lines into sections
-    current_section = []
-    for line in lines[1:]:
-        line = line.strip()
-        if not line:
-            # Empty line: flush current section
-            if current_section:
+        # One section block per blank-line separated block of the page
+        for section in parse_sections(page):
+            text = "\n".join(line.strip() for line in section.render().split("\n")).strip()
+            if text:
                 blocks.append({
                     "type": "section",
                     "text": {
                         "type": "mrkdwn",
-                        "text": "\n".join(current_section)
+                        "text": text
                     }
                 })
-                current_section = []
-        elif line.startswith("**") or line.startswith("•") or line.startswith("🔐") or line.startswith("🧹"):
-            # Markdown bold or list item
-            current_section.append(line)
-        else:
-            current_section.append(line)
 
-    # Flush any remaining section
-    if current_section:
+        # Add context footer with hostname and timestamp
         blocks.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "\n".join(current_section)
-            }
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": f"_{os.uname().nodename}_ • {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                }
+            ]
         })
 
-    # Add context footer with hostname and timestamp
-    blocks.append({
-        "type": "context",
-        "elements": [
-            {
-                "type": "mrkdwn",
-                "text": f"_{os.uname().nodename}_ • {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            }
-        ]
-    })
+        # Color-coded attachment
+        attachment_color = "#FF0000" if error else "#36a64f"  # Red or green
+
+        payloads.append({
+            "blocks": blocks,
+            "attachments": [{
+                "color": attachment_color
+            }]
+        })
+    return payloads
 
-    # Color-coded attachment
-    attachment_color = "#FF0000" if error else "#36a64f"  # Red or green
 
-    payload = {
-        "blocks": blocks,
-        "attachments": [{
-            "color": attachment_color
-        }]
-    }
+def _send_slack(message: str, error: bool = False) -> bool:
+    """Send notification to Slack webhook using blocks (internal helper)"""
+    if not SLACK_WEBHOOK_URL:
+        log("Slack webhook not configured, skipping Slack notification", "WARN")
+        return False
 
     # Send to Slack
     try:
-        req = urllib.request.Request(
-            SLACK_WEBHOOK_URL,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={
-                'Content-Type': 'application/json',
-                'User-Agent': 'Homebrew-Updater/1.0 (Python)'
-            }
-        )
-        with urllib.request.urlopen(req, timeout=10) as response:
-            if response.status == 200:
-                log("Slack notification sent successfully")
-                return True
-            else:
+        for payload in _slack_payloads(message, error):
+            response = WEBHOOK_CLIENT.post(SLACK_WEBHOOK_URL, payload)
+            if response.status != 200:
                 log(f"Slack notification returned status {response.status}", "WARN")
                 return False
-    except urllib.error.URLError as e:
+        log("Slack notification sent successfully")
+        return True
+    except (OSError, http.client.HTTPException) as e:
         log(f"Failed to send Slack notification: {e}", "ERROR")
         return False
     except Exception as e:
@@ -275,32 +1184,234 @@ def _send_slack(message: str, error: bool = False) -> bool:
         return False
 
 
-def send_notification(message: str, error: bool = False):
-    """Send notification via configured platform(s) and macOS notification center"""
+def _webhook_configured(sink: str) -> bool:
+    if sink == "discord":
+        return bool(DISCORD_WEBHOOK_URL) and DISCORD_WEBHOOK_URL != "YOUR_WEBHOOK_ID/YOUR_WEBHOOK_TOKEN"
+    return bool(SLACK_WEBHOOK_URL)
+
+
+def _webhook_sender(sink: str) -> Callable[[str, bool], bool]:
+    return _send_discord if sink == "discord" else _send_slack
+
+
+_OUTBOX_LOCK = threading.Lock()
+
+
+def _load_outbox() -> list:
+    try:
+        with open(NOTIFICATION_OUTBOX_FILE) as f:
+            entries = json.load(f)
+        return entries if isinstance(entries, list) else []
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        log(f"Failed to read notification outbox: {e}", "WARN")
+        return []
+
+
+def _save_outbox(entries: list):
+    try:
+        write_json_atomic(NOTIFICATION_OUTBOX_FILE, entries)
+    except OSError as e:
+        log(f"Failed to save notification outbox: {e}", "WARN")
+
+
+def _retry_delay(attempts: int) -> float:
+    """Exponential backoff with +/-50% jitter, so retries from several sinks spread out"""
+    delay = min(NOTIFICATION_RETRY_BASE * 2 ** (attempts - 1), NOTIFICATION_RETRY_MAX)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def outbox_add(sink: str, message: str, error: bool = False):
+    """Keep a webhook message that failed to send for a later retry"""
+    now = time.time()
+    with _OUTBOX_LOCK:
+        entries = _load_outbox()
+        entries.append({"id": f"{time.time_ns()}-{sink}", "sink": sink, "message": message,
+                        "error": error, "created": now, "attempts": 1,
+                        "next_attempt": now + _retry_delay(1)})
+        _save_outbox(entries)
+    log(f"Queued {sink} notification for retry")
+
+
+def outbox_next_due() -> Optional[float]:
+    """When the earliest pending retry is due (None when the outbox is empty)"""
+    with _OUTBOX_LOCK:
+        entries = _load_outbox()
+    return min((entry.get("next_attempt", 0) for entry in entries), default=None)
+
+
+def flush_outbox(now: Optional[float] = None) -> int:
+    """Retry every outbox entry that is due and return how many were delivered.
+
+    Sends happen outside the lock; the outbox is re-read before it is rewritten so
+    entries added meanwhile are kept.
+    """
+    now = time.time() if now is None else now
+    with _OUTBOX_LOCK:
+        due = [entry for entry in _load_outbox() if entry.get("next_attempt", 0) <= now]
+    if not due:
+        return 0
+
+    results = {}
+    for entry in due:
+        try:
+            results[entry["id"]] = _webhook_sender(entry["sink"])(entry["message"], entry.get("error", False))
+        except Exception as e:
+            log(f"Retry of {entry['sink']} notification failed: {e}", "ERROR")
+            results[entry["id"]] = False
+
+    with _OUTBOX_LOCK:
+        kept = []
+        for entry in _load_outbox():
+            if entry.get("id") in results:
+                if results[entry["id"]]:
+                    continue
+                entry["attempts"] = entry.get("attempts", 1) + 1
+                if entry["attempts"] > NOTIFICATION_MAX_ATTEMPTS:
+                    log(f"Dropping {entry['sink']} notification after {NOTIFICATION_MAX_ATTEMPTS} attempts: "
+                        f"{entry['message'].splitlines()[0] if entry['message'] else ''}", "ERROR")
+                    continue
+                entry["next_attempt"] = now + _retry_delay(entry["attempts"])
+            kept.append(entry)
+        _save_outbox(kept)
+    delivered = sum(1 for ok in results.values() if ok)
+    log(f"Notification outbox: {delivered} of {len(due)} retries delivered, {len(kept)} pending")
+    return delivered
+
+
+def _deliver_notification(message: str, error: bool = False,
+                          pool: Optional[ThreadPoolExecutor] = None):
+    """Send one notification to every configured sink concurrently and wait for all of them"""
     # Extract first line for macOS notification
     first_line = message.split('\n')[0].strip() or "Homebrew Updater Notification"
     sound = "Basso" if error else "Glass"
 
-    # Track if any webhook succeeded
-    webhook_sent = False
-
-    # Send to configured platform(s)
+    webhooks = []
     if NOTIFICATION_PLATFORM in ("discord", "both"):
-        if _send_discord(message, error):
-            webhook_sent = True
-
+        live = LIVE_MESSAGE
+        webhooks.append(("discord", live.post if live and live.accepting else _send_discord))
     if NOTIFICATION_PLATFORM in ("slack", "both"):
-        if _send_slack(message, error):
-            webhook_sent = True
+        webhooks.append(("slack", _send_slack))
 
-    # Always send macOS notification for reliable local alerts
-    send_macos_notification("Homebrew Updater", first_line, sound=sound)
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=len(webhooks) + 1, thread_name_prefix="notify")
+    try:
+        webhook_futures = [(sink, pool.submit(send, message, error)) for sink, send in webhooks]
+        # Always send macOS notification for reliable local alerts
+        local_future = pool.submit(send_macos_notification, "Homebrew Updater", first_line, sound=sound)
+        webhook_sent = False
+        for sink, future in webhook_futures:
+            try:
+                sent = future.result()
+            except Exception as e:
+                log(f"Notification sink failed: {e}", "ERROR")
+                sent = False
+            webhook_sent = sent or webhook_sent
+            # A configured webhook that failed gets another chance from the outbox
+            if not sent and _webhook_configured(sink):
+                outbox_add(sink, message, error)
+        local_future.result()
+    finally:
+        if own_pool:
+            pool.shutdown(wait=False)
 
     # If no webhooks configured or all failed, warn but don't fail
     if not webhook_sent and NOTIFICATION_PLATFORM != "":
         log("No webhook notifications were sent (check configuration)", "WARN")
 
 
+class NotificationDispatcher:
+    """Delivers notifications on a background thread so callers never wait on webhooks.
+
+    Notifications go out one at a time, in the order they were sent, each fanned
+    out to its sinks concurrently. ``drain`` waits for pending sends up to a deadline.
+    Between sends the thread retries the outbox: leftovers from earlier runs first,
+    then this run's failures as their backoff expires.
+    """
+
+    def __init__(self, workers: int = 3):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, message: str, error: bool = False):
+        with self._idle:
+            self._pending += 1
+        self._queue.put((message, error))
+
+    def _flush_outbox(self):
+        try:
+            flush_outbox()
+        except Exception as e:
+            log(f"Failed to flush notification outbox: {e}", "ERROR")
+
+    def _run(self):
+        self._flush_outbox()
+        while True:
+            due = outbox_next_due()
+            try:
+                item = self._queue.get(timeout=None if due is None else max(due - time.time(), 0.1))
+            except queue.Empty:
+                self._flush_outbox()
+                continue
+            if item is None:
+                return
+            try:
+                _deliver_notification(*item, pool=self._pool)
+            except Exception as e:
+                log(f"Failed to deliver notification: {e}", "ERROR")
+            finally:
+                with self._idle:
+                    self._pending -= 1
+                    self._idle.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        """Wait until every submitted notification has been delivered; False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout: float) -> bool:
+        drained = self.drain(timeout)
+        self._queue.put(None)
+        self._pool.shutdown(wait=False)
+        return drained
+
+
+NOTIFIER: Optional[NotificationDispatcher] = None
+
+
+def start_notifier():
+    """Send notifications in the background from now on"""
+    global NOTIFIER
+    if NOTIFIER is None:
+        NOTIFIER = NotificationDispatcher()
+
+
+def stop_notifier(timeout: Optional[float] = None):
+    """Deliver pending notifications (up to NOTIFICATION_DRAIN_TIMEOUT) and go back to inline sends"""
+    global NOTIFIER
+    notifier, NOTIFIER = NOTIFIER, None
+    if notifier and not notifier.close(NOTIFICATION_DRAIN_TIMEOUT if timeout is None else timeout):
+        log("Gave up waiting for pending notifications", "WARN")
+
+
+def send_notification(message: str, error: bool = False):
+    """Send notification via configured platform(s) and macOS notification center.
+
+    Returns immediately while a dispatcher is running (see start_notifier); otherwise
+    delivers inline, with all sinks in parallel.
+    """
+    if NOTIFIER is not None:
+        NOTIFIER.submit(message, error)
+    else:
+        _deliver_notification(message, error)
+
+
 # Backwards compatibility alias
 def send_discord_notification(message: str, error: bool = False):
     """Deprecated: Use send_notification() instead. Kept for backwards compatibility."""
@@ -383,32 +1494,601 @@ def send_monthly_cleanup_reminder():
     # Save today's date as the last reminder date
     save_last_reminder_date(datetime.now().strftime("%Y-%m-%d"))
 
+# ============================================================================
+# INVENTORY (read directly from the Cellar and Caskroom)
+# ============================================================================
+
+@dataclass
+class InstalledPackage:
+    """An installed formula or cask as recorded on disk"""
+    name: str
+    version: str  # the version brew considers installed
+    versions: List[str]  # every installed version directory
+    installed_time: Optional[float] = None  # epoch seconds of the latest install
+    receipt: Optional[dict] = None  # INSTALL_RECEIPT.json of the installed keg (formulae only)
+
+
+@dataclass
+class Inventory:
+    """Installed formulae and casks, keyed by name/token"""
+    formulae: Dict[str, InstalledPackage]
+    casks: Dict[str, InstalledPackage]
+
+
+def _subdirs(path) -> List[os.DirEntry]:
+    """Non-hidden subdirectories of path (empty if it cannot be read)"""
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries
+                    if not entry.name.startswith('.') and entry.is_dir()]
+    except OSError:
+        return []
+
+
+def read_formula(name: str, path: str) -> Optional[InstalledPackage]:
+    """Read one formula from its Cellar directory.
+
+    The installed keg is the one ``opt/<name>`` links to, falling back to the most
+    recently modified keg when the formula is unlinked.
+    """
+    kegs = _subdirs(path)
+    if not kegs:
+        return None
+    installed = None
+    try:
+        linked = os.path.basename(os.readlink(HOMEBREW_PREFIX / "opt" / name))
+        installed = next((keg for keg in kegs if keg.name == linked), None)
+    except OSError:
+        pass
+    if installed is None:
+        installed = max(kegs, key=lambda keg: keg.stat().st_mtime)
+
+    receipt = None
+    try:
+        with open(os.path.join(installed.path, "INSTALL_RECEIPT.json")) as f:
+            receipt = json.load(f)
+    except (OSError, ValueError):
+        pass
+    installed_time = (receipt or {}).get("time") or installed.stat().st_mtime
+    return InstalledPackage(name, installed.name, sorted(keg.name for keg in kegs),
+                            float(installed_time), receipt)
+
+
+def read_cask(token: str, path: str) -> InstalledPackage:
+    """Read one cask from its Caskroom directory.
+
+    Brew records each install under ``.metadata/<version>/<timestamp>``; the version
+    with the newest timestamp is the installed one. Like ``brew list --cask``, a
+    Caskroom directory counts as installed even when it is empty (version "").
+    """
+    versions = [entry.name for entry in _subdirs(path)]
+    latest = None  # (timestamp, version)
+    for version_dir in _subdirs(os.path.join(path, ".metadata")):
+        for stamp_dir in _subdirs(version_dir.path):
+            if latest is None or stamp_dir.name > latest[0]:
+                latest = (stamp_dir.name, version_dir.name)
+
+    installed_time = None
+    version = latest[1] if latest else (sorted(versions)[-1] if versions else "")
+    if latest:
+        try:
+            installed_time = datetime.strptime(latest[0].split('.')[0], "%Y%m%d%H%M%S").timestamp()
+        except ValueError:
+            pass
+    return InstalledPackage(token, version, sorted(versions), installed_time)
+
+
+def _read_packages(root: Path, reader) -> Dict[str, InstalledPackage]:
+    packages = {}
+    for entry in _subdirs(root):
+        package = reader(entry.name, entry.path)
+        if package:
+            packages[entry.name] = package
+    return packages
+
+
+def read_formulae(cellar: Optional[Path] = None) -> Dict[str, InstalledPackage]:
+    """Installed formulae, read from the Cellar"""
+    return _read_packages(cellar or CELLAR_PATH, read_formula)
+
+
+def read_casks(caskroom: Optional[Path] = None) -> Dict[str, InstalledPackage]:
+    """Installed casks, read from the Caskroom"""
+    return _read_packages(caskroom or CASKROOM_PATH, read_cask)
+
+
+def read_inventory(cellar: Optional[Path] = None, caskroom: Optional[Path] = None) -> Inventory:
+    """Read installed formulae and casks straight from disk, without spawning brew"""
+    start = time.monotonic()
+    inventory = Inventory(formulae=read_formulae(cellar), casks=read_casks(caskroom))
+    log(f"Read inventory: {len(inventory.formulae)} formulae, {len(inventory.casks)} casks "
+        f"in {(time.monotonic() - start) * 1000:.0f} ms")
+    return inventory
+
+# Where each kind of cask artifact ends up; kinds not listed here (pkg, installer,
+# artifact, stage_only, ...) cannot be checked for existence
+_HOME_LIBRARY = Path.home() / "Library"
+ARTIFACT_DIRS: Dict[str, List[Path]] = {
+    "app": APPLICATION_DIRS,
+    "suite": APPLICATION_DIRS,
+    "binary": [HOMEBREW_PREFIX / "bin"],
+    "pkgutil": [Path("/var/db/receipts")],
+    "prefpane": [Path("/Library/PreferencePanes"), _HOME_LIBRARY / "PreferencePanes"],
+    "qlplugin": [Path("/Library/QuickLook"), _HOME_LIBRARY / "QuickLook"],
+    "font": [Path("/Library/Fonts"), _HOME_LIBRARY / "Fonts"],
+    "colorpicker": [_HOME_LIBRARY / "ColorPickers"],
+    "dictionary": [_HOME_LIBRARY / "Dictionaries"],
+    "input_method": [_HOME_LIBRARY / "Input Methods"],
+    "screen_saver": [_HOME_LIBRARY / "Screen Savers"],
+    "service": [_HOME_LIBRARY / "Services"],
+    "audio_unit_plugin": [_HOME_LIBRARY / "Audio/Plug-Ins/Components"],
+    "vst_plugin": [_HOME_LIBRARY / "Audio/Plug-Ins/VST"],
+    "vst3_plugin": [_HOME_LIBRARY / "Audio/Plug-Ins/VST3"],
+}
+
+# pkgutil ids may be regular expressions, e.g. "com.microsoft.package.*"
+_PKGUTIL_PATTERN_CHARS = re.compile(r"[*+?\[\](){}|^$\\]")
+
+
+class ArtifactIndex:
+    """Names present in each artifact directory, read with one scandir per directory.
+
+    Directories are scanned on first use and shared between kinds (apps and suites
+    both live in /Applications). Names are compared case-insensitively, like the
+    default macOS file system. The per-kind lookup tables and pkgutil pattern
+    matches are built once, so each lookup is a dict hit.
+    """
+
+    def __init__(self, dirs: Optional[Dict[str, List[Path]]] = None):
+        self.dirs = ARTIFACT_DIRS if dirs is None else dirs
+        self._names: Dict[Path, Dict[str, str]] = {}
+        self._paths: Dict[str, Dict[str, Path]] = {}
+        self._pattern_matches: Dict[str, Optional[Path]] = {}
+
+    def _scan(self, directory: Path) -> Dict[str, str]:
+        names = self._names.get(directory)
+        if names is None:
+            names = {}
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        names[entry.name.casefold()] = entry.name
+            except OSError:
+                pass
+            self._names[directory] = names
+        return names
+
+    def _kind_paths(self, kind: str) -> Dict[str, Path]:
+        paths = self._paths.get(kind)
+        if paths is not None:
+            return paths
+        paths = self._paths[kind] = {}
+        for directory in self.dirs.get(kind, []):
+            for key, name in self._scan(directory).items():
+                if kind == "pkgutil":
+                    # Receipts are <pkgid>.plist / <pkgid>.bom
+                    if not key.endswith((".plist", ".bom")):
+                        continue
+                    key = key.rsplit(".", 1)[0]
+                paths.setdefault(key, directory / name)
+        return paths
+
+    def checkable(self, artifacts: Dict[str, List[str]]) -> bool:
+        """Whether any of the artifacts is of a kind the index can look up"""
+        return any(targets and kind in self.dirs for kind, targets in artifacts.items())
+
+    def locate(self, artifacts: Dict[str, List[str]]) -> Optional[Tuple[str, Path]]:
+        """Return (target, path on disk) for the first artifact that exists, or None"""
+        for kind, targets in artifacts.items():
+            if kind not in self.dirs:
+                continue
+            paths = self._kind_paths(kind)
+            for target in targets:
+                key = target.casefold()
+                if key in paths:
+                    return target, paths[key]
+                if kind == "pkgutil" and _PKGUTIL_PATTERN_CHARS.search(target):
+                    path = self._match_pattern(key, paths)
+                    if path is not None:
+                        return target, path
+        return None
+
+    def _match_pattern(self, key: str, paths: Dict[str, Path]) -> Optional[Path]:
+        # A pkgutil pattern is compiled and matched against the receipts only once
+        if key not in self._pattern_matches:
+            match = None
+            try:
+                pattern = re.compile(key)
+            except re.error:
+                pattern = None
+            if pattern is not None:
+                match = next((path for name, path in paths.items() if pattern.fullmatch(name)), None)
+            self._pattern_matches[key] = match
+        return self._pattern_matches[key]
+
+    def find(self, artifacts: Dict[str, List[str]]) -> Optional[str]:
+        """Return the first artifact target that exists, or None"""
+        located = self.locate(artifacts)
+        return located[0] if located else None
+
+
+# ============================================================================
+# HOMEBREW API INDEX (compact, memory-mapped view of the cached API JSON)
+# ============================================================================
+
+API_INDEX_FORMAT = 1
+
+
+def cask_artifacts(cask_info: dict) -> Dict[str, List[str]]:
+    """Compact a cask's artifact list to {kind: [installed target names]}.
+
+    Entries are either a source path or ``{"target": ...}``; the installed name is
+    the explicit target, otherwise the basename of the source. Package receipts
+    are taken from ``uninstall: pkgutil`` stanzas and stored as kind "pkgutil".
+    """
+    compact: Dict[str, List[str]] = {}
+    for artifact in cask_info.get("artifacts") or []:
+        if not isinstance(artifact, dict):
+            continue
+        for kind, values in artifact.items():
+            if kind == "uninstall":
+                for stanza in values or []:
+                    pkgutil = stanza.get("pkgutil") if isinstance(stanza, dict) else None
+                    if pkgutil:
+                        compact.setdefault("pkgutil", []).extend(
+                            [pkgutil] if isinstance(pkgutil, str) else pkgutil)
+                continue
+            if kind in ("zap", "preflight", "postflight", "uninstall_preflight", "uninstall_postflight"):
+                continue
+            names = []
+            for value in values if isinstance(values, list) else [values]:
+                if isinstance(value, str):
+                    names.append(Path(value).name)
+                elif isinstance(value, dict) and value.get("target") and names:
+                    # {"target": ...} renames the preceding source
+                    names[-1] = Path(value["target"]).name
+            if names:
+                compact.setdefault(kind, []).extend(names)
+    return compact
+
+
+def _formula_record(info: dict) -> Tuple[str, dict]:
+    versions = info.get("versions") or {}
+    version = str(versions.get("stable") or "")
+    revision = info.get("revision") or 0
+    if revision:
+        version = f"{version}_{revision}"
+    return info.get("name", ""), {
+        "version": version,
+        "deps": info.get("dependencies") or [],
+    }
+
+
+def _cask_record(info: dict) -> Tuple[str, dict]:
+    depends_on = info.get("depends_on")
+    deps = depends_on.get("formula") if isinstance(depends_on, dict) else None
+    return info.get("token", ""), {
+        "version": str(info.get("version") or ""),
+        "auto_updates": bool(info.get("auto_updates")),
+        "artifacts": cask_artifacts(info),
+        "deps": deps or [],
+    }
+
+
+def _iter_json_array(text: str, pos: int = 0):
+    """Yield the elements of the JSON array starting at ``text[pos]`` one at a time,
+    so only one decoded package definition is alive at once"""
+    decoder = json.JSONDecoder()
+    length = len(text)
+    while pos < length and text[pos] in " \t\r\n":
+        pos += 1
+    if pos >= length or text[pos] != "[":
+        raise ValueError("expected a JSON array")
+    pos += 1
+    while True:
+        while pos < length and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= length:
+            raise ValueError("unterminated JSON array")
+        if text[pos] == "]":
+            return
+        element, pos = decoder.raw_decode(text, pos)
+        yield element
+
+
+def _api_source_file(kind: str) -> Optional[Path]:
+    """The API cache file brew uses for formulae or casks (signed .jws.json preferred)"""
+    for name in (f"{kind}.jws.json", f"{kind}.json"):
+        path = HOMEBREW_API_CACHE / name
+        if path.is_file():
+            return path
+    return None
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.hexdigest()
+
+
+def _jws_payload(text: str) -> str:
+    """The "payload" string of a JWS envelope, decoded without building the envelope.
+
+    Quotes inside the escaped payload are always backslash-prefixed, so the first
+    bare ``"payload":`` is the envelope's own key.
+    """
+    match = re.search(r'"payload"\s*:\s*', text)
+    if match is None:
+        raise ValueError("JWS envelope has no payload")
+    payload, _ = json.JSONDecoder().raw_decode(text, match.end())
+    if not isinstance(payload, str):
+        raise ValueError("JWS payload is not a string")
+    return payload
+
+
+def build_api_index(kind: str, source: Path, index_path: Path, digest: Optional[str] = None):
+    """Parse an API cache file and write its compact index.
+
+    Index layout: one JSON header line ({source stamp, name -> [offset, length]})
+    followed by one compact JSON record per package, addressable by offset.
+
+    The source is hashed and decoded straight from the mapping, and only the
+    payload string is pulled out of a JWS envelope, so at most the decoded file
+    and its payload are alive at once before packages are decoded one at a time.
+    """
+    start = time.monotonic()
+    stat = source.stat()
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        digest = digest or hashlib.sha256(mm).hexdigest()
+        with memoryview(mm) as view:
+            text = str(view, "utf-8")
+
+    if re.match(r"\s*\{", text):
+        text = _jws_payload(text)
+    make_record = _formula_record if kind == "formula" else _cask_record
+
+    records = []
+    offsets = {}
+    position = 0
+    for info in _iter_json_array(text):
+        name, record = make_record(info)
+        if not name:
+            continue
+        encoded = json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+        offsets[name] = [position, len(encoded)]
+        records.append(encoded)
+        position += len(encoded)
+    del text
+
+    header = {"format": API_INDEX_FORMAT, "kind": kind, "source_mtime": stat.st_mtime,
+              "source_size": stat.st_size, "source_sha256": digest, "offsets": offsets}
+    tmp_path = index_path.with_name(f".{index_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n")
+        f.writelines(records)
+    os.replace(tmp_path, index_path)
+    log(f"Built {kind} API index: {len(offsets)} entries in {time.monotonic() - start:.2f}s")
+
+
+def _read_index_header(index_path: Path) -> Optional[dict]:
+    try:
+        with open(index_path, "rb") as f:
+            header = json.loads(f.readline())
+        return header if header.get("format") == API_INDEX_FORMAT else None
+    except (OSError, ValueError):
+        return None
+
+
+def _restamp_api_index(index_path: Path, header: dict, stat: os.stat_result):
+    """Record a new source mtime for an index whose source content did not change"""
+    header = dict(header, source_mtime=stat.st_mtime, source_size=stat.st_size)
+    tmp_path = index_path.with_name(f".{index_path.name}.{os.getpid()}.tmp")
+    with open(index_path, "rb") as src, open(tmp_path, "wb") as dst:
+        src.readline()
+        dst.write(json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n")
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, index_path)
+
+
+class ApiIndex:
+    """O(1) lookups of formula or cask definitions from a memory-mapped index file"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self._mmap.find(b"\n") + 1
+        header = json.loads(self._mmap[:header_end])
+        self._data_start = header_end
+        self._offsets = header["offsets"]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get(self, name: str) -> Optional[dict]:
+        """The compact record for a package, or None if the API does not know it"""
+        location = self._offsets.get(name)
+        if location is None:
+            return None
+        offset, length = location
+        start = self._data_start + offset
+        return json.loads(self._mmap[start:start + length])
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+_API_INDEXES: Dict[Tuple[str, str], ApiIndex] = {}
+
+
+def load_api_index(kind: str) -> Optional[ApiIndex]:
+    """Open the formula or cask index, rebuilding it only if the API cache changed.
+
+    A changed mtime alone triggers a hash comparison; the index is only re-parsed
+    when the source content actually differs.
+    """
+    source = _api_source_file(kind)
+    if source is None:
+        return None
+    cache_key = (kind, str(source))
+    index_path = LOG_DIR / f".api-index-{kind}.idx"
+    try:
+        stat = source.stat()
+        header = _read_index_header(index_path)
+        fresh = header and header.get("source_mtime") == stat.st_mtime \
+            and header.get("source_size") == stat.st_size
+        if not fresh:
+            stale = _API_INDEXES.pop(cache_key, None)
+            if stale:
+                stale.close()
+            digest = _file_digest(source)
+            if header and header.get("source_sha256") == digest:
+                _restamp_api_index(index_path, header, stat)
+            else:
+                build_api_index(kind, source, index_path, digest)
+        if cache_key not in _API_INDEXES:
+            _API_INDEXES[cache_key] = ApiIndex(index_path)
+        return _API_INDEXES[cache_key]
+    except (OSError, ValueError, KeyError) as e:
+        log(f"Could not load {kind} API index from {source}: {e}", "WARN")
+        return None
+
 # ============================================================================
 # HOMEBREW OPERATIONS
 # ============================================================================
 
-def run_brew_command(args: List[str], check: bool = True) -> Tuple[bool, str]:
-    """Run a brew command and return success status and output"""
+# Process groups of running brew commands; each runs in its own session, so
+# signals sent to the updater have to be passed on explicitly
+_BREW_GROUPS: set = set()
+_BREW_GROUPS_LOCK = threading.Lock()
+
+
+def _signal_groups(signum: int):
+    with _BREW_GROUPS_LOCK:
+        groups = list(_BREW_GROUPS)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, signum)
+        except OSError:
+            pass
+
+
+def _forward_signal(signum, frame):
+    """Pass SIGINT/SIGTERM on to every running brew command, then stop the updater"""
+    _signal_groups(signum)
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    raise SystemExit(128 + signum)
+
+
+def install_signal_forwarding():
+    """Forward Ctrl-C and launchd's SIGTERM to brew (call from the main thread)"""
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, _forward_signal)
+
+
+def run_brew_command(args: List[str], check: bool = True,
+                     on_line: Optional[Callable[[str], None]] = None,
+                     capture: bool = True, log_output: bool = True,
+                     timeout: int = 3600, label: str = "",
+                     extra_env: Optional[Dict[str, str]] = None) -> Tuple[bool, str]:
+    """Run a brew command, streaming its output as it is produced.
+
+    Each line is written to the log as soon as brew emits it (so the log can be
+    followed with ``tail -f``) and stdout lines are handed to ``on_line``.
+    With ``capture=False`` only the last BREW_OUTPUT_TAIL_LINES lines are kept,
+    which bounds memory for long upgrades whose output is consumed via ``on_line``.
+    ``label`` prefixes logged output lines, which keeps concurrent commands readable,
+    and ``extra_env`` adds per-command environment variables on top of BREW_ENV.
+    Returns success status and output (stdout followed by stderr).
+    """
     cmd = [BREW_PATH] + args
     log(f"Running: {' '.join(cmd)}")
+    line_prefix = f"  [{label}] " if label else "  "
+
+    def _buffer():
+        return [] if capture else deque(maxlen=BREW_OUTPUT_TAIL_LINES)
+
+    stdout_lines = _buffer()
+    stderr_lines = _buffer()
+    timed_out = threading.Event()
+
+    def _handle(line: str, buffer, callback):
+        if log_output and line.strip():
+            log(f"{line_prefix}{line.rstrip()}")
+        buffer.append(line)
+        if callback:
+            callback(line.rstrip("\n"))
 
     try:
-        result = subprocess.run(
+        started = time.monotonic()
+        cpu_before = _children_cpu()
+        process = subprocess.Popen(
             cmd,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            env={**os.environ, **BREW_ENV},
-            timeout=3600  # 1 hour timeout
+            bufsize=1,
+            env={**os.environ, **BREW_ENV, **(extra_env or {})},
+            start_new_session=True
         )
 
-        output = result.stdout + result.stderr
-
-        # Log output
-        for line in output.splitlines():
-            if line.strip():
-                log(f"  {line}")
-
-        if check and result.returncode != 0:
+        def _on_timeout():
+            # brew's ruby, curl and git children hold the pipes open too: kill the whole group
+            timed_out.set()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+
+        watchdog = threading.Timer(timeout, _on_timeout)
+        watchdog.daemon = True
+        watchdog.start()
+
+        # stderr is drained on a helper thread so neither pipe can fill up and stall brew
+        stderr_reader = threading.Thread(
+            target=lambda: [_handle(line, stderr_lines, None) for line in process.stderr],
+            daemon=True
+        )
+        stderr_reader.start()
+        with _BREW_GROUPS_LOCK:
+            _BREW_GROUPS.add(process.pid)
+        try:
+            for line in process.stdout:
+                _handle(line, stdout_lines, on_line)
+            returncode, cpu, rss = _reap(process)
+            stderr_reader.join()
+        except BaseException:
+            # Interrupted or a callback failed: don't leave brew's tree running unreaped
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            process.wait()
+            raise
+        finally:
+            watchdog.cancel()
+            with _BREW_GROUPS_LOCK:
+                _BREW_GROUPS.discard(process.pid)
+
+        if RUN_METRICS is not None:
+            if cpu is None:
+                cpu = _children_cpu() - cpu_before
+            RUN_METRICS.record_command(args, time.monotonic() - started, cpu, rss, returncode == 0)
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+        output = "".join(stdout_lines) + "".join(stderr_lines)
+
+        if check and returncode != 0:
             return False, output
 
         return True, output
@@ -424,35 +2104,276 @@ def run_brew_command(args: List[str], check: bool = True) -> Tuple[bool, str]:
 
 def get_caskroom_path() -> Path:
     """Get the Caskroom directory path"""
+    if CASKROOM_PATH.is_dir():
+        return CASKROOM_PATH
+    # Unusual layout: ask brew where the Caskroom lives
     success, output = run_brew_command(["--caskroom"], check=False)
     if success:
         return Path(output.strip())
-    return Path("/opt/homebrew/Caskroom")
+    return CASKROOM_PATH
+
+def _parse_cask_info(text: str) -> Dict[str, Dict[str, List[str]]]:
+    """Compact artifacts from ``brew info --cask --json=v2`` stdout, decoding one cask at a time"""
+    key = text.find('"casks"')
+    if key < 0:
+        raise ValueError("no casks in brew info output")
+    start = text.index(":", key) + 1
+    return {info.get("token", ""): cask_artifacts(info) for info in _iter_json_array(text, start)}
+
+
+def _brew_info_chunk(casks: List[str]) -> Dict[str, Dict[str, List[str]]]:
+    stdout_lines = []
+    success, output = run_brew_command(["info", "--cask", "--json=v2"] + casks, check=True,
+                                       on_line=stdout_lines.append, log_output=False,
+                                       timeout=BREW_INFO_TIMEOUT)
+    if not success:
+        log(f"brew info failed for {len(casks)} casks ({casks[0]}...{casks[-1]}): "
+            f"{_last_error_line(output)}", "WARN")
+        return {}
+    try:
+        return _parse_cask_info("\n".join(stdout_lines))
+    except ValueError as e:
+        log(f"Failed to parse cask info JSON: {e}", "WARN")
+        return {}
+
+
+def _brew_info_cask_artifacts(casks: List[str]) -> Dict[str, Dict[str, List[str]]]:
+    """Artifacts per cask from ``brew info --cask --json=v2``.
+
+    Casks are queried in chunks of BREW_INFO_CHUNK_SIZE on up to BREW_INFO_WORKERS
+    concurrent brew processes, each with its own timeout, so a slow or failing
+    chunk only loses the casks in that chunk.
+    """
+    chunk_size = max(BREW_INFO_CHUNK_SIZE, 1)
+    chunks = [casks[i:i + chunk_size] for i in range(0, len(casks), chunk_size)]
+    artifacts_by_cask = {}
+    with ThreadPoolExecutor(max_workers=max(min(BREW_INFO_WORKERS, len(chunks)), 1)) as pool:
+        for result in pool.map(_brew_info_chunk, chunks):
+            artifacts_by_cask.update(result)
+    if len(artifacts_by_cask) < len(casks):
+        log(f"No cask info for {len(casks) - len(artifacts_by_cask)} of {len(casks)} casks, "
+            f"skipping their detailed checks", "WARN")
+    return artifacts_by_cask
+
+
+def _cask_stamp(cask_dir: Path, package: InstalledPackage) -> list:
+    """Change stamp of a Caskroom entry: directory mtime and installed version"""
+    try:
+        mtime = cask_dir.stat().st_mtime_ns
+    except OSError:
+        mtime = 0
+    return [mtime, package.version]
+
+
+def load_ghost_scan_state() -> dict:
+    """Per-cask records from the last ghost scan"""
+    try:
+        with open(GHOST_SCAN_STATE_FILE) as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log(f"Failed to read ghost scan state: {e}", "WARN")
+        return {}
 
-def heal_ghost_casks() -> List[str]:
-    """Remove ghost casks that are installed in Homebrew but missing from system"""
+
+def save_ghost_scan_state(state: dict):
+    try:
+        write_json_atomic(GHOST_SCAN_STATE_FILE, state)
+    except OSError as e:
+        log(f"Failed to save ghost scan state: {e}", "WARN")
+
+
+def uninstall_casks(casks: List[str], caskroom: Path) -> List[str]:
+    """Uninstall casks with one brew call and return the ones that were removed.
+
+    When the batch fails, the Caskroom shows which casks are already gone; the rest
+    are retried as a batch if the failed run made progress, otherwise split in half,
+    so a single bad cask costs about log2(n) extra brew runs instead of n.
+    """
+    if not casks:
+        return []
+    log(f"Removing ghost cask(s): {', '.join(casks)}")
+    success, _ = run_brew_command(["uninstall", "--cask", "--force", "--zap"] + casks, check=True)
+    if success:
+        return list(casks)
+
+    remaining = [cask for cask in casks if (caskroom / cask).exists()]
+    removed = [cask for cask in casks if cask not in remaining]
+    if not remaining or len(casks) == 1:
+        if remaining:
+            log(f"Failed to remove ghost cask: {remaining[0]}", "WARN")
+        return removed
+    if len(remaining) < len(casks):
+        return removed + uninstall_casks(remaining, caskroom)
+    middle = len(remaining) // 2
+    return (removed + uninstall_casks(remaining[:middle], caskroom)
+            + uninstall_casks(remaining[middle:], caskroom))
+
+
+def remove_tree(path: Path) -> bool:
+    """Delete a directory tree, falling back to non-interactive sudo for root-owned files"""
+    try:
+        shutil.rmtree(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError as e:
+        log(f"Could not remove {path} ({e}), retrying with sudo", "WARN")
+    try:
+        result = subprocess.run(["sudo", "-n", "rm", "-rf", str(path)],
+                                capture_output=True, text=True, timeout=60)
+        if result.returncode == 0:
+            return True
+        log(f"sudo rm failed for {path}: {result.stderr.strip()}", "WARN")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log(f"sudo rm failed for {path}: {e}", "WARN")
+    return False
+
+
+def _partial_upgrades(cask_path: str) -> List[Path]:
+    """``*.upgrading`` dirs an interrupted upgrade left in one Caskroom entry (either level)"""
+    partials = []
+    for entry in _subdirs(cask_path):
+        if entry.name.endswith(".upgrading"):
+            partials.append(Path(entry.path))
+            continue
+        partials.extend(Path(sub.path) for sub in _subdirs(entry.path)
+                        if sub.name.endswith(".upgrading"))
+    return partials
+
+
+@dataclass
+class SweepReport:
+    """Stale state left behind in the prefix by interrupted or half-cleaned upgrades"""
+    partials: List[Path] = field(default_factory=list)
+    empty_dirs: List[Path] = field(default_factory=list)
+    broken_links: List[Path] = field(default_factory=list)
+    repaired: List[Path] = field(default_factory=list)
+
+    def merge(self, other: "SweepReport"):
+        self.partials.extend(other.partials)
+        self.empty_dirs.extend(other.empty_dirs)
+        self.broken_links.extend(other.broken_links)
+
+    @property
+    def found(self) -> int:
+        return len(self.partials) + len(self.empty_dirs) + len(self.broken_links)
+
+
+def _is_empty_dir(path: str) -> bool:
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is None
+    except OSError:
+        return False
+
+
+def _sweep_cask(path: str) -> SweepReport:
+    """Partials and empty leftover version dirs of one Caskroom entry.
+
+    The installed version's directory is often legitimately empty (its app was moved
+    to /Applications), so only empty dirs of other versions count as stale.
+    """
+    report = SweepReport(partials=_partial_upgrades(path))
+    installed = read_cask(os.path.basename(path), path).version
+    for entry in _subdirs(path):
+        if (entry.name != installed and not entry.name.endswith(".upgrading")
+                and _is_empty_dir(entry.path)):
+            report.empty_dirs.append(Path(entry.path))
+    return report
+
+
+def _sweep_kegs(path: str) -> SweepReport:
+    """Empty keg dirs of one Cellar entry (a keg always has files)"""
+    return SweepReport(empty_dirs=[Path(entry.path) for entry in _subdirs(path)
+                                   if _is_empty_dir(entry.path)])
+
+
+def _sweep_links(path: str) -> SweepReport:
+    """Symlinks in a link dir (bin, sbin, opt) whose target is gone"""
+    report = SweepReport()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_symlink() and not os.path.exists(entry.path):
+                    report.broken_links.append(Path(entry.path))
+    except OSError:
+        pass
+    return report
+
+
+def sweep_stale_state(repair: bool = False, repair_partials: bool = False,
+                      workers: Optional[int] = None) -> SweepReport:
+    """Find (and with ``repair``, remove) stale state in the Caskroom, Cellar and link dirs.
+
+    ``repair_partials`` removes only the ``*.upgrading`` partials, which break later
+    upgrades of their cask, and leaves empty dirs and broken links reported.
+
+    Every Caskroom and Cellar entry and every link dir is one scandir task on a
+    thread pool, so the sweep costs a few directory reads per package.
+    """
+    start = time.monotonic()
+    tasks = ([(_sweep_cask, entry.path) for entry in _subdirs(CASKROOM_PATH)]
+             + [(_sweep_kegs, entry.path) for entry in _subdirs(CELLAR_PATH)]
+             + [(_sweep_links, str(HOMEBREW_PREFIX / name)) for name in ("bin", "sbin", "opt")])
+    report = SweepReport()
+    with ThreadPoolExecutor(max_workers=max(workers or SWEEP_WORKERS, 1)) as pool:
+        for result in pool.map(lambda task: task[0](task[1]), tasks):
+            report.merge(result)
+    report.partials.sort()
+    report.empty_dirs.sort()
+    report.broken_links.sort()
+
+    for label, paths in (("Partial upgrade", report.partials), ("Empty version dir", report.empty_dirs),
+                         ("Broken link", report.broken_links)):
+        for path in paths:
+            log(f"{label}: {path}", "WARN")
+
+    if repair or repair_partials:
+        for path in report.partials:
+            if remove_tree(path):
+                report.repaired.append(path)
+    if repair:
+        for path in report.empty_dirs:
+            try:
+                os.rmdir(path)
+                report.repaired.append(path)
+            except OSError as e:
+                log(f"Could not remove {path}: {e}", "WARN")
+        for path in report.broken_links:
+            try:
+                os.unlink(path)
+                report.repaired.append(path)
+            except OSError as e:
+                log(f"Could not remove {path}: {e}", "WARN")
+
+    log(f"Stale-state sweep: {report.found} found, {len(report.repaired)} repaired "
+        f"({len(tasks)} directories in {time.monotonic() - start:.2f}s)")
+    return report
+
+
+def heal_ghost_casks(dry_run: bool = False) -> List[str]:
+    """Remove ghost casks that are installed in Homebrew but missing from system.
+
+    With ``dry_run`` nothing is removed and the casks that would be are returned.
+    """
     log("Scanning for ghost casks...")
 
     removed_casks = []
     ghost_casks = []
 
-    # Get list of installed casks
-    success, output = run_brew_command(["list", "--cask"], check=False)
-    if not success:
-        log("Could not get cask list", "WARN")
-        return removed_casks
-
-    casks = [c.strip() for c in output.strip().split('\n') if c.strip()]
+    # *.upgrading partials are left to the stale-state sweep (STALE_STATE_SWEEP)
     caskroom = get_caskroom_path()
 
+    # Installed casks are the Caskroom directories (what `brew list --cask` reports)
+    casks = dict(sorted(read_casks(caskroom).items()))
+
     # First pass: Identify casks that definitely have issues or need detailed checking
     casks_needing_detailed_check = []
 
-    for cask in casks:
-        # Skip fonts and quicklook plugins (often no .app artifacts)
-        if cask.startswith('font-') or cask.startswith('ql'):
-            continue
-
+    for cask, package in casks.items():
         cask_dir = caskroom / cask
 
         # Definitely ghost if directory doesn't exist or is empty
@@ -464,115 +2385,656 @@ def heal_ghost_casks() -> List[str]:
             # Has directory with content - needs detailed artifact checking
             casks_needing_detailed_check.append(cask)
 
-    # Second pass: Batch check artifacts for casks with directories
+    # Casks whose Caskroom entry is unchanged since the last scan, and whose artifact
+    # is still where that scan found it, keep their verdict
+    previous_scan = load_ghost_scan_state()
+    scan_state = {}
+    casks_to_verify = []
+    for cask in casks_needing_detailed_check:
+        stamp = _cask_stamp(caskroom / cask, casks[cask])
+        record = previous_scan.get(cask)
+        if (record and record.get("stamp") == stamp
+                and (record.get("found") is None or os.path.lexists(record["found"]))):
+            scan_state[cask] = record
+        else:
+            scan_state[cask] = {"stamp": stamp, "found": None}
+            casks_to_verify.append(cask)
     if casks_needing_detailed_check:
-        log(f"Checking {len(casks_needing_detailed_check)} casks for missing applications...")
+        log(f"{len(casks_needing_detailed_check) - len(casks_to_verify)} casks unchanged since the last scan")
+
+    # Second pass: check artifacts for changed casks
+    if casks_to_verify:
+        log(f"Checking {len(casks_to_verify)} casks for missing artifacts...")
+
+        # Artifacts come from the local API index; only casks it does not know
+        # (e.g. from third-party taps) need a batched brew info call
+        artifacts_by_cask = {}
+        missing_from_index = []
+        index = load_api_index("cask")
+        for cask in casks_to_verify:
+            record = index.get(cask) if index else None
+            if record is None:
+                missing_from_index.append(cask)
+            else:
+                artifacts_by_cask[cask] = record["artifacts"]
+        if missing_from_index:
+            artifacts_by_cask.update(_brew_info_cask_artifacts(missing_from_index))
+            # Without artifact information there is no verdict to remember
+            for cask in missing_from_index:
+                if cask not in artifacts_by_cask:
+                    scan_state.pop(cask, None)
+
+        # Existence checks are set lookups against one scan of each artifact directory
+        present = ArtifactIndex()
+        for cask_name, artifacts in artifacts_by_cask.items():
+            # Casks without checkable artifacts (pkg installers, stage_only...) are left alone
+            if not present.checkable(artifacts):
+                continue
+            located = present.locate(artifacts)
+            if located:
+                found, path = located
+                scan_state[cask_name]["found"] = str(path)
+                log(f"  ✓ Found {found} for {cask_name}")
+            else:
+                log(f"  ✗ No artifacts found for {cask_name}, marking as ghost")
+                ghost_casks.append(cask_name)
+                scan_state.pop(cask_name, None)
 
-        # Batch fetch all cask info in one call
-        cmd = [BREW_PATH, "info", "--cask", "--json=v2"] + casks_needing_detailed_check
-        try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                env={**os.environ, **BREW_ENV},
-                timeout=60  # 1 minute should be enough for batch query
-            )
-
-            if result.returncode == 0:
-                try:
-                    info = json.loads(result.stdout + result.stderr)
-                    if info and 'casks' in info:
-                        for cask_info in info['casks']:
-                            cask_name = cask_info.get('token', '')
-                            artifacts = cask_info.get('artifacts', [])
-                            apps = []
-
-                            for artifact in artifacts:
-                                if isinstance(artifact, dict) and 'app' in artifact:
-                                    apps.extend(artifact['app'])
-
-                            # If cask defines apps, check if any exist
-                            if apps:
-                                found = False
-                                for app in apps:
-                                    # Extract just the .app filename, stripping version directories
-                                    app_name = Path(app).name
-                                    app_path = Path("/Applications") / app_name
-                                    home_app_path = Path.home() / "Applications" / app_name
-                                    log(f"  Checking {cask_name}: looking for {app_name}")
-                                    if app_path.exists() or home_app_path.exists():
-                                        found = True
-                                        log(f"  ✓ Found {app_name} for {cask_name}")
-                                        break
-
-                                if not found:
-                                    log(f"  ✗ No app found for {cask_name}, marking as ghost")
-                                    ghost_casks.append(cask_name)
-                except json.JSONDecodeError as e:
-                    log(f"Failed to parse cask info JSON: {e}", "WARN")
-        except subprocess.TimeoutExpired:
-            log("Batch cask info check timed out, skipping detailed checks", "WARN")
-        except Exception as e:
-            log(f"Error during batch cask check: {e}", "WARN")
+    save_ghost_scan_state(scan_state)
 
     # Remove identified ghost casks
     if ghost_casks:
         log(f"Found {len(ghost_casks)} ghost cask(s): {', '.join(ghost_casks)}")
 
-        for cask in ghost_casks:
-            log(f"Removing ghost cask: {cask}")
-            success, _ = run_brew_command(["uninstall", "--cask", "--force", "--zap", cask], check=False)
-            if success:
-                removed_casks.append(cask)
+        if dry_run:
+            log(f"[dry-run] Would remove ghost cask(s): {', '.join(ghost_casks)}")
+            return ghost_casks
+        removed = set(uninstall_casks(ghost_casks, caskroom))
+        removed_casks = [cask for cask in ghost_casks if cask in removed]
     else:
         log("No ghost casks found")
 
     return removed_casks
 
+# Brew refuses to work on a package another brew process has locked, e.g.
+# "Error: A `brew upgrade foo` process has already locked /opt/homebrew/var/homebrew/locks/foo.formula.lock"
+BREW_LOCK_PATTERN = re.compile(r"has already locked|Another active Homebrew .* process is already in progress")
+
+
+@dataclass
+class UpgradeResult:
+    """Outcome of upgrading a single package"""
+    name: str
+    status: str  # "success", "warning", "failed" or "skipped"
+    detail: str = ""
+
+
+def run_locked_brew_command(args: List[str], label: str,
+                            extra_env: Optional[Dict[str, str]] = None) -> Tuple[bool, str]:
+    """Run a brew command, waiting and retrying while another brew process holds its lock"""
+    for attempt in range(BREW_LOCK_RETRIES + 1):
+        success, output = run_brew_command(args, check=True, capture=False, label=label,
+                                           extra_env=extra_env)
+        if success or not BREW_LOCK_PATTERN.search(output) or attempt == BREW_LOCK_RETRIES:
+            return success, output
+        log(f"{label} is locked by another brew process, retrying in {BREW_LOCK_RETRY_DELAY:g}s", "WARN")
+        time.sleep(BREW_LOCK_RETRY_DELAY)
+    return success, output
+
+
+def _last_error_line(output: str) -> str:
+    """Pick the most informative line of brew output for a result detail"""
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    for line in reversed(lines):
+        if line.startswith("Error:"):
+            return line
+    return lines[-1] if lines else ""
+
+
+def _cask_version_dirs(cask_dir: Path) -> set:
+    """Names of installed version directories of a cask in the Caskroom"""
+    try:
+        return {entry.name for entry in os.scandir(cask_dir)
+                if entry.is_dir() and not entry.name.startswith('.')}
+    except OSError:
+        return set()
+
+
+def upgrade_single_cask(cask: str, caskroom: Path, greedy: bool = True) -> UpgradeResult:
+    """Upgrade one cask and classify the outcome from its exit status.
+
+    A non-zero exit after a new version directory appeared in the Caskroom means the
+    upgrade itself went through and only post-upgrade cleanup failed (a warning).
+    """
+    versions_before = _cask_version_dirs(caskroom / cask)
+    args = ["upgrade", "--cask"] + (["--greedy"] if greedy else []) + [cask]
+    success, output = run_locked_brew_command(args, label=cask)
+    if success:
+        return UpgradeResult(cask, "success")
+    detail = _last_error_line(output)
+    if _cask_version_dirs(caskroom / cask) - versions_before:
+        return UpgradeResult(cask, "warning", detail)
+    return UpgradeResult(cask, "failed", detail)
+
+
+def upgrade_casks_parallel(casks: List[str], workers: int, greedy: bool = True) -> List[UpgradeResult]:
+    """Upgrade casks individually across a bounded worker pool"""
+    caskroom = get_caskroom_path()
+    log(f"Upgrading {len(casks)} casks with {workers} workers...")
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(upgrade_single_cask, cask, caskroom, greedy): cask for cask in casks}
+        for future in as_completed(futures):
+            cask = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = UpgradeResult(cask, "failed", str(e))
+            level = "INFO" if result.status == "success" else "WARN"
+            log(f"Cask {cask}: {result.status}" + (f" ({result.detail})" if result.detail else ""), level)
+            results.append(result)
+    # Report in the order brew listed the casks rather than completion order
+    order = {cask: index for index, cask in enumerate(casks)}
+    return sorted(results, key=lambda result: order[result.name])
+
+def get_formula_dependencies(formulae: List[str]) -> Optional[Dict[str, set]]:
+    """Map each formula to the (recursive) runtime dependencies among ``formulae``.
+
+    Dependencies come from the install receipts in the Cellar, which already list
+    the full recursive runtime dependency closure. Returns None if any receipt is
+    unreadable, since an incomplete graph could schedule a dependent too early.
+    """
+    wanted = set(formulae)
+    installed = read_formulae()
+    graph = {}
+    for formula in formulae:
+        receipt = installed[formula].receipt if formula in installed else None
+        if receipt is None:
+            log(f"No install receipt for {formula}, cannot build dependency graph", "WARN")
+            return None
+        deps = set()
+        for dep in receipt.get("runtime_dependencies") or []:
+            full_name = dep.get("full_name", "")
+            # Tap-qualified names ("user/tap/foo") are listed by brew outdated as "foo"
+            for name in (full_name, full_name.rsplit("/", 1)[-1]):
+                if name in wanted and name != formula:
+                    deps.add(name)
+        graph[formula] = deps
+    return graph
+
+
+def upgrade_single_formula(formula: str) -> UpgradeResult:
+    """Upgrade one formula; dependents are scheduled by the caller, so brew skips its own check"""
+    success, output = run_locked_brew_command(
+        ["upgrade", "--formula", formula], label=formula,
+        extra_env={"HOMEBREW_NO_INSTALLED_DEPENDENTS_CHECK": "1"}
+    )
+    if success:
+        return UpgradeResult(formula, "success")
+    return UpgradeResult(formula, "failed", _last_error_line(output))
+
+
+def upgrade_formulae_dag(formulae: List[str], graph: Dict[str, set], workers: int) -> List[UpgradeResult]:
+    """Upgrade formulae concurrently, always upgrading a dependency before its dependents.
+
+    Independent subtrees run in parallel on a bounded pool. When a formula fails,
+    everything that depends on it is skipped rather than upgraded against a stale dependency.
+    """
+    log(f"Upgrading {len(formulae)} formulae with {workers} workers...")
+    waiting_on = {formula: set(graph.get(formula, ())) for formula in formulae}
+    dependents = {formula: set() for formula in formulae}
+    for formula, deps in waiting_on.items():
+        for dep in deps:
+            dependents[dep].add(formula)
+
+    results: Dict[str, UpgradeResult] = {}
+
+    def _skip_dependents(failed: str):
+        pending = list(dependents[failed])
+        while pending:
+            dependent = pending.pop()
+            if dependent not in results:
+                results[dependent] = UpgradeResult(dependent, "skipped", f"dependency {failed} failed")
+                log(f"Formula {dependent}: skipped (dependency {failed} failed)", "WARN")
+                pending.extend(dependents[dependent])
+
+    ready = [formula for formula in formulae if not waiting_on[formula]]
+    running = {}
+    submitted = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for formula in ready:
+                if formula not in results and formula not in submitted:
+                    submitted.add(formula)
+                    running[pool.submit(upgrade_single_formula, formula)] = formula
+            ready = []
+            if not running:
+                blocked = [f for f in formulae if f not in results and f not in submitted]
+                if not blocked:
+                    break
+                # Only reachable with a dependency cycle; break it deterministically
+                log(f"Dependency cycle among {', '.join(blocked)}, upgrading {blocked[0]} first", "WARN")
+                waiting_on[blocked[0]].clear()
+                ready = [blocked[0]]
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                formula = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = UpgradeResult(formula, "failed", str(e))
+                results[formula] = result
+                level = "INFO" if result.status == "success" else "WARN"
+                log(f"Formula {formula}: {result.status}" + (f" ({result.detail})" if result.detail else ""), level)
+                if result.status != "success":
+                    _skip_dependents(formula)
+                    continue
+                for dependent in dependents[formula]:
+                    waiting_on[dependent].discard(formula)
+                    if not waiting_on[dependent] and dependent not in results:
+                        ready.append(dependent)
+
+    return [results[formula] for formula in formulae]
+
+def run_brew_json(args: List[str], timeout: int = 600) -> Optional[dict]:
+    """Run a brew command that prints JSON and parse its stdout (stderr is only logged)"""
+    stdout_lines = []
+    success, output = run_brew_command(args, check=False, on_line=stdout_lines.append,
+                                       capture=False, log_output=False, timeout=timeout)
+    if not success:
+        return None
+    try:
+        return json.loads("\n".join(stdout_lines))
+    except json.JSONDecodeError as e:
+        log(f"Failed to parse JSON from brew {' '.join(args)}: {e}", "WARN")
+        for line in output.splitlines()[-5:]:
+            log(f"  {line}", "WARN")
+        return None
+
+
+@dataclass
+class OutdatedPackage:
+    """An outdated formula or cask as reported by ``brew outdated --json=v2``"""
+    name: str
+    installed_versions: List[str]
+    current_version: str
+    pinned: bool = False
+
+    @property
+    def installed_version(self) -> str:
+        return self.installed_versions[-1] if self.installed_versions else "?"
+
+    @property
+    def version_change(self) -> str:
+        return f"{self.installed_version} → {self.current_version}"
+
+
+@dataclass
+class OutdatedSet:
+    """Everything that is outdated, discovered once per run and shared by all phases"""
+    formulae: Dict[str, OutdatedPackage]
+    casks: Dict[str, OutdatedPackage]
+
+    def describe(self, name: str) -> str:
+        """Package name with its version change, for summaries"""
+        package = self.formulae.get(name) or self.casks.get(name)
+        return f"{name} ({package.version_change})" if package else name
+
+    def versions(self, name: str) -> Optional[List[str]]:
+        """``[installed, current]`` versions of a package, or None when it is unknown"""
+        package = self.formulae.get(name) or self.casks.get(name)
+        return [package.installed_version, package.current_version] if package else None
+
+
+def _parse_outdated_entries(entries: list) -> Dict[str, OutdatedPackage]:
+    packages = {}
+    for entry in entries or []:
+        name = entry.get("name")
+        if not name:
+            continue
+        packages[name] = OutdatedPackage(
+            name=name,
+            installed_versions=[str(v) for v in entry.get("installed_versions") or []],
+            current_version=str(entry.get("current_version", "")),
+            pinned=bool(entry.get("pinned", False))
+        )
+    return packages
+
+
+def _is_pinned(formula: str) -> bool:
+    return os.path.islink(HOMEBREW_PREFIX / "var/homebrew/pinned" / formula)
+
+
+def compute_outdated_locally(greedy: bool = True) -> Optional[OutdatedSet]:
+    """Work out what is outdated without running brew.
+
+    Installed versions come from the Cellar and Caskroom, current versions from the
+    API index. Returns None whenever the answer is ambiguous (a package the API does
+    not know, a formula whose install receipt does not name homebrew/core as its tap,
+    or a HEAD build), so the caller can fall back to ``brew outdated``.
+    """
+    start = time.monotonic()
+    formula_index = load_api_index("formula")
+    cask_index = load_api_index("cask")
+    if formula_index is None or cask_index is None:
+        log("No local API cache, cannot check outdated packages without brew")
+        return None
+
+    outdated = OutdatedSet(formulae={}, casks={})
+    for name, package in read_formulae().items():
+        # The API index only describes homebrew/core; a tapped formula may share a core name
+        tap = ((package.receipt or {}).get("source") or {}).get("tap")
+        if tap != "homebrew/core":
+            log(f"Formula {name} is from {tap or 'an unknown tap'}, falling back to brew outdated")
+            return None
+        record = formula_index.get(name)
+        if record is None or not record["version"]:
+            log(f"Formula {name} is not in the API cache, falling back to brew outdated")
+            return None
+        if any(version.startswith("HEAD") for version in package.versions):
+            log(f"Formula {name} is a HEAD build, falling back to brew outdated")
+            return None
+        # Like brew, a formula is current as soon as a keg of the current version exists
+        if record["version"] not in package.versions:
+            outdated.formulae[name] = OutdatedPackage(name, package.versions, record["version"],
+                                                      pinned=_is_pinned(name))
+
+    for token, package in read_casks().items():
+        if not package.version:
+            continue  # nothing installed to compare; ghost healing deals with these
+        record = cask_index.get(token)
+        if record is None or not record["version"]:
+            log(f"Cask {token} is not in the API cache, falling back to brew outdated")
+            return None
+        if record["auto_updates"] and not greedy:
+            continue
+        if record["version"] == "latest":
+            # Unversioned casks only count as outdated when upgrading greedily
+            is_outdated = greedy
+        else:
+            is_outdated = package.version != record["version"]
+        if is_outdated:
+            outdated.casks[token] = OutdatedPackage(token, [package.version], record["version"])
+
+    log(f"Outdated (from local API cache): {len(outdated.formulae)} formulae, {len(outdated.casks)} casks "
+        f"in {(time.monotonic() - start) * 1000:.0f} ms")
+    return outdated
+
+
+def get_outdated(greedy: bool = True) -> Optional[OutdatedSet]:
+    """Discover outdated formulae and casks.
+
+    Uses the brew-free comparison of the inventory against the API index when
+    OUTDATED_SOURCE is "auto", otherwise (or when that is ambiguous) a single
+    ``brew outdated --json=v2 --greedy``. ``greedy=False`` leaves out casks that
+    update themselves.
+    """
+    log("Checking for outdated packages...")
+    if OUTDATED_SOURCE == "auto":
+        outdated = compute_outdated_locally(greedy)
+        if outdated is not None:
+            return outdated
+    data = run_brew_json(["outdated", "--json=v2"] + (["--greedy"] if greedy else []))
+    if data is None:
+        log("Could not determine outdated packages", "ERROR")
+        return None
+    outdated = OutdatedSet(
+        formulae=_parse_outdated_entries(data.get("formulae")),
+        casks=_parse_outdated_entries(data.get("casks"))
+    )
+    log(f"Outdated: {len(outdated.formulae)} formulae, {len(outdated.casks)} casks")
+    return outdated
+
+# `brew fetch` reports where each artifact lives: "Downloaded to: <path>" or "Already downloaded: <path>"
+FETCH_PATH_PATTERN = re.compile(r"^(Downloaded to|Already downloaded):\s+(.+)$")
+
+
+@dataclass
+class FetchResult:
+    """Outcome of prefetching one package into HOMEBREW_CACHE"""
+    name: str
+    kind: str  # "formula" or "cask"
+    success: bool
+    cached: bool = False  # already present before the fetch
+    size: int = 0  # bytes of the artifact
+    seconds: float = 0.0
+    paths: List[str] = field(default_factory=list)
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def fetch_package(name: str, kind: str) -> FetchResult:
+    """Download one formula bottle or cask artifact into the cache"""
+    artifacts = []
+
+    def _track_artifact(line: str):
+        match = FETCH_PATH_PATTERN.match(line.strip())
+        if match:
+            artifacts.append((match.group(1) == "Already downloaded", match.group(2)))
+
+    start = time.monotonic()
+    success, _ = run_brew_command(["fetch", f"--{kind}", name], on_line=_track_artifact,
+                                  capture=False, label=name)
+    result = FetchResult(name, kind, success, seconds=time.monotonic() - start)
+    if artifacts:
+        result.cached = all(cached for cached, _ in artifacts)
+        result.paths = [path for _, path in artifacts]
+        for _, path in artifacts:
+            try:
+                result.size += os.path.getsize(path)
+            except OSError:
+                pass
+    return result
+
+
+def prefetch_downloads(outdated: OutdatedSet, workers: int) -> List[FetchResult]:
+    """Fetch every outdated formula and cask concurrently so upgrades install from the cache"""
+    packages = [(name, "formula") for name, package in outdated.formulae.items() if not package.pinned]
+    packages += [(name, "cask") for name in outdated.casks]
+    if not packages:
+        return []
+
+    log(f"Prefetching {len(packages)} packages with {workers} workers...")
+    start = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_package, name, kind) for name, kind in packages]
+        for future in as_completed(futures):
+            result = future.result()
+            if not result.success:
+                log(f"Prefetch failed for {result.kind} {result.name}; it will download during upgrade", "WARN")
+            else:
+                state = "cached" if result.cached else "downloaded"
+                log(f"Prefetched {result.kind} {result.name}: {_format_bytes(result.size)} {state} "
+                    f"in {result.seconds:.1f}s")
+            results.append(result)
+
+    downloaded = sum(r.size for r in results if r.success and not r.cached)
+    cached = sum(1 for r in results if r.success and r.cached)
+    failed = sum(1 for r in results if not r.success)
+    log(f"Prefetch complete in {time.monotonic() - start:.1f}s: {_format_bytes(downloaded)} downloaded, "
+        f"{cached} already cached, {failed} failed")
+    return results
+
+def write_text_atomic(path: Path, text: str):
+    """Write a file so readers never see it partially written"""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path: Path, data):
+    """Write JSON state so readers never see a partially written file"""
+    write_text_atomic(path, json.dumps(data))
+
+
+def save_prefetch_manifest(outdated: OutdatedSet, results: List[FetchResult]):
+    """Record which package versions were fetched, and where, for a later --apply-cached run"""
+    manifest = {}
+    for result in results:
+        packages = outdated.formulae if result.kind == "formula" else outdated.casks
+        if result.success and result.paths and result.name in packages:
+            manifest[f"{result.kind}/{result.name}"] = {
+                "version": packages[result.name].current_version,
+                "paths": result.paths
+            }
+    try:
+        write_json_atomic(PREFETCH_MANIFEST_FILE, manifest)
+        log(f"Saved prefetch manifest with {len(manifest)} packages")
+    except OSError as e:
+        log(f"Failed to save prefetch manifest: {e}", "WARN")
+
+
+def load_prefetch_manifest() -> dict:
+    """Load the manifest written by the last --fetch-only run"""
+    try:
+        with open(PREFETCH_MANIFEST_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        log("No prefetch manifest found; run with --fetch-only first", "WARN")
+    except (OSError, ValueError) as e:
+        log(f"Failed to read prefetch manifest: {e}", "WARN")
+    return {}
+
+
+def filter_cached(outdated: OutdatedSet, manifest: dict) -> Tuple[OutdatedSet, List[str]]:
+    """Split outdated packages into those whose current version is fully cached and the rest"""
+    not_cached = []
+
+    def _cached(kind: str, packages: Dict[str, OutdatedPackage]) -> Dict[str, OutdatedPackage]:
+        kept = {}
+        for name, package in packages.items():
+            entry = manifest.get(f"{kind}/{name}")
+            if (entry and entry.get("version") == package.current_version
+                    and all(Path(path).exists() for path in entry.get("paths", []))):
+                kept[name] = package
+            else:
+                log(f"Skipping {kind} {name}: {package.current_version} is not in the cache", "WARN")
+                not_cached.append(name)
+        return kept
+
+    cached = OutdatedSet(formulae=_cached("formula", outdated.formulae),
+                         casks=_cached("cask", outdated.casks))
+    return cached, not_cached
+
+
+def enable_offline_mode():
+    """Keep brew from touching the network during an --apply-cached run"""
+    BREW_ENV.update({
+        "HOMEBREW_NO_AUTO_UPDATE": "1",
+        "HOMEBREW_NO_ANALYTICS": "1",
+        "HOMEBREW_NO_INSTALL_CLEANUP": "1",
+    })
+
+
+def run_fetch_only(greedy: bool = True) -> int:
+    """Fetch stage: update, then download every outdated package into HOMEBREW_CACHE"""
+    if not brew_update():
+        error_msg = "Failed to update Homebrew"
+        log(error_msg, "ERROR")
+        send_notification(f"❌ {error_msg}", error=True)
+        return 1
+
+    outdated = get_outdated(greedy)
+    if outdated is None:
+        error_msg = "Failed to check for outdated packages"
+        log(error_msg, "ERROR")
+        send_notification(f"❌ {error_msg}", error=True)
+        return 1
+
+    results = prefetch_downloads(outdated, max(PREFETCH_WORKERS, 1))
+    save_prefetch_manifest(outdated, results)
+
+    failed = [r.name for r in results if not r.success]
+    if failed:
+        send_notification(f"⚠️ **Homebrew prefetch incomplete**\n\n"
+                          f"Could not download {len(failed)} package(s): {', '.join(failed)}", error=True)
+    log("=" * 80)
+    log(f"Fetch-only run complete: {len(results) - len(failed)} of {len(results)} packages cached")
+    log("=" * 80)
+    return 0
+
 def brew_update() -> bool:
     """Run brew update"""
     log("Updating Homebrew...")
-    success, _ = run_brew_command(["update"])
+    success, _ = run_brew_command(["update"], capture=False)
     return success
 
-def brew_upgrade_formulae() -> Tuple[bool, List[str]]:
-    """Upgrade all formulae and return list of upgraded packages"""
+def brew_upgrade_formulae(outdated: Optional[OutdatedSet] = None) -> Tuple[bool, List[str], List[str]]:
+    """Upgrade all formulae and return (success, upgraded_formulae, failed_formulae)"""
     log("Upgrading formulae...")
 
-    # First check what's outdated
-    success, output = run_brew_command(["outdated", "--formula"], check=False)
-    outdated_formulae = [line.split()[0] for line in output.splitlines() if line.strip()]
+    if outdated is None:
+        outdated = get_outdated()
+        if outdated is None:
+            return False, [], []
+
+    pinned = [name for name, package in outdated.formulae.items() if package.pinned]
+    if pinned:
+        log(f"Skipping pinned formulae: {', '.join(pinned)}")
+    outdated_formulae = [name for name, package in outdated.formulae.items() if not package.pinned]
 
     if not outdated_formulae:
         log("No outdated formulae")
-        return True, []
+        return True, [], []
 
     log(f"Found {len(outdated_formulae)} outdated formulae: {', '.join(outdated_formulae)}")
-    success, _ = run_brew_command(["upgrade", "--formula"])
-    return success, outdated_formulae if success else []
 
-def brew_upgrade_casks() -> Tuple[bool, List[str], List[str]]:
-    """Upgrade all casks with greedy flag and return (success, upgraded_casks, casks_with_warnings)"""
+    if FORMULA_UPGRADE_WORKERS > 1 and len(outdated_formulae) > 1:
+        graph = get_formula_dependencies(outdated_formulae)
+        if graph is not None:
+            results = upgrade_formulae_dag(outdated_formulae, graph, FORMULA_UPGRADE_WORKERS)
+            upgraded = [r.name for r in results if r.status == "success"]
+            failed = [r.name for r in results if r.status != "success"]
+            if failed:
+                log(f"Failed to upgrade {len(failed)} formula(e): {', '.join(failed)}", "ERROR")
+            return bool(upgraded or not failed), upgraded, failed
+        log("Falling back to a single brew upgrade --formula run", "WARN")
+
+    # Name the formulae: the set may have been filtered (pinned, or not cached for --apply-cached)
+    success, _ = run_brew_command(["upgrade", "--formula"] + outdated_formulae, capture=False)
+    return success, outdated_formulae if success else [], []
+
+def brew_upgrade_casks(outdated: Optional[OutdatedSet] = None,
+                       greedy: bool = True) -> Tuple[bool, List[str], List[str], List[str]]:
+    """Upgrade all casks (with greedy flag unless disabled) and return (success, upgraded_casks, casks_with_warnings, failed_casks)"""
     log("Upgrading casks...")
 
-    # First check what's outdated
-    success, output = run_brew_command(["outdated", "--cask", "--greedy"], check=False)
-    outdated_casks = [line.split()[0] for line in output.splitlines() if line.strip()]
+    if outdated is None:
+        outdated = get_outdated(greedy)
+        if outdated is None:
+            return False, [], [], []
+
+    outdated_casks = list(outdated.casks)
 
     if not outdated_casks:
         log("No outdated casks")
-        return True, [], []
+        return True, [], [], []
 
     log(f"Found {len(outdated_casks)} outdated casks: {', '.join(outdated_casks)}")
 
-    # Run upgrade (may have non-zero exit code due to cleanup failures, but upgrades may still succeed)
-    success, upgrade_output = run_brew_command(["upgrade", "--cask", "--greedy"], check=False)
-
-    # Parse output to find actually upgraded casks (look for success indicators)
+    if CASK_UPGRADE_WORKERS > 1 and len(outdated_casks) > 1:
+        results = upgrade_casks_parallel(outdated_casks, CASK_UPGRADE_WORKERS, greedy)
+        upgraded = [r.name for r in results if r.status == "success"]
+        casks_with_warnings = [r.name for r in results if r.status == "warning"]
+        failed = [r.name for r in results if r.status == "failed"]
+        if failed:
+            log(f"Failed to upgrade {len(failed)} cask(s): {', '.join(failed)}", "ERROR")
+        # The phase only fails outright when no cask could be upgraded at all
+        return bool(upgraded or casks_with_warnings or not failed), upgraded, casks_with_warnings, failed
+
+    # Parse output as it streams to find actually upgraded casks (look for success indicators)
     # Brew shows "✔︎ Cask name (version)" or "🍺 name was successfully upgraded!"
     successfully_upgraded = []
-    for line in upgrade_output.splitlines():
+
+    def _track_upgraded(line: str):
         # Look for the checkmark indicator: "✔︎ Cask name (version)"
         if "✔︎ Cask" in line or "✔︎  Cask" in line:
             parts = line.split()
@@ -588,6 +3050,11 @@ def brew_upgrade_casks() -> Tuple[bool, List[str], List[str]]:
                 if cask_name in outdated_casks and cask_name not in successfully_upgraded:
                     successfully_upgraded.append(cask_name)
 
+    # Run upgrade (may have non-zero exit code due to cleanup failures, but upgrades may still succeed);
+    # the casks are named so an --apply-cached run only upgrades the cached ones
+    success, _ = run_brew_command(["upgrade", "--cask"] + (["--greedy"] if greedy else []) + outdated_casks,
+                                  check=False, on_line=_track_upgraded, capture=False)
+
     # Determine which casks had post-upgrade warnings (upgraded but with cleanup errors)
     casks_with_warnings = []
     if successfully_upgraded and len(successfully_upgraded) < len(outdated_casks):
@@ -597,52 +3064,518 @@ def brew_upgrade_casks() -> Tuple[bool, List[str], List[str]]:
     # If we upgraded at least one cask, consider it a success
     if successfully_upgraded:
         log(f"Successfully upgraded {len(successfully_upgraded)} cask(s): {', '.join(successfully_upgraded)}")
-        return True, successfully_upgraded, casks_with_warnings
+        return True, successfully_upgraded, casks_with_warnings, []
 
     # If nothing was upgraded, return the original result
-    return success, outdated_casks if success else [], []
+    return success, outdated_casks if success else [], [], []
 
 def brew_cleanup():
     """Clean up old downloads and cache aggressively"""
     log("Cleaning up Homebrew cache and downloads...")
-    run_brew_command(["cleanup", "-s"], check=False)
+    run_brew_command(["cleanup", "-s"], check=False, capture=False)
 
 def brew_doctor():
     """Run brew doctor for diagnostics"""
     log("Running brew doctor...")
-    success, output = run_brew_command(["doctor"], check=False)
+    success, _ = run_brew_command(["doctor"], check=False, capture=False)
     if not success:
         log("brew doctor found some issues (non-fatal)", "WARN")
 
+# ============================================================================
+# RUN STATE
+# ============================================================================
+
+def _git_head(git_dir: Path) -> Optional[str]:
+    """Resolve a repository's HEAD commit without running git"""
+    try:
+        head = (git_dir / "HEAD").read_text().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        ref_file = git_dir / ref
+        if ref_file.exists():
+            return ref_file.read_text().strip()
+        with open(git_dir / "packed-refs") as f:
+            for line in f:
+                if line.rstrip().endswith(" " + ref):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def compute_fingerprint() -> str:
+    """Digest of everything that can change what a run would do.
+
+    Covers the brew and tap repository HEADs, the API cache mtimes, the installed
+    Cellar/Caskroom versions and the application folders (for ghost casks).
+    """
+    parts = []
+    git_dirs = [HOMEBREW_PREFIX / ".git", HOMEBREW_PREFIX / "Homebrew/.git"]
+    git_dirs += sorted((HOMEBREW_PREFIX / "Library/Taps").glob("*/*/.git"))
+    for git_dir in git_dirs:
+        head = _git_head(git_dir)
+        if head:
+            parts.append(f"git {git_dir} {head}")
+
+    if HOMEBREW_API_CACHE.is_dir():
+        for path in sorted(HOMEBREW_API_CACHE.glob("*.json")):
+            parts.append(f"api {path.name} {path.stat().st_mtime_ns}")
+
+    for root in (CELLAR_PATH, CASKROOM_PATH):
+        for entry in sorted(_subdirs(root), key=lambda e: e.name):
+            versions = sorted(v.name for v in _subdirs(entry.path))
+            parts.append(f"{root.name}/{entry.name} {','.join(versions)}")
+
+    for app_dir in APPLICATION_DIRS:
+        try:
+            parts.append(f"apps {app_dir} {app_dir.stat().st_mtime_ns}")
+        except OSError:
+            pass
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def load_run_state() -> dict:
+    """Load the state recorded by the last successful run"""
+    try:
+        with open(RUN_STATE_FILE) as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log(f"Failed to read run state: {e}", "WARN")
+        return {}
+
+
+def save_run_state(state: dict):
+    """Persist run state for the next run's fast path"""
+    try:
+        write_json_atomic(RUN_STATE_FILE, state)
+    except OSError as e:
+        log(f"Failed to save run state: {e}", "WARN")
+
+
+def brew_update_due(state: dict) -> bool:
+    """Whether BREW_UPDATE_TTL_HOURS has passed since the last `brew update`"""
+    if BREW_UPDATE_TTL_HOURS <= 0:
+        return True
+    return time.time() - state.get("last_update", 0) >= BREW_UPDATE_TTL_HOURS * 3600
+
+
+def nothing_changed(state: dict) -> bool:
+    """True when the last run left nothing outdated and the fingerprint still matches"""
+    if not ENABLE_NOOP_FAST_PATH or state.get("outdated_count") != 0:
+        return False
+    if time.time() - state.get("last_full_run", 0) >= NOOP_MAX_AGE_HOURS * 3600:
+        return False
+    return state.get("fingerprint") == compute_fingerprint()
+
+
+# ============================================================================
+# RUN SUMMARY & DIGEST
+# ============================================================================
+
+def _describe_upgrade(name: str, versions: Optional[List[str]]) -> str:
+    return f"{name} ({versions[0]} → {versions[1]})" if versions else name
+
+
+@dataclass
+class RunSummary:
+    """Outcome of one update run, rendered into the summary notification.
+
+    Upgrades map the package name to its ``[installed, current]`` versions (None when
+    the version change is unknown) so digests can merge the same package across runs.
+    """
+    upgraded_formulae: Dict[str, Optional[List[str]]] = field(default_factory=dict)
+    upgraded_casks: Dict[str, Optional[List[str]]] = field(default_factory=dict)
+    failed_formulae: List[str] = field(default_factory=list)
+    failed_casks: List[str] = field(default_factory=list)
+    casks_with_warnings: List[str] = field(default_factory=list)
+    not_cached: List[str] = field(default_factory=list)
+    removed_ghosts: List[str] = field(default_factory=list)
+    swept: Optional[SweepReport] = None
+    cleanup_skipped: bool = False
+    metrics: Optional[RunMetrics] = None
+
+    @property
+    def has_failures(self) -> bool:
+        return bool(self.failed_formulae or self.failed_casks)
+
+    def render(self) -> str:
+        """The run summary notification"""
+        if self.has_failures:
+            summary = "✅ **Homebrew Update Complete!** ⚠️ (some packages failed to upgrade)\n\n"
+        elif self.casks_with_warnings:
+            summary = "✅ **Homebrew Update Complete!** ⚠️ (with minor cleanup warnings)\n\n"
+        else:
+            summary = "✅ **Homebrew Update Complete!**\n\n"
+
+        if self.upgraded_formulae:
+            summary += f"📦 **Formulae Upgraded ({len(self.upgraded_formulae)}):**\n"
+            for formula, versions in self.upgraded_formulae.items():
+                summary += f"  • {_describe_upgrade(formula, versions)}\n"
+            summary += "\n"
+        else:
+            summary += "📦 **Formulae:** None to upgrade\n\n"
+
+        if self.failed_formulae:
+            summary += f"❌ **Formulae Failed ({len(self.failed_formulae)}):**\n"
+            for formula in self.failed_formulae:
+                summary += f"  • {formula}\n"
+            summary += "\n"
+
+        if self.upgraded_casks:
+            summary += f"🍺 **Casks Upgraded ({len(self.upgraded_casks)}):**\n"
+            for cask, versions in self.upgraded_casks.items():
+                summary += f"  • {_describe_upgrade(cask, versions)}\n"
+            summary += "\n"
+        else:
+            summary += "🍺 **Casks:** None to upgrade\n\n"
+
+        if self.failed_casks:
+            summary += f"❌ **Casks Failed ({len(self.failed_casks)}):**\n"
+            for cask in self.failed_casks:
+                summary += f"  • {cask}\n"
+            summary += "\n"
+
+        if self.not_cached:
+            summary += f"⏭️ **Skipped, Not Cached ({len(self.not_cached)}):**\n"
+            for name in self.not_cached:
+                summary += f"  • {name}\n"
+            summary += "\n"
+
+        if self.removed_ghosts:
+            summary += f"👻 **Ghost Casks Removed ({len(self.removed_ghosts)}):**\n"
+            for ghost in self.removed_ghosts:
+                summary += f"  • {ghost}\n"
+            summary += "\n"
+
+        swept = self.swept
+        if swept and swept.found:
+            if swept.repaired:
+                summary += f"🧽 **Stale State Repaired:** {len(swept.repaired)} of {swept.found} item(s)\n\n"
+            else:
+                summary += (f"🧽 **Stale State Found:** {len(swept.partials)} partial upgrade(s), "
+                            f"{len(swept.empty_dirs)} empty dir(s), {len(swept.broken_links)} broken link(s)\n\n")
+
+        summary += f"🧹 **Cleanup:** {'Skipped' if self.cleanup_skipped else 'Complete'}\n\n"
+
+        if self.metrics is not None:
+            summary += self.metrics.render() + "\n\n"
+
+        # Add cleanup warnings section if any casks had issues
+        if self.casks_with_warnings:
+            summary += f"⚠️ **Post-Upgrade Cleanup Warnings ({len(self.casks_with_warnings)}):**\n"
+            summary += "The following casks upgraded successfully but had minor cleanup issues:\n"
+            for cask in self.casks_with_warnings:
+                summary += f"  • {cask}\n"
+            summary += "\n**Manual Cleanup (optional):**\n"
+            summary += "These warnings are usually harmless (empty directories left behind).\n"
+            summary += "To clean up manually, run:\n"
+            summary += f"```\nbrew cleanup {' '.join(self.casks_with_warnings)}\n```\n"
+            summary += "Or see: docs/TROUBLESHOOTING.md"
+
+        return summary
+
+    def render_failures(self) -> str:
+        """The part of the summary that digest mode still sends immediately"""
+        summary = "⚠️ **Homebrew Update:** some packages failed to upgrade\n\n"
+        if self.failed_formulae:
+            summary += f"❌ **Formulae Failed ({len(self.failed_formulae)}):**\n"
+            for formula in self.failed_formulae:
+                summary += f"  • {formula}\n"
+            summary += "\n"
+        if self.failed_casks:
+            summary += f"❌ **Casks Failed ({len(self.failed_casks)}):**\n"
+            for cask in self.failed_casks:
+                summary += f"  • {cask}\n"
+            summary += "\n"
+        summary += "Everything else is included in the next digest."
+        return summary
+
+
+def load_digest() -> dict:
+    """Load the run summaries collected since the last digest"""
+    try:
+        with open(DIGEST_STORE_FILE) as f:
+            digest = json.load(f)
+        return digest if isinstance(digest, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log(f"Failed to read notification digest: {e}", "WARN")
+        return {}
+
+
+def save_digest(digest: dict):
+    """Persist the digest store"""
+    try:
+        write_json_atomic(DIGEST_STORE_FILE, digest)
+    except OSError as e:
+        log(f"Failed to save notification digest: {e}", "WARN")
+
+
+def _merge_upgrades(collected: dict, upgrades: Dict[str, Optional[List[str]]]):
+    """Fold one run's upgrades in, keeping the first old and the latest new version"""
+    for name, versions in upgrades.items():
+        previous = collected.get(name)
+        if previous and versions:
+            collected[name] = [previous[0], versions[1]]
+        elif versions or name not in collected:
+            collected[name] = versions
+
+
+def digest_add(summary: RunSummary, now: Optional[float] = None):
+    """Record one run in the digest store"""
+    now = time.time() if now is None else now
+    digest = load_digest()
+    digest.setdefault("since", now)
+    digest["runs"] = digest.get("runs", 0) + 1
+
+    for key, upgrades in (("formulae", summary.upgraded_formulae), ("casks", summary.upgraded_casks)):
+        collected = digest.setdefault(key, {})
+        _merge_upgrades(collected, upgrades)
+
+    # A package that failed once and upgraded later is no longer a failure
+    upgraded = set(digest["formulae"]) | set(digest["casks"])
+    failed = [name for name in digest.get("failed", []) if name not in upgraded]
+    for name in summary.failed_formulae + summary.failed_casks:
+        if name not in failed:
+            failed.append(name)
+    digest["failed"] = failed
+
+    for key, names in (("ghosts", summary.removed_ghosts), ("warnings", summary.casks_with_warnings)):
+        collected = digest.setdefault(key, [])
+        collected.extend(name for name in names if name not in collected)
+
+    save_digest(digest)
+
+
+def digest_due(digest: dict, now: Optional[float] = None) -> bool:
+    """Whether DIGEST_INTERVAL_HOURS has passed since the digest started collecting"""
+    if not digest.get("runs"):
+        return False
+    now = time.time() if now is None else now
+    return now - digest.get("since", now) >= DIGEST_INTERVAL_HOURS * 3600
+
+
+def render_digest(digest: dict) -> str:
+    """The consolidated digest notification"""
+    since = datetime.fromtimestamp(digest.get("since", time.time())).strftime("%Y-%m-%d %H:%M")
+    runs = digest.get("runs", 0)
+    message = f"📬 **Homebrew Digest** ({runs} run{'s' if runs != 1 else ''} since {since})\n\n"
+
+    formulae = digest.get("formulae", {})
+    casks = digest.get("casks", {})
+    if formulae:
+        message += f"📦 **Formulae Upgraded ({len(formulae)}):**\n"
+        for name in sorted(formulae):
+            message += f"  • {_describe_upgrade(name, formulae[name])}\n"
+        message += "\n"
+    if casks:
+        message += f"🍺 **Casks Upgraded ({len(casks)}):**\n"
+        for name in sorted(casks):
+            message += f"  • {_describe_upgrade(name, casks[name])}\n"
+        message += "\n"
+    if not formulae and not casks:
+        message += "📦 **Upgrades:** Nothing was upgraded\n\n"
+
+    for key, title in (("failed", "❌ **Still Failing"), ("ghosts", "👻 **Ghost Casks Removed"),
+                       ("warnings", "⚠️ **Cleanup Warnings")):
+        names = digest.get(key, [])
+        if names:
+            message += f"{title} ({len(names)}):**\n"
+            for name in names:
+                message += f"  • {name}\n"
+            message += "\n"
+
+    return message.rstrip("\n")
+
+
+def send_digest_if_due(now: Optional[float] = None) -> bool:
+    """Send the consolidated digest and start a new one once the interval has passed"""
+    digest = load_digest()
+    if not digest_due(digest, now):
+        return False
+    log(f"Sending notification digest for {digest['runs']} run(s)")
+    send_notification(render_digest(digest))
+    save_digest({})
+    return True
+
+
+def notify_summary(summary: RunSummary):
+    """Post the run summary, or collect it for the next digest in digest mode"""
+    if NOTIFICATION_MODE != "digest":
+        send_notification(summary.render())
+        return
+    if summary.has_failures:
+        send_notification(summary.render_failures(), error=True)
+    digest_add(summary)
+    send_digest_if_due()
+
+
 # ============================================================================
 # MAIN EXECUTION
 # ============================================================================
 
-def main():
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    """Parse command-line options"""
+    parser = argparse.ArgumentParser(description="Update Homebrew formulae and casks with notifications")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--fetch-only", action="store_true",
+                      help="only download outdated packages into HOMEBREW_CACHE (no upgrades)")
+    mode.add_argument("--apply-cached", action="store_true",
+                      help="upgrade only packages fetched by a previous --fetch-only run, without network access")
+    mode.add_argument("--check", action="store_true",
+                      help="only report outdated packages (no update, upgrades or notifications)")
+    mode.add_argument("--dry-run", action="store_true",
+                      help="report ghost casks, partial upgrades and outdated packages without changing anything")
+    parser.add_argument("--no-heal", action="store_true", help="skip ghost cask healing")
+    parser.add_argument("--no-greedy", action="store_true",
+                        help="leave casks that update themselves to their own updater")
+    parser.add_argument("--no-cleanup", action="store_true", help="skip brew cleanup after upgrading")
+    return parser.parse_args(argv)
+
+def run_check(greedy: bool = True) -> int:
+    """Check mode: list outdated packages and exit"""
+    outdated = get_outdated(greedy)
+    if outdated is None:
+        log("Failed to check for outdated packages", "ERROR")
+        return 1
+    for kind, packages in (("formula", outdated.formulae), ("cask", outdated.casks)):
+        for name, package in packages.items():
+            pinned = " [pinned]" if package.pinned else ""
+            log(f"Outdated {kind}: {name} ({package.version_change}){pinned}")
+    if not outdated.formulae and not outdated.casks:
+        log("Everything is up to date")
+    return 0
+
+def run_dry_run(greedy: bool = True, heal: bool = True) -> int:
+    """Dry-run mode: report what a run would heal and upgrade, changing nothing"""
+    if STALE_STATE_SWEEP != "off":
+        sweep_stale_state()
+    if heal:
+        heal_ghost_casks(dry_run=True)
+    return run_check(greedy)
+
+
+def main(argv: Optional[List[str]] = None):
     """Main execution flow"""
+    args = parse_args(argv if argv is not None else [])
+
     log("=" * 80)
-    log("Homebrew Updater Started")
+    log("Homebrew Updater Started" + (" (fetch only)" if args.fetch_only else
+                                      " (apply from cache)" if args.apply_cached else
+                                      " (check only)" if args.check else
+                                      " (dry run)" if args.dry_run else ""))
     log("=" * 80)
 
     # Clean up old logs first
     cleanup_old_logs()
 
-    # Send start notification
-    send_notification("🚀 Starting Homebrew update...")
+    greedy = not args.no_greedy
+    if args.check or args.dry_run:
+        try:
+            return run_check(greedy) if args.check else run_dry_run(greedy, heal=not args.no_heal)
+        finally:
+            shutdown_logging()
+
+    # Time the run; update runs are also exported to PROMETHEUS_TEXTFILE_DIR
+    start_metrics(export=not args.fetch_only)
+
+    # Fast path: nothing to fetch, upgrade or heal since the last run
+    full_run = not (args.fetch_only or args.apply_cached)
+    run_state = load_run_state() if full_run else {}
+    update_due = full_run and brew_update_due(run_state)
+    if full_run and not update_due and nothing_changed(run_state):
+        log("Nothing changed since the last run and nothing was outdated, skipping")
+        # The dispatcher is not started on this path; deliver earlier runs' leftovers here
+        flush_outbox()
+        if NOTIFICATION_MODE == "digest":
+            send_digest_if_due()
+        RUN_METRICS.record_outcome(RunSummary())
+        stop_metrics()
+        shutdown_logging()
+        return 0
+
+    # Notifications are sent in the background and drained before exit
+    start_notifier()
+
+    # Send start notification (the overnight fetch stage and digest mode run quietly);
+    # with live progress it becomes the Discord message that phases and the summary edit
+    if not args.fetch_only and NOTIFICATION_MODE != "digest":
+        start_live_progress()
+        send_notification("🚀 Starting Homebrew update...")
 
     try:
-        # Update Homebrew
-        if not brew_update():
-            error_msg = "Failed to update Homebrew"
+        if args.fetch_only:
+            return run_fetch_only(greedy)
+
+        # Update Homebrew (an apply run works from the state the fetch run left behind)
+        not_cached = []
+        if args.apply_cached:
+            enable_offline_mode()
+        elif update_due:
+            report_progress("Update", "running")
+            if not brew_update():
+                report_progress("Update", "failed")
+                error_msg = "Failed to update Homebrew"
+                log(error_msg, "ERROR")
+                send_notification(f"❌ {error_msg}", error=True)
+                return 1
+            run_state["last_update"] = time.time()
+            report_progress("Update", "done")
+            if nothing_changed(run_state):
+                log("Nothing changed since the last run and nothing was outdated, skipping")
+                save_run_state(run_state)
+                RUN_METRICS.record_outcome(RunSummary())
+                if NOTIFICATION_MODE == "digest":
+                    notify_summary(RunSummary())
+                else:
+                    send_notification("✅ **Homebrew is up to date** (nothing changed since the last run)")
+                return 0
+        else:
+            log(f"Skipping brew update (BREW_UPDATE_TTL_HOURS={BREW_UPDATE_TTL_HOURS:g})")
+            report_progress("Update", "skipped")
+
+        # Clear state left by interrupted upgrades before it trips up this run's upgrades
+        swept = None
+        if STALE_STATE_SWEEP != "off":
+            swept = sweep_stale_state(repair=STALE_STATE_SWEEP == "repair",
+                                      repair_partials=STALE_STATE_SWEEP == "partials")
+
+        # Heal ghost casks
+        if args.no_heal:
+            removed_ghosts = []
+            report_progress("Heal ghost casks", "skipped")
+        else:
+            report_progress("Heal ghost casks", "running")
+            removed_ghosts = heal_ghost_casks()
+            report_progress("Heal ghost casks", "done")
+
+        # Discover everything outdated once; both upgrade phases and the summary share it
+        report_progress("Check outdated", "running")
+        outdated = get_outdated(greedy)
+        report_progress("Check outdated", "done" if outdated is not None else "failed")
+        if outdated is None:
+            error_msg = "Failed to check for outdated packages"
             log(error_msg, "ERROR")
             send_notification(f"❌ {error_msg}", error=True)
             return 1
 
-        # Heal ghost casks
-        removed_ghosts = heal_ghost_casks()
+        if args.apply_cached:
+            # Only upgrade what the fetch stage already downloaded
+            outdated, not_cached = filter_cached(outdated, load_prefetch_manifest())
+        elif PREFETCH_WORKERS > 0:
+            # Download everything up front, concurrently, so upgrades install from the cache
+            prefetch_downloads(outdated, PREFETCH_WORKERS)
 
         # Upgrade formulae
-        success, upgraded_formulae = brew_upgrade_formulae()
+        report_progress("Upgrade formulae", "running")
+        success, upgraded_formulae, failed_formulae = brew_upgrade_formulae(outdated)
+        report_progress("Upgrade formulae", "done" if success and not failed_formulae else "failed")
         if not success:
             error_msg = "Failed to upgrade formulae"
             log(error_msg, "ERROR")
@@ -650,7 +3583,9 @@ def main():
             return 1
 
         # Upgrade casks
-        success, upgraded_casks, casks_with_warnings = brew_upgrade_casks()
+        report_progress("Upgrade casks", "running")
+        success, upgraded_casks, casks_with_warnings, failed_casks = brew_upgrade_casks(outdated, greedy)
+        report_progress("Upgrade casks", "done" if success and not failed_casks else "failed")
         if not success:
             error_msg = "Failed to upgrade casks"
             log(error_msg, "ERROR")
@@ -658,10 +3593,25 @@ def main():
             return 1
 
         # Cleanup
-        brew_cleanup()
+        if args.no_cleanup:
+            report_progress("Cleanup", "skipped")
+        else:
+            report_progress("Cleanup", "running")
+            brew_cleanup()
+            report_progress("Cleanup", "done")
 
         # Run doctor
+        report_progress("Doctor", "running")
         brew_doctor()
+        report_progress("Doctor", "done")
+
+        # Remember what this run saw so an unchanged system can skip the next one
+        if full_run:
+            still_outdated = (failed_formulae + failed_casks
+                              + [n for n, p in outdated.formulae.items() if p.pinned])
+            run_state.update(fingerprint=compute_fingerprint(), outdated_count=len(still_outdated),
+                             last_full_run=time.time())
+            save_run_state(run_state)
 
         # Success notification
         log("=" * 80)
@@ -669,51 +3619,26 @@ def main():
         log(f"Upgraded: {len(upgraded_formulae)} formulae, {len(upgraded_casks)} casks")
         if casks_with_warnings:
             log(f"Casks with cleanup warnings: {len(casks_with_warnings)}")
+        if failed_formulae:
+            log(f"Formulae that failed to upgrade: {len(failed_formulae)}")
+        if failed_casks:
+            log(f"Casks that failed to upgrade: {len(failed_casks)}")
         log("=" * 80)
 
-        # Build detailed summary
-        if casks_with_warnings:
-            summary = "✅ **Homebrew Update Complete!** ⚠️ (with minor cleanup warnings)\n\n"
-        else:
-            summary = "✅ **Homebrew Update Complete!**\n\n"
-
-        if upgraded_formulae:
-            summary += f"📦 **Formulae Upgraded ({len(upgraded_formulae)}):**\n"
-            for formula in upgraded_formulae:
-                summary += f"  • {formula}\n"
-            summary += "\n"
-        else:
-            summary += "📦 **Formulae:** None to upgrade\n\n"
-
-        if upgraded_casks:
-            summary += f"🍺 **Casks Upgraded ({len(upgraded_casks)}):**\n"
-            for cask in upgraded_casks:
-                summary += f"  • {cask}\n"
-            summary += "\n"
-        else:
-            summary += "🍺 **Casks:** None to upgrade\n\n"
-
-        if removed_ghosts:
-            summary += f"👻 **Ghost Casks Removed ({len(removed_ghosts)}):**\n"
-            for ghost in removed_ghosts:
-                summary += f"  • {ghost}\n"
-            summary += "\n"
-
-        summary += f"🧹 **Cleanup:** Complete\n\n"
-
-        # Add cleanup warnings section if any casks had issues
-        if casks_with_warnings:
-            summary += f"⚠️ **Post-Upgrade Cleanup Warnings ({len(casks_with_warnings)}):**\n"
-            summary += "The following casks upgraded successfully but had minor cleanup issues:\n"
-            for cask in casks_with_warnings:
-                summary += f"  • {cask}\n"
-            summary += "\n**Manual Cleanup (optional):**\n"
-            summary += "These warnings are usually harmless (empty directories left behind).\n"
-            summary += "To clean up manually, run:\n"
-            summary += f"```\nbrew cleanup {' '.join(casks_with_warnings)}\n```\n"
-            summary += "Or see: docs/TROUBLESHOOTING.md"
-
-        send_notification(summary)
+        summary = RunSummary(
+            upgraded_formulae={name: outdated.versions(name) for name in upgraded_formulae},
+            upgraded_casks={name: outdated.versions(name) for name in upgraded_casks},
+            failed_formulae=failed_formulae,
+            failed_casks=failed_casks,
+            casks_with_warnings=casks_with_warnings,
+            not_cached=not_cached,
+            removed_ghosts=removed_ghosts,
+            swept=swept,
+            cleanup_skipped=args.no_cleanup,
+            metrics=RUN_METRICS,
+        )
+        RUN_METRICS.record_outcome(summary)
+        notify_summary(summary)
 
         # Check if we should send monthly cleanup reminder
         if should_send_monthly_reminder():
@@ -727,5 +3652,13 @@ def main():
         send_notification(f"❌ {error_msg}", error=True)
         return 1
 
+    finally:
+        stop_notifier()
+        stop_live_progress()
+        stop_metrics()
+        WEBHOOK_CLIENT.close()
+        shutdown_logging()
+
 if __name__ == "__main__":
-    sys.exit(main())
+    install_signal_forwarding()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-line logging cost of the persistent LogWriter versus the
+previous open-per-line log() implementation.
+Run with: python3 tests/bench_log_writer.py [lines]
+"""
+
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Add parent directory to path to import the module
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+
+import homebrew_updater
+
+
+def legacy_log(path: Path, message: str, level: str = "INFO"):
+    """The original log(): format a fresh timestamp and reopen the file per line"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_line = f"[{timestamp}] [{level}] {message}"
+    with open(path, "a") as f:
+        f.write(log_line + "\n")
+
+
+def bench(label: str, write, lines: int) -> float:
+    start = time.perf_counter()
+    for i in range(lines):
+        write(f"  ==> Downloading https://example.com/artifact-{i}.dmg")
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {lines:>7} lines  {elapsed:7.3f}s  {elapsed / lines * 1e6:7.2f} µs/line")
+    return elapsed
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+
+        legacy_path = tmp_dir / "legacy.log"
+        legacy = bench("open-per-line (legacy)", lambda m: legacy_log(legacy_path, m), lines)
+
+        writer = homebrew_updater.LogWriter(tmp_dir / "buffered.log", mirror_stdout=False)
+        buffered = bench("LogWriter (buffered)", writer.write, lines)
+        writer.close()
+
+        writer = homebrew_updater.LogWriter(tmp_dir / "background.log", mirror_stdout=False,
+                                            background=True)
+        background = bench("LogWriter (background)", writer.write, lines)
+        writer.close()
+
+    print()
+    print(f"Speedup buffered:   {legacy / buffered:5.1f}x")
+    print(f"Speedup background: {legacy / background:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
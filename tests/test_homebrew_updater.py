@@ -6,8 +6,14 @@ Or: python3 tests/test_homebrew_updater.py
 """
 
 import json
+import os
+import signal
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
+from datetime import datetime
 from pathlib import Path
 from unittest.mock import Mock, patch, mock_open, MagicMock
 from io import StringIO
@@ -18,43 +24,83 @@ sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
 import homebrew_updater
 
 
+def fake_process(stdout: str = "", stderr: str = "", returncode: int = 0) -> MagicMock:
+    """Build a stand-in for subprocess.Popen whose pipes yield the given output"""
+    process = MagicMock()
+    # No such process: run_brew_command falls back to wait() and kill() on the mock
+    process.pid = 2 ** 31 - 1
+    process.stdout = StringIO(stdout)
+    process.stderr = StringIO(stderr)
+    process.wait.return_value = returncode
+    process.returncode = returncode
+    return process
+
+
+def process_alive(pid: int) -> bool:
+    """Whether a pid is still running (zombies awaiting their reaper count as gone)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    try:
+        return Path(f"/proc/{pid}/stat").read_text().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+def scripted_brew(*responses):
+    """Side effect for a mocked run_brew_command that replays (success, output)
+    responses in order, feeding each output through on_line when one is given"""
+    queue = list(responses)
+
+    def _run(args, check=True, on_line=None, **kwargs):
+        success, output = queue.pop(0)
+        if on_line:
+            for line in output.splitlines():
+                on_line(line)
+        return success, output
+    return _run
+
+
+def outdated_json(formulae=(), casks=()) -> str:
+    """Output of `brew outdated --json=v2` for the given package names"""
+    def _entries(names):
+        return [{"name": name, "installed_versions": ["1.0"], "current_version": "2.0"}
+                for name in names]
+    return json.dumps({"formulae": _entries(formulae), "casks": _entries(casks)})
+
+
 class TestWebhookNotifications(unittest.TestCase):
     """Test webhook notification functionality (Discord & Slack)"""
 
-    @patch('homebrew_updater.urllib.request.urlopen')
-    def test_send_discord_helper_success(self, mock_urlopen):
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post')
+    def test_send_discord_helper_success(self, mock_post):
         """Test successful Discord notification via _send_discord"""
         # Save original and set test webhook
         original_webhook = homebrew_updater.DISCORD_WEBHOOK_URL
         homebrew_updater.DISCORD_WEBHOOK_URL = "https://discord.com/api/webhooks/test/test"
 
-        mock_response = MagicMock()
-        mock_response.status = 204
-        mock_response.__enter__.return_value = mock_response
-        mock_urlopen.return_value = mock_response
+        mock_post.return_value = homebrew_updater.WebhookResponse(204)
 
         result = homebrew_updater._send_discord("Test message")
         self.assertTrue(result)
-        self.assertTrue(mock_urlopen.called)
+        self.assertTrue(mock_post.called)
 
         # Restore original
         homebrew_updater.DISCORD_WEBHOOK_URL = original_webhook
 
-    @patch('homebrew_updater.urllib.request.urlopen')
-    def test_send_slack_helper_success(self, mock_urlopen):
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post')
+    def test_send_slack_helper_success(self, mock_post):
         """Test successful Slack notification via _send_slack"""
         # Save original and set test webhook
         original_webhook = homebrew_updater.SLACK_WEBHOOK_URL
         homebrew_updater.SLACK_WEBHOOK_URL = "https://hooks.slack.com/services/test/test/test"
 
-        mock_response = MagicMock()
-        mock_response.status = 200  # Slack returns 200, not 204
-        mock_response.__enter__.return_value = mock_response
-        mock_urlopen.return_value = mock_response
+        mock_post.return_value = homebrew_updater.WebhookResponse(200)  # Slack returns 200, not 204
 
         result = homebrew_updater._send_slack("Test message")
         self.assertTrue(result)
-        self.assertTrue(mock_urlopen.called)
+        self.assertTrue(mock_post.called)
 
         # Restore original
         homebrew_updater.SLACK_WEBHOOK_URL = original_webhook
@@ -132,36 +178,29 @@ class TestWebhookNotifications(unittest.TestCase):
         # Restore original
         homebrew_updater.NOTIFICATION_PLATFORM = original_platform
 
-    @patch('homebrew_updater.urllib.request.urlopen')
-    def test_send_discord_notification_success(self, mock_urlopen):
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post')
+    def test_send_discord_notification_success(self, mock_post):
         """Test successful Discord notification (backwards compatibility)"""
-        mock_response = MagicMock()
-        mock_response.status = 204
-        mock_response.__enter__.return_value = mock_response
-        mock_urlopen.return_value = mock_response
+        mock_post.return_value = homebrew_updater.WebhookResponse(204)
 
         # Should not raise exception
         homebrew_updater.send_discord_notification("Test message")
 
-        # Verify urlopen was called
-        self.assertTrue(mock_urlopen.called)
+        # Verify the webhook was posted
+        self.assertTrue(mock_post.called)
 
-    @patch('homebrew_updater.urllib.request.urlopen')
-    def test_send_discord_notification_error(self, mock_urlopen):
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post')
+    def test_send_discord_notification_error(self, mock_post):
         """Test Discord notification with error response"""
-        mock_response = MagicMock()
-        mock_response.status = 400
-        mock_response.__enter__.return_value = mock_response
-        mock_urlopen.return_value = mock_response
+        mock_post.return_value = homebrew_updater.WebhookResponse(400)
 
         # Should not raise exception (errors are logged)
         homebrew_updater.send_discord_notification("Test message")
 
-    @patch('homebrew_updater.urllib.request.urlopen')
-    def test_send_discord_notification_timeout(self, mock_urlopen):
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post')
+    def test_send_discord_notification_timeout(self, mock_post):
         """Test Discord notification with timeout"""
-        import urllib.error
-        mock_urlopen.side_effect = urllib.error.URLError("Timeout")
+        mock_post.side_effect = TimeoutError("timed out")
 
         # Should not raise exception (errors are logged)
         homebrew_updater.send_discord_notification("Test message")
@@ -180,45 +219,531 @@ class TestWebhookNotifications(unittest.TestCase):
         homebrew_updater.DISCORD_WEBHOOK_URL = original_webhook
 
 
+class TestMessagePagination(unittest.TestCase):
+    """Test fitting long notifications into the platforms' size limits"""
+
+    def setUp(self):
+        self.summary = homebrew_updater.RunSummary(
+            upgraded_formulae={f"formula-{i:03d}": ["1.0.0", "1.0.1"] for i in range(250)},
+            upgraded_casks={f"cask-{i:03d}": ["1", "2"] for i in range(120)},
+            removed_ghosts=["ghost"]).render()
+
+    def test_short_message_is_untouched(self):
+        """Messages within the limit are sent as they are"""
+        self.assertEqual(homebrew_updater.paginate_message("✅ Done\n\n  • git", 4096), ["✅ Done\n\n  • git"])
+
+    def test_long_lists_continue_on_later_pages(self):
+        """Lists that do not fit are continued under a repeated heading"""
+        pages = homebrew_updater.paginate_message(self.summary, 4096, max_parts=5)
+
+        self.assertGreater(len(pages), 1)
+        self.assertTrue(all(len(page) <= 4096 for page in pages))
+        self.assertIn("📦 **Formulae Upgraded (250):** (continued)", pages[1])
+        text = "\n".join(pages)
+        self.assertEqual(text.count("  • formula-"), 250)
+        self.assertIn("👻 **Ghost Casks Removed (1):**", pages[-1])
+
+    def test_overflow_collapses_to_counts(self):
+        """Past the part limit, lists are cut down with an "and N more" line"""
+        pages = homebrew_updater.paginate_message(self.summary, 3000, max_parts=1)
+
+        self.assertEqual(len(pages), 1)
+        self.assertLessEqual(len(pages[0]), 3000)
+        self.assertIn("📦 **Formulae Upgraded (250):**", pages[0])
+        self.assertRegex(pages[0], r"• … and \d+ more")
+        self.assertIn("• ghost", pages[0])
+
+    @patch('homebrew_updater.WEBHOOK_CLIENT.post', return_value=homebrew_updater.WebhookResponse(204))
+    def test_discord_sends_continuation_messages(self, mock_post):
+        """Each Discord part stays within the embed limit and only the first mentions"""
+        with patch('homebrew_updater.DISCORD_WEBHOOK_URL', "https://discord.com/api/webhooks/test/test"), \
+                patch('homebrew_updater.NOTIFICATION_MAX_PARTS', 3):
+            self.assertTrue(homebrew_updater._send_discord(self.summary))
+
+        payloads = [c.args[1] for c in mock_post.call_args_list]
+        self.assertGreater(len(payloads), 1)
+        self.assertIn("content", payloads[0])
+        self.assertNotIn("content", payloads[1])
+        self.assertEqual(payloads[1]["embeds"][0]["title"], f"Homebrew Updater (2/{len(payloads)})")
+        self.assertTrue(all(len(p["embeds"][0]["description"]) <= 4096 for p in payloads))
+
+    def test_slack_sections_fit_limit(self):
+        """Every Slack section block stays within 3000 characters"""
+        payloads = homebrew_updater._slack_payloads(self.summary)
+
+        sections = [b for p in payloads for b in p["blocks"] if b["type"] == "section"]
+        self.assertTrue(all(len(b["text"]["text"]) <= 3000 for b in sections))
+        self.assertTrue(payloads[0]["blocks"][0]["text"]["text"].startswith("✅ **Homebrew Update Complete!**"))
+
+
+class WebhookStandIn:
+    """Local HTTP server standing in for a webhook endpoint.
+
+    Replies with the queued (status, headers, body) responses, then 204s, and
+    records the client port of every request so connection reuse is visible.
+    """
+
+    def __init__(self):
+        import http.server
+        import threading
+        stand_in = self
+        self.requests = []
+        self.responses = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stand_in.requests.append((self.client_address[1], self.path, json.loads(body)))
+                status, headers, payload = stand_in.responses.pop(0) if stand_in.responses else (204, {}, b"")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_PATCH = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestWebhookClient(unittest.TestCase):
+    """Test the pooled, rate-limit-aware webhook client against a local stand-in"""
+
+    def setUp(self):
+        self.stand_in = WebhookStandIn()
+        self.client = homebrew_updater.WebhookClient(timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.stand_in.close()
+
+    def test_connection_is_reused(self):
+        """Several posts share one keep-alive connection"""
+        for i in range(3):
+            response = self.client.post(f"{self.stand_in.url}/api/webhooks/1/token", {"content": i})
+            self.assertEqual(response.status, 204)
+
+        ports = {port for port, _, _ in self.stand_in.requests}
+        self.assertEqual(len(self.stand_in.requests), 3)
+        self.assertEqual(len(ports), 1)
+
+    def test_429_retry_after_is_honoured(self):
+        """A 429 with a short Retry-After is retried once after waiting"""
+        self.stand_in.responses = [(429, {"Retry-After": "0.2"}, b'{"retry_after": 0.2}')]
+
+        start = time.monotonic()
+        response = self.client.post(f"{self.stand_in.url}/hook", {"content": "x"})
+
+        self.assertEqual(response.status, 204)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(len(self.stand_in.requests), 2)
+
+    @patch('homebrew_updater.WEBHOOK_MAX_RATE_LIMIT_WAIT', 1)
+    def test_long_rate_limit_is_not_waited_out(self):
+        """A long Retry-After returns the 429 so the outbox can retry later"""
+        self.stand_in.responses = [(429, {"Retry-After": "60"}, b"")]
+
+        response = self.client.post(f"{self.stand_in.url}/hook", {"content": "x"})
+        self.assertEqual(response.status, 429)
+
+        # The bucket now holds further sends without touching the server
+        response = self.client.post(f"{self.stand_in.url}/hook", {"content": "y"})
+        self.assertEqual(response.status, 429)
+        self.assertEqual(len(self.stand_in.requests), 1)
+
+    def test_rate_limit_headers_pace_requests(self):
+        """An exhausted X-RateLimit bucket delays the next request until it resets"""
+        self.stand_in.responses = [(204, {"X-RateLimit-Limit": "5", "X-RateLimit-Remaining": "0",
+                                          "X-RateLimit-Reset-After": "0.3"}, b"")]
+
+        self.client.post(f"{self.stand_in.url}/hook", {"content": "x"})
+        start = time.monotonic()
+        self.client.post(f"{self.stand_in.url}/hook", {"content": "y"})
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        self.assertEqual(len(self.stand_in.requests), 2)
+
+
+class TestDiscordLiveProgress(unittest.TestCase):
+    """Test the single live-edited Discord message against a local stand-in"""
+
+    def setUp(self):
+        self.stand_in = WebhookStandIn()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.webhook = f"{self.stand_in.url}/api/webhooks/1/token"
+        self.patches = [patch('homebrew_updater.DISCORD_LIVE_PROGRESS', True),
+                        patch('homebrew_updater.DISCORD_EDIT_INTERVAL', 0.3),
+                        patch('homebrew_updater.DISCORD_WEBHOOK_URL', self.webhook),
+                        patch('homebrew_updater.NOTIFICATION_PLATFORM', 'discord'),
+                        patch('homebrew_updater.NOTIFICATION_OUTBOX_FILE', Path(self.tmp.name) / "outbox.json"),
+                        patch('homebrew_updater.WEBHOOK_CLIENT', homebrew_updater.WebhookClient(timeout=5)),
+                        patch('homebrew_updater.send_macos_notification')]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        homebrew_updater.stop_live_progress()
+        homebrew_updater.WEBHOOK_CLIENT.close()
+        for p in self.patches:
+            p.stop()
+        self.stand_in.close()
+        self.tmp.cleanup()
+
+    def test_one_message_with_coalesced_edits(self):
+        """A run costs one create, a few throttled edits and a final edit"""
+        self.stand_in.responses = [(200, {"Content-Type": "application/json"}, b'{"id": "42"}')]
+        homebrew_updater.start_live_progress()
+
+        homebrew_updater.send_notification("🚀 Starting Homebrew update...")
+        for phase in ("Update", "Heal ghost casks", "Upgrade formulae", "Upgrade casks"):
+            homebrew_updater.report_progress(phase, "running")
+            homebrew_updater.report_progress(phase, "done")
+        time.sleep(0.5)
+        homebrew_updater.send_notification("✅ **Homebrew Update Complete!**")
+        # After the summary the run's message is final; later notifications are new messages
+        homebrew_updater.send_notification("🧹 Monthly cleanup reminder")
+
+        paths = [path for _, path, _ in self.stand_in.requests]
+        self.assertEqual(paths[0], "/api/webhooks/1/token?wait=true")
+        edits = [body for _, path, body in self.stand_in.requests if path == "/api/webhooks/1/token/messages/42"]
+        self.assertEqual(len(edits), 2)  # one coalesced progress edit + the summary
+        self.assertIn("✅ Upgrade casks", edits[0]["embeds"][0]["description"])
+        self.assertEqual(edits[1]["embeds"][0]["description"], "✅ **Homebrew Update Complete!**")
+        self.assertEqual(paths[-1], "/api/webhooks/1/token")
+        self.assertEqual(len(paths), 4)
+
+    def test_disabled_by_default(self):
+        """Without DISCORD_LIVE_PROGRESS every notification is its own message"""
+        with patch('homebrew_updater.DISCORD_LIVE_PROGRESS', False):
+            homebrew_updater.start_live_progress()
+        self.assertIsNone(homebrew_updater.LIVE_MESSAGE)
+        homebrew_updater.send_notification("🚀 Starting Homebrew update...")
+        homebrew_updater.report_progress("Update", "running")
+        homebrew_updater.send_notification("✅ **Homebrew Update Complete!**")
+
+        self.assertEqual([path for _, path, _ in self.stand_in.requests], ["/api/webhooks/1/token"] * 2)
+
+class TestNotificationDispatcher(unittest.TestCase):
+    """Test concurrent, background notification delivery"""
+
+    def setUp(self):
+        self.delivered = []
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [patch('homebrew_updater.NOTIFICATION_OUTBOX_FILE', Path(self.tmp.name) / "outbox.json"),
+                        patch('homebrew_updater.NOTIFICATION_PLATFORM', 'both'),
+                        patch('homebrew_updater._send_discord', side_effect=self._slow_sink("discord")),
+                        patch('homebrew_updater._send_slack', side_effect=self._slow_sink("slack")),
+                        patch('homebrew_updater.send_macos_notification')]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        homebrew_updater.stop_notifier(timeout=5)
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def _slow_sink(self, name):
+        def send(message, error=False):
+            time.sleep(0.2)
+            self.delivered.append((name, message))
+            return True
+        return send
+
+    def test_inline_send_fans_out_concurrently(self):
+        """Without a dispatcher, sinks still run in parallel"""
+        start = time.monotonic()
+        homebrew_updater.send_notification("Test message")
+
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(sorted(name for name, _ in self.delivered), ["discord", "slack"])
+
+    def test_dispatcher_does_not_block_and_drains_in_order(self):
+        """With a dispatcher, send_notification returns at once and stop_notifier drains"""
+        homebrew_updater.start_notifier()
+        start = time.monotonic()
+        homebrew_updater.send_notification("first")
+        homebrew_updater.send_notification("second")
+        self.assertLess(time.monotonic() - start, 0.1)
+
+        homebrew_updater.stop_notifier(timeout=5)
+
+        self.assertIsNone(homebrew_updater.NOTIFIER)
+        discord = [message for name, message in self.delivered if name == "discord"]
+        self.assertEqual(discord, ["first", "second"])
+
+    def test_drain_deadline(self):
+        """A drain gives up at its deadline instead of hanging the run"""
+        dispatcher = homebrew_updater.NotificationDispatcher()
+        dispatcher.submit("slow")
+
+        self.assertFalse(dispatcher.drain(0.05))
+        self.assertTrue(dispatcher.close(5))
+
+
+class TestNotificationOutbox(unittest.TestCase):
+    """Test the on-disk outbox of failed webhook sends"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outbox = Path(self.tmp.name) / "outbox.json"
+        self.patches = [patch('homebrew_updater.NOTIFICATION_OUTBOX_FILE', self.outbox),
+                        patch('homebrew_updater.NOTIFICATION_PLATFORM', 'both'),
+                        patch('homebrew_updater.DISCORD_WEBHOOK_URL', "https://discord.com/api/webhooks/test/test"),
+                        patch('homebrew_updater.SLACK_WEBHOOK_URL', ""),
+                        patch('homebrew_updater.send_macos_notification')]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        homebrew_updater.stop_notifier(timeout=5)
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def _entries(self):
+        return json.loads(self.outbox.read_text()) if self.outbox.exists() else []
+
+    @patch('homebrew_updater._send_slack', return_value=False)
+    @patch('homebrew_updater._send_discord', return_value=False)
+    def test_failed_configured_webhook_is_queued(self, mock_discord, mock_slack):
+        """Only the configured webhook that failed is kept for retry"""
+        homebrew_updater.send_notification("✅ Homebrew Update Complete!")
+
+        entries = self._entries()
+        self.assertEqual([(e["sink"], e["message"], e["attempts"]) for e in entries],
+                         [("discord", "✅ Homebrew Update Complete!", 1)])
+        self.assertGreater(entries[0]["next_attempt"], time.time())
+
+    @patch('homebrew_updater._send_discord')
+    def test_flush_retries_with_backoff_then_delivers(self, mock_discord):
+        """A failed retry backs off further; a successful one empties the outbox"""
+        homebrew_updater.outbox_add("discord", "report")
+        first_due = self._entries()[0]["next_attempt"]
+        self.assertEqual(homebrew_updater.flush_outbox(), 0)  # not due yet
+        mock_discord.assert_not_called()
+
+        mock_discord.return_value = False
+        homebrew_updater.flush_outbox(now=first_due)
+        entry = self._entries()[0]
+        self.assertEqual(entry["attempts"], 2)
+        self.assertGreaterEqual(entry["next_attempt"] - first_due,
+                                homebrew_updater.NOTIFICATION_RETRY_BASE * 2 * 0.5)
+
+        mock_discord.return_value = True
+        self.assertEqual(homebrew_updater.flush_outbox(now=entry["next_attempt"]), 1)
+        self.assertEqual(self._entries(), [])
+        mock_discord.assert_called_with("report", False)
+
+    @patch('homebrew_updater.NOTIFICATION_MAX_ATTEMPTS', 2)
+    @patch('homebrew_updater._send_discord', return_value=False)
+    def test_gives_up_after_max_attempts(self, mock_discord):
+        """Entries are dropped once NOTIFICATION_MAX_ATTEMPTS is used up"""
+        homebrew_updater.outbox_add("discord", "report")
+        homebrew_updater.flush_outbox(now=time.time() + 10 ** 6)
+        self.assertEqual(len(self._entries()), 1)
+        homebrew_updater.flush_outbox(now=time.time() + 10 ** 7)
+        self.assertEqual(self._entries(), [])
+
+    @patch('homebrew_updater._send_discord', return_value=True)
+    def test_dispatcher_flushes_leftovers_first(self, mock_discord):
+        """Leftovers from an earlier run go out before this run's notifications"""
+        homebrew_updater.outbox_add("discord", "yesterday's report")
+        entries = self._entries()
+        entries[0]["next_attempt"] = 0
+        self.outbox.write_text(json.dumps(entries))
+
+        homebrew_updater.start_notifier()
+        homebrew_updater.send_notification("🚀 Starting Homebrew update...")
+        homebrew_updater.stop_notifier(timeout=5)
+
+        self.assertEqual([c.args[0] for c in mock_discord.call_args_list],
+                         ["yesterday's report", "🚀 Starting Homebrew update..."])
+        self.assertEqual(self._entries(), [])
+
+class TestNotificationDigest(unittest.TestCase):
+    """Test digest mode: run summaries collected and sent on a schedule"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = Path(self.tmp.name) / "digest.json"
+        self.patches = [patch('homebrew_updater.DIGEST_STORE_FILE', self.store),
+                        patch('homebrew_updater.NOTIFICATION_MODE', 'digest'),
+                        patch('homebrew_updater.DIGEST_INTERVAL_HOURS', 24)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def test_upgrades_are_deduplicated_across_runs(self):
+        """A package upgraded twice shows once, from its first to its latest version"""
+        RunSummary = homebrew_updater.RunSummary
+        homebrew_updater.digest_add(RunSummary(upgraded_formulae={"git": ["2.42.0", "2.43.0"]},
+                                               failed_casks=["zoom"]), now=1000)
+        homebrew_updater.digest_add(RunSummary(upgraded_formulae={"git": ["2.43.0", "2.44.0"]},
+                                               upgraded_casks={"zoom": ["5.0", "5.1"]}), now=2000)
+
+        digest = homebrew_updater.load_digest()
+        self.assertEqual(digest["runs"], 2)
+        self.assertEqual(digest["since"], 1000)
+        self.assertEqual(digest["formulae"], {"git": ["2.42.0", "2.44.0"]})
+        self.assertEqual(digest["failed"], [])  # zoom upgraded on the second run
+        self.assertIn("git (2.42.0 → 2.44.0)", homebrew_updater.render_digest(digest))
+
+    @patch('homebrew_updater.send_notification')
+    def test_digest_sent_once_interval_passes(self, mock_notification):
+        """Summaries are held until DIGEST_INTERVAL_HOURS, then sent and cleared"""
+        start = time.time()
+        homebrew_updater.digest_add(homebrew_updater.RunSummary(upgraded_casks={"firefox": None}), now=start)
+
+        self.assertFalse(homebrew_updater.send_digest_if_due(now=start + 3600))
+        mock_notification.assert_not_called()
+
+        self.assertTrue(homebrew_updater.send_digest_if_due(now=start + 24 * 3600))
+        message = mock_notification.call_args.args[0]
+        self.assertTrue(message.startswith("📬 **Homebrew Digest** (1 run since"))
+        self.assertIn("  • firefox", message)
+        self.assertEqual(homebrew_updater.load_digest(), {})
+
+    @patch('homebrew_updater.send_notification')
+    def test_failures_are_sent_immediately(self, mock_notification):
+        """Only failures bypass the digest"""
+        homebrew_updater.notify_summary(homebrew_updater.RunSummary(upgraded_formulae={"git": None}))
+        mock_notification.assert_not_called()
+
+        homebrew_updater.notify_summary(homebrew_updater.RunSummary(failed_formulae=["node"]))
+        message = mock_notification.call_args.args[0]
+        self.assertIn("❌ **Formulae Failed (1):**\n  • node", message)
+        self.assertNotIn("git", message)
+        self.assertTrue(mock_notification.call_args.kwargs["error"])
+        self.assertEqual(homebrew_updater.load_digest()["runs"], 2)
+
+@patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
 class TestBrewCommands(unittest.TestCase):
     """Test Homebrew command execution"""
 
-    @patch('homebrew_updater.subprocess.run')
-    def test_run_brew_command_success(self, mock_run):
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_run_brew_command_success(self, mock_popen):
         """Test successful brew command"""
-        mock_run.return_value = Mock(
-            returncode=0,
-            stdout="Success",
-            stderr=""
-        )
+        mock_popen.return_value = fake_process(stdout="Success")
 
         success, output = homebrew_updater.run_brew_command(["update"])
         self.assertTrue(success)
         self.assertEqual(output, "Success")
 
-    @patch('homebrew_updater.subprocess.run')
-    def test_run_brew_command_failure(self, mock_run):
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_run_brew_command_failure(self, mock_popen):
         """Test failed brew command"""
-        mock_run.return_value = Mock(
-            returncode=1,
-            stdout="",
-            stderr="Error occurred"
-        )
+        mock_popen.return_value = fake_process(stderr="Error occurred", returncode=1)
 
         success, output = homebrew_updater.run_brew_command(["update"])
         self.assertFalse(success)
         self.assertIn("Error occurred", output)
 
-    @patch('homebrew_updater.subprocess.run')
-    def test_run_brew_command_timeout(self, mock_run):
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_run_brew_command_timeout(self, mock_popen):
         """Test brew command timeout"""
         import subprocess
-        mock_run.side_effect = subprocess.TimeoutExpired("brew", 10)
+        mock_popen.side_effect = subprocess.TimeoutExpired("brew", 10)
 
         success, output = homebrew_updater.run_brew_command(["update"])
         self.assertFalse(success)
         self.assertIn("timed out", output.lower())
 
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_run_brew_command_streams_lines(self, mock_popen):
+        """Test that stdout lines are handed to on_line as they arrive"""
+        mock_popen.return_value = fake_process(stdout="line1\nline2\nline3\n")
+        seen = []
+
+        success, _ = homebrew_updater.run_brew_command(["upgrade"], on_line=seen.append)
+        self.assertTrue(success)
+        self.assertEqual(seen, ["line1", "line2", "line3"])
+
+    @patch('homebrew_updater.BREW_OUTPUT_TAIL_LINES', 2)
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_run_brew_command_without_capture_keeps_tail(self, mock_popen):
+        """Test that capture=False only retains the trailing output lines"""
+        mock_popen.return_value = fake_process(stdout="a\nb\nc\nd\n")
+
+        success, output = homebrew_updater.run_brew_command(["upgrade"], capture=False)
+        self.assertTrue(success)
+        self.assertEqual(output, "c\nd\n")
+
+    def test_run_brew_command_real_process_timeout(self):
+        """Test that the watchdog kills a process that exceeds its timeout"""
+        with patch('homebrew_updater.BREW_PATH', 'sleep'):
+            success, output = homebrew_updater.run_brew_command(["5"], timeout=0.2)
+        self.assertFalse(success)
+        self.assertIn("timed out", output.lower())
+
+    def test_run_brew_command_timeout_kills_grandchildren(self):
+        """Test that the timeout also ends children of brew that hold its pipes open"""
+        with tempfile.TemporaryDirectory() as tmp:
+            stub = Path(tmp) / "brew"
+            stub.write_text("#!/bin/sh\necho started\nsleep 5\necho finished\n")
+            stub.chmod(0o755)
+            start = time.monotonic()
+            with patch('homebrew_updater.BREW_PATH', str(stub)):
+                success, output = homebrew_updater.run_brew_command(["upgrade"], timeout=0.5)
+        self.assertFalse(success)
+        self.assertIn("timed out", output.lower())
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_run_brew_command_interrupt_kills_process_tree(self):
+        """Test that an interrupt mid-command ends brew's process group instead of orphaning it"""
+        pids = []
+
+        def on_line(line):
+            pids.append(int(line))
+            if len(pids) == 2:
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stub = Path(tmp) / "brew"
+            stub.write_text("#!/bin/sh\necho $$\nsleep 30 &\necho $!\nwait\n")
+            stub.chmod(0o755)
+            with patch('homebrew_updater.BREW_PATH', str(stub)):
+                with self.assertRaises(KeyboardInterrupt):
+                    homebrew_updater.run_brew_command(["upgrade"], on_line=on_line)
+
+        self.assertFalse(process_alive(pids[0]))
+        deadline = time.monotonic() + 3
+        while process_alive(pids[1]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(process_alive(pids[1]))
+        self.assertEqual(homebrew_updater._BREW_GROUPS, set())
+
+    def test_sigterm_is_forwarded_to_running_brew(self):
+        """Test that SIGTERM reaches brew's own session and then stops the updater"""
+        process = subprocess.Popen(["sleep", "30"], start_new_session=True)
+        homebrew_updater._BREW_GROUPS.add(process.pid)
+        try:
+            with self.assertRaises(SystemExit) as raised:
+                homebrew_updater._forward_signal(signal.SIGTERM, None)
+            self.assertEqual(process.wait(timeout=3), -signal.SIGTERM)
+            self.assertEqual(raised.exception.code, 128 + signal.SIGTERM)
+        finally:
+            homebrew_updater._BREW_GROUPS.discard(process.pid)
+            process.kill()
+            process.wait()
+
     @patch('homebrew_updater.run_brew_command')
     def test_brew_update_success(self, mock_run_brew):
         """Test brew update success"""
@@ -231,12 +756,12 @@ class TestBrewCommands(unittest.TestCase):
     def test_brew_upgrade_formulae_success(self, mock_run_brew):
         """Test brew upgrade formulae"""
         # Mock outdated check
-        mock_run_brew.side_effect = [
-            (True, "package1\npackage2\npackage3"),  # outdated
+        mock_run_brew.side_effect = scripted_brew(
+            (True, outdated_json(formulae=["package1", "package2", "package3"])),  # outdated
             (True, "Upgraded")  # upgrade
-        ]
+        )
 
-        success, packages = homebrew_updater.brew_upgrade_formulae()
+        success, packages, failed = homebrew_updater.brew_upgrade_formulae()
         self.assertTrue(success)
         self.assertEqual(len(packages), 3)
         self.assertIn("package1", packages)
@@ -244,21 +769,21 @@ class TestBrewCommands(unittest.TestCase):
     @patch('homebrew_updater.run_brew_command')
     def test_brew_upgrade_formulae_none_outdated(self, mock_run_brew):
         """Test brew upgrade when no formulae are outdated"""
-        mock_run_brew.return_value = (True, "")
+        mock_run_brew.side_effect = scripted_brew((True, outdated_json()))
 
-        success, packages = homebrew_updater.brew_upgrade_formulae()
+        success, packages, failed = homebrew_updater.brew_upgrade_formulae()
         self.assertTrue(success)
         self.assertEqual(packages, [])
 
     @patch('homebrew_updater.run_brew_command')
     def test_brew_upgrade_casks_success(self, mock_run_brew):
         """Test brew upgrade casks with successful upgrades"""
-        mock_run_brew.side_effect = [
-            (True, "cask1\ncask2"),  # outdated
+        mock_run_brew.side_effect = scripted_brew(
+            (True, outdated_json(casks=["cask1", "cask2"])),  # outdated
             (True, "✔︎ Cask cask1 (1.0.0)\n✔︎ Cask cask2 (2.0.0)")  # upgrade with success indicators
-        ]
+        )
 
-        success, casks, warnings = homebrew_updater.brew_upgrade_casks()
+        success, casks, warnings, failed = homebrew_updater.brew_upgrade_casks()
         self.assertTrue(success)
         self.assertEqual(len(casks), 2)
         self.assertIn("cask1", casks)
@@ -268,12 +793,12 @@ class TestBrewCommands(unittest.TestCase):
     @patch('homebrew_updater.run_brew_command')
     def test_brew_upgrade_casks_with_warnings(self, mock_run_brew):
         """Test brew upgrade casks with partial success (some cleanup warnings)"""
-        mock_run_brew.side_effect = [
-            (True, "cask1\ncask2\ncask3"),  # 3 outdated casks
+        mock_run_brew.side_effect = scripted_brew(
+            (True, outdated_json(casks=["cask1", "cask2", "cask3"])),  # 3 outdated casks
             (False, "✔︎ Cask cask1 (1.0.0)\n✔︎ Cask cask2 (2.0.0)\nError: cask3 cleanup failed")  # 2 succeed, 1 has warnings
-        ]
+        )
 
-        success, casks, warnings = homebrew_updater.brew_upgrade_casks()
+        success, casks, warnings, failed = homebrew_updater.brew_upgrade_casks()
         self.assertTrue(success)  # Overall success because some casks upgraded
         self.assertEqual(len(casks), 2)  # Two casks upgraded successfully
         self.assertIn("cask1", casks)
@@ -282,36 +807,1170 @@ class TestBrewCommands(unittest.TestCase):
         self.assertIn("cask3", warnings)
 
 
-class TestGhostCaskHealing(unittest.TestCase):
-    """Test ghost cask healing functionality"""
+class TestOutdatedDiscovery(unittest.TestCase):
+    """Test the single JSON outdated query"""
+
+    @patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
+    @patch('homebrew_updater.run_brew_command')
+    def test_get_outdated_parses_json(self, mock_run_brew):
+        """Test that formulae and casks come from one brew outdated call"""
+        payload = {
+            "formulae": [{"name": "git", "installed_versions": ["2.42.0"], "current_version": "2.43.0",
+                          "pinned": False, "pinned_version": None},
+                         {"name": "node", "installed_versions": ["20.1.0"], "current_version": "21.0.0",
+                          "pinned": True, "pinned_version": "20.1.0"}],
+            "casks": [{"name": "firefox", "installed_versions": ["119.0"], "current_version": "120.0"}]
+        }
+        mock_run_brew.side_effect = scripted_brew((True, json.dumps(payload, indent=2)))
+
+        outdated = homebrew_updater.get_outdated()
+
+        mock_run_brew.assert_called_once()
+        self.assertEqual(mock_run_brew.call_args.args[0], ["outdated", "--json=v2", "--greedy"])
+        self.assertEqual(set(outdated.formulae), {"git", "node"})
+        self.assertEqual(outdated.casks["firefox"].current_version, "120.0")
+        self.assertTrue(outdated.formulae["node"].pinned)
+        self.assertEqual(outdated.describe("git"), "git (2.42.0 → 2.43.0)")
+
+    @patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
+    @patch('homebrew_updater.run_brew_command')
+    def test_get_outdated_ignores_stderr(self, mock_run_brew):
+        """Test that stderr warnings do not corrupt the JSON"""
+        def _run(args, check=True, on_line=None, **kwargs):
+            on_line('{"formulae": [], "casks": []}')
+            return True, '{"formulae": [], "casks": []}Warning: some tap is deprecated'
+        mock_run_brew.side_effect = _run
+
+        outdated = homebrew_updater.get_outdated()
+        self.assertEqual(outdated.formulae, {})
+
+    @patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
+    @patch('homebrew_updater.run_brew_command')
+    def test_get_outdated_failure(self, mock_run_brew):
+        """Test that an unparseable response yields None"""
+        mock_run_brew.side_effect = scripted_brew((True, "not json"))
+        self.assertIsNone(homebrew_updater.get_outdated())
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_pinned_formulae_are_not_upgraded(self, mock_run_brew):
+        """Test that pinned formulae are left alone"""
+        mock_run_brew.return_value = (True, "")
+        outdated = homebrew_updater.OutdatedSet(
+            formulae={"node": homebrew_updater.OutdatedPackage("node", ["20.1.0"], "21.0.0", pinned=True)},
+            casks={}
+        )
+
+        success, upgraded, failed = homebrew_updater.brew_upgrade_formulae(outdated)
+
+        self.assertTrue(success)
+        self.assertEqual(upgraded, [])
+        mock_run_brew.assert_not_called()
+
+
+class TestPrefetch(unittest.TestCase):
+    """Test the concurrent download prefetch stage"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_prefetch_tracks_bytes_per_package(self, mock_run_brew):
+        """Test that every outdated package is fetched and its artifact size recorded"""
+        (self.cache / "git.bottle.tar.gz").write_bytes(b"x" * 1000)
+        (self.cache / "firefox.dmg").write_bytes(b"x" * 5000)
+        outputs = {
+            "git": f"==> Fetching git\nDownloaded to: {self.cache / 'git.bottle.tar.gz'}",
+            "firefox": f"Already downloaded: {self.cache / 'firefox.dmg'}",
+            "broken": "Error: Download failed",
+        }
+
+        def _run(args, check=True, on_line=None, **kwargs):
+            name = args[-1]
+            for line in outputs[name].splitlines():
+                on_line(line)
+            return name != "broken", outputs[name]
+        mock_run_brew.side_effect = _run
+
+        outdated = homebrew_updater.OutdatedSet(
+            formulae={"git": homebrew_updater.OutdatedPackage("git", ["1"], "2")},
+            casks={"firefox": homebrew_updater.OutdatedPackage("firefox", ["1"], "2"),
+                   "broken": homebrew_updater.OutdatedPackage("broken", ["1"], "2")}
+        )
+        results = {r.name: r for r in homebrew_updater.prefetch_downloads(outdated, workers=3)}
+
+        self.assertEqual(results["git"].size, 1000)
+        self.assertFalse(results["git"].cached)
+        self.assertEqual(results["git"].kind, "formula")
+        self.assertEqual(results["firefox"].size, 5000)
+        self.assertTrue(results["firefox"].cached)
+        self.assertFalse(results["broken"].success)
+        fetched = sorted(c.args[0][1:] for c in mock_run_brew.call_args_list)
+        self.assertEqual(fetched, [["--cask", "broken"], ["--cask", "firefox"], ["--formula", "git"]])
 
-    @patch('homebrew_updater.subprocess.run')
     @patch('homebrew_updater.run_brew_command')
+    def test_prefetch_nothing_outdated(self, mock_run_brew):
+        """Test that nothing is spawned when nothing is outdated"""
+        outdated = homebrew_updater.OutdatedSet(formulae={}, casks={})
+        self.assertEqual(homebrew_updater.prefetch_downloads(outdated, workers=4), [])
+        mock_run_brew.assert_not_called()
+
+
+class TestFetchAndApplyModes(unittest.TestCase):
+    """Test the split fetch-only / apply-from-cache runs"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = Path(self.tmp.name)
+        self.manifest_file = self.cache / ".prefetch_manifest.json"
+        self.outdated = homebrew_updater.OutdatedSet(
+            formulae={"git": homebrew_updater.OutdatedPackage("git", ["2.42.0"], "2.43.0")},
+            casks={"firefox": homebrew_updater.OutdatedPackage("firefox", ["119.0"], "120.0"),
+                   "slack": homebrew_updater.OutdatedPackage("slack", ["4.0"], "4.1")}
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _artifact(self, name):
+        path = self.cache / name
+        path.write_bytes(b"artifact")
+        return str(path)
+
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.fetch_package')
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_update')
+    def test_fetch_only_writes_manifest(self, mock_update, mock_get_outdated, mock_fetch, mock_notification):
+        """Test that a fetch-only run records fetched versions and does not upgrade"""
+        mock_update.return_value = True
+        mock_get_outdated.return_value = self.outdated
+        paths = {"git": self._artifact("git.tar.gz"), "firefox": self._artifact("firefox.dmg")}
+        mock_fetch.side_effect = lambda name, kind: homebrew_updater.FetchResult(
+            name, kind, success=name in paths, paths=[paths[name]] if name in paths else [])
+
+        with patch('homebrew_updater.PREFETCH_MANIFEST_FILE', self.manifest_file), \
+                patch('homebrew_updater.brew_upgrade_formulae') as mock_upgrade:
+            result = homebrew_updater.main(["--fetch-only"])
+
+        self.assertEqual(result, 0)
+        mock_upgrade.assert_not_called()
+        manifest = json.loads(self.manifest_file.read_text())
+        self.assertEqual(manifest["formula/git"]["version"], "2.43.0")
+        self.assertEqual(manifest["cask/firefox"]["paths"], [paths["firefox"]])
+        self.assertNotIn("cask/slack", manifest)
+
+    def test_filter_cached_against_prepopulated_cache(self):
+        """Test that only packages with their current version cached are applied"""
+        manifest = {
+            "formula/git": {"version": "2.43.0", "paths": [self._artifact("git.tar.gz")]},
+            "cask/firefox": {"version": "119.5", "paths": [self._artifact("firefox.dmg")]},
+            "cask/slack": {"version": "4.1", "paths": [str(self.cache / "deleted.dmg")]},
+        }
+
+        cached, not_cached = homebrew_updater.filter_cached(self.outdated, manifest)
+
+        self.assertEqual(list(cached.formulae), ["git"])
+        self.assertEqual(cached.casks, {})
+        self.assertEqual(sorted(not_cached), ["firefox", "slack"])
+
+    @patch.dict('homebrew_updater.BREW_ENV', clear=False)
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update')
+    @patch('homebrew_updater.heal_ghost_casks')
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_formulae')
+    @patch('homebrew_updater.brew_upgrade_casks')
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    def test_apply_cached_runs_offline(self, mock_doctor, mock_cleanup, mock_upgrade_casks,
+                                       mock_upgrade_formulae, mock_get_outdated, mock_heal,
+                                       mock_update, mock_notification, mock_cleanup_logs):
+        """Test that an apply run skips brew update and uncached packages"""
+        mock_get_outdated.return_value = self.outdated
+        mock_heal.return_value = []
+        mock_upgrade_formulae.return_value = (True, ["git"], [])
+        mock_upgrade_casks.return_value = (True, [], [], [])
+        self.manifest_file.write_text(json.dumps({
+            "formula/git": {"version": "2.43.0", "paths": [self._artifact("git.tar.gz")]}
+        }))
+
+        with patch('homebrew_updater.PREFETCH_MANIFEST_FILE', self.manifest_file):
+            result = homebrew_updater.main(["--apply-cached"])
+
+        self.assertEqual(result, 0)
+        mock_update.assert_not_called()
+        self.assertEqual(homebrew_updater.BREW_ENV["HOMEBREW_NO_AUTO_UPDATE"], "1")
+        applied = mock_upgrade_formulae.call_args.args[0]
+        self.assertEqual(list(applied.formulae), ["git"])
+        self.assertEqual(mock_upgrade_casks.call_args.args[0].casks, {})
+        summary = mock_notification.call_args_list[-1].args[0]
+        self.assertIn("Not Cached (2)", summary)
+
+    @patch.dict('homebrew_updater.BREW_ENV', clear=False)
+    @patch('homebrew_updater.FORMULA_UPGRADE_WORKERS', 1)
+    @patch('homebrew_updater.CASK_UPGRADE_WORKERS', 1)
+    @patch('homebrew_updater.STALE_STATE_SWEEP', 'off')
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.heal_ghost_casks', return_value=[])
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    @patch('homebrew_updater.run_brew_command', return_value=(True, ""))
+    def test_apply_cached_names_only_cached_packages(self, mock_run_brew, mock_doctor, mock_cleanup,
+                                                     mock_get_outdated, mock_heal, mock_notification,
+                                                     mock_cleanup_logs):
+        """Test that single-run upgrades name the cached packages instead of upgrading everything"""
+        self.outdated.formulae["curl"] = homebrew_updater.OutdatedPackage("curl", ["8.4.0"], "8.5.0")
+        mock_get_outdated.return_value = self.outdated
+        self.manifest_file.write_text(json.dumps({
+            "formula/git": {"version": "2.43.0", "paths": [self._artifact("git.tar.gz")]},
+            "cask/firefox": {"version": "120.0", "paths": [self._artifact("firefox.dmg")]},
+        }))
+
+        with patch('homebrew_updater.PREFETCH_MANIFEST_FILE', self.manifest_file), \
+                patch('homebrew_updater.METRICS_FILE', self.cache / "run.metrics.json"):
+            result = homebrew_updater.main(["--apply-cached"])
+
+        self.assertEqual(result, 0)
+        upgrades = [c.args[0] for c in mock_run_brew.call_args_list if c.args[0][0] == "upgrade"]
+        self.assertEqual(upgrades, [["upgrade", "--formula", "git"],
+                                    ["upgrade", "--cask", "--greedy", "firefox"]])
+
+
+@patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
+class TestParallelCaskUpgrades(unittest.TestCase):
+    """Test the per-cask parallel upgrade engine"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.caskroom = Path(self.tmp.name)
+        for cask in ("cask1", "cask2", "cask3"):
+            (self.caskroom / cask / "1.0").mkdir(parents=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _fake_brew(self, outcomes):
+        """Fake run_brew_command: outdated listing plus per-cask upgrade outcomes"""
+        calls = []
+
+        def _run(args, check=True, on_line=None, **kwargs):
+            calls.append(args)
+            if args[0] == "outdated":
+                return scripted_brew((True, outdated_json(casks=["cask1", "cask2", "cask3"])))(
+                    args, on_line=on_line)
+            cask = args[-1]
+            outcome = outcomes[cask]
+            if callable(outcome):
+                outcome = outcome()
+            return outcome
+        return _run, calls
+
+    @patch('homebrew_updater.CASK_UPGRADE_WORKERS', 3)
     @patch('homebrew_updater.get_caskroom_path')
-    @patch('homebrew_updater.Path')
-    def test_heal_ghost_casks_missing_dir(self, mock_path_class, mock_get_caskroom,
-                                          mock_run_brew, mock_subprocess):
-        """Test healing when cask directory doesn't exist"""
-        # Mock the caskroom path
-        mock_caskroom = MagicMock()
-        mock_get_caskroom.return_value = mock_caskroom
-
-        # Mock cask directory doesn't exist
-        mock_cask_dir = MagicMock()
-        mock_cask_dir.exists.return_value = False
-        mock_caskroom.__truediv__.return_value = mock_cask_dir
-
-        # Mock brew list casks
+    @patch('homebrew_updater.run_brew_command')
+    def test_results_per_cask(self, mock_run_brew, mock_caskroom):
+        """Test that each cask gets its own success, warning or failure result"""
+        mock_caskroom.return_value = self.caskroom
+
+        def upgraded_but_cleanup_failed():
+            (self.caskroom / "cask2" / "2.0").mkdir()
+            return False, "Error: Permission denied @ dir_s_rmdir"
+
+        fake, calls = self._fake_brew({
+            "cask1": (True, ""),
+            "cask2": upgraded_but_cleanup_failed,
+            "cask3": (False, "Error: Download failed"),
+        })
+        mock_run_brew.side_effect = fake
+
+        success, upgraded, warnings, failed = homebrew_updater.brew_upgrade_casks()
+
+        self.assertTrue(success)
+        self.assertEqual(upgraded, ["cask1"])
+        self.assertEqual(warnings, ["cask2"])
+        self.assertEqual(failed, ["cask3"])
+        upgrade_calls = [c for c in calls if c[0] == "upgrade"]
+        self.assertEqual(len(upgrade_calls), 3)
+        self.assertTrue(all(c[-1] in ("cask1", "cask2", "cask3") for c in upgrade_calls))
+
+    @patch('homebrew_updater.CASK_UPGRADE_WORKERS', 2)
+    @patch('homebrew_updater.get_caskroom_path')
+    @patch('homebrew_updater.run_brew_command')
+    def test_all_failed_reports_failure(self, mock_run_brew, mock_caskroom):
+        """Test that the phase fails when no cask could be upgraded"""
+        mock_caskroom.return_value = self.caskroom
+        fake, _ = self._fake_brew({cask: (False, "Error: boom") for cask in ("cask1", "cask2", "cask3")})
+        mock_run_brew.side_effect = fake
+
+        success, upgraded, warnings, failed = homebrew_updater.brew_upgrade_casks()
+
+        self.assertFalse(success)
+        self.assertEqual(failed, ["cask1", "cask2", "cask3"])
+
+    @patch('homebrew_updater.BREW_LOCK_RETRY_DELAY', 0)
+    @patch('homebrew_updater.run_brew_command')
+    def test_lock_contention_is_retried(self, mock_run_brew):
+        """Test that a cask locked by another brew process is retried"""
         mock_run_brew.side_effect = [
-            (True, "ghost-cask"),  # list casks
-            (True, "Uninstalled")  # uninstall
+            (False, "Error: A `brew upgrade cask1` process has already locked /opt/homebrew/var/homebrew/locks/cask1.lock"),
+            (True, ""),
         ]
 
-        removed = homebrew_updater.heal_ghost_casks()
+        result = homebrew_updater.upgrade_single_cask("cask1", self.caskroom)
+
+        self.assertEqual(result.status, "success")
+        self.assertEqual(mock_run_brew.call_count, 2)
+
+
+@patch('homebrew_updater.OUTDATED_SOURCE', 'brew')
+class TestFormulaDependencyScheduler(unittest.TestCase):
+    """Test the dependency-ordered parallel formula upgrades"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cellar = Path(self.tmp.name)
+        # openssl@3 <- python@3.12 <- (pipx); ca-certificates <- openssl@3; wget is independent
+        self._receipt("ca-certificates", [])
+        self._receipt("openssl@3", ["ca-certificates"])
+        self._receipt("python@3.12", ["ca-certificates", "openssl@3", "sqlite"])
+        self._receipt("pipx", ["ca-certificates", "openssl@3", "python@3.12"])
+        self._receipt("wget", ["libidn2"])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _receipt(self, formula, deps):
+        keg = self.cellar / formula / "1.0"
+        keg.mkdir(parents=True)
+        receipt = {"runtime_dependencies": [{"full_name": dep, "version": "1.0"} for dep in deps]}
+        (keg / "INSTALL_RECEIPT.json").write_text(json.dumps(receipt))
+
+    def test_dependency_graph_from_receipts(self):
+        """Test that edges are limited to the outdated formulae"""
+        with patch('homebrew_updater.CELLAR_PATH', self.cellar):
+            graph = homebrew_updater.get_formula_dependencies(["openssl@3", "python@3.12", "wget"])
+
+        self.assertEqual(graph["python@3.12"], {"openssl@3"})
+        self.assertEqual(graph["openssl@3"], set())
+        self.assertEqual(graph["wget"], set())
+
+    def test_missing_receipt_disables_graph(self):
+        """Test that an unknown formula makes the graph unusable"""
+        with patch('homebrew_updater.CELLAR_PATH', self.cellar):
+            self.assertIsNone(homebrew_updater.get_formula_dependencies(["wget", "not-installed"]))
+
+    @patch('homebrew_updater.upgrade_single_formula')
+    def test_dependencies_upgrade_before_dependents(self, mock_upgrade):
+        """Test that no formula starts before its dependencies finished"""
+        formulae = ["pipx", "python@3.12", "openssl@3", "ca-certificates", "wget"]
+        with patch('homebrew_updater.CELLAR_PATH', self.cellar):
+            graph = homebrew_updater.get_formula_dependencies(formulae)
+
+        finished = []
+
+        def _upgrade(formula):
+            for dep in graph[formula]:
+                self.assertIn(dep, finished, f"{formula} started before {dep}")
+            finished.append(formula)
+            return homebrew_updater.UpgradeResult(formula, "success")
+        mock_upgrade.side_effect = _upgrade
+
+        results = homebrew_updater.upgrade_formulae_dag(formulae, graph, workers=4)
+
+        self.assertEqual([r.name for r in results], formulae)
+        self.assertTrue(all(r.status == "success" for r in results))
+
+    @patch('homebrew_updater.upgrade_single_formula')
+    def test_failed_dependency_skips_dependents(self, mock_upgrade):
+        """Test that dependents of a failed formula are skipped"""
+        formulae = ["pipx", "python@3.12", "openssl@3", "wget"]
+        with patch('homebrew_updater.CELLAR_PATH', self.cellar):
+            graph = homebrew_updater.get_formula_dependencies(formulae)
+        mock_upgrade.side_effect = lambda f: homebrew_updater.UpgradeResult(
+            f, "failed" if f == "openssl@3" else "success")
+
+        results = {r.name: r for r in homebrew_updater.upgrade_formulae_dag(formulae, graph, workers=2)}
+
+        self.assertEqual(results["openssl@3"].status, "failed")
+        self.assertEqual(results["python@3.12"].status, "skipped")
+        self.assertEqual(results["pipx"].status, "skipped")
+        self.assertEqual(results["wget"].status, "success")
+        called = [c.args[0] for c in mock_upgrade.call_args_list]
+        self.assertNotIn("pipx", called)
+
+    @patch('homebrew_updater.FORMULA_UPGRADE_WORKERS', 3)
+    @patch('homebrew_updater.run_brew_command')
+    def test_brew_upgrade_formulae_parallel(self, mock_run_brew):
+        """Test that brew_upgrade_formulae upgrades formulae one by one when parallel"""
+        def _run(args, check=True, on_line=None, **kwargs):
+            if args[0] == "outdated":
+                return scripted_brew((True, outdated_json(formulae=["openssl@3", "wget"])))(
+                    args, on_line=on_line)
+            return (False, "Error: build failed") if args[-1] == "wget" else (True, "")
+        mock_run_brew.side_effect = _run
+
+        with patch('homebrew_updater.CELLAR_PATH', self.cellar):
+            success, upgraded, failed = homebrew_updater.brew_upgrade_formulae()
+
+        self.assertTrue(success)
+        self.assertEqual(upgraded, ["openssl@3"])
+        self.assertEqual(failed, ["wget"])
+        env = mock_run_brew.call_args_list[-1].kwargs["extra_env"]
+        self.assertEqual(env["HOMEBREW_NO_INSTALLED_DEPENDENTS_CHECK"], "1")
 
-        # Should identify and remove the ghost cask
+
+class TestGhostCaskHealing(unittest.TestCase):
+    """Test ghost cask healing functionality"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.caskroom = Path(self.tmp.name) / "Caskroom"
+        self.caskroom.mkdir()
+        self.state_patch = patch('homebrew_updater.GHOST_SCAN_STATE_FILE',
+                                 Path(self.tmp.name) / ".ghost_scan.json")
+        self.state_patch.start()
+
+    def tearDown(self):
+        self.state_patch.stop()
+        self.tmp.cleanup()
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_heal_ghost_casks_missing_dir(self, mock_run_brew):
+        """Test healing when the cask directory has no installed version"""
+        (self.caskroom / "ghost-cask").mkdir()
+        mock_run_brew.return_value = (True, "Uninstalled")
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom):
+            removed = homebrew_updater.heal_ghost_casks()
+
+        # Should identify and remove the ghost cask without asking brew for the cask list
         self.assertEqual(len(removed), 1)
         self.assertIn("ghost-cask", removed)
+        mock_run_brew.assert_called_once()
+        self.assertEqual(mock_run_brew.call_args.args[0][:2], ["uninstall", "--cask"])
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_heal_batches_uninstalls(self, mock_run_brew):
+        """Test that all ghosts are removed with a single brew call"""
+        for cask in ("ghost-a", "ghost-b", "ghost-c"):
+            (self.caskroom / cask).mkdir()
+        mock_run_brew.return_value = (True, "")
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom):
+            removed = homebrew_updater.heal_ghost_casks()
+
+        self.assertEqual(removed, ["ghost-a", "ghost-b", "ghost-c"])
+        mock_run_brew.assert_called_once_with(
+            ["uninstall", "--cask", "--force", "--zap", "ghost-a", "ghost-b", "ghost-c"], check=True)
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_failed_batch_bisects_to_the_bad_cask(self, mock_run_brew):
+        """Test that one failing cask is isolated and the others are still removed"""
+        ghosts = [f"ghost-{i}" for i in range(8)]
+        for cask in ghosts:
+            (self.caskroom / cask).mkdir()
+
+        def uninstall(args, check=True):
+            # Like run_brew_command, a non-zero exit only fails with check=True
+            casks = args[4:]
+            if "ghost-5" in casks:
+                return not check, "Error: ghost-5 is broken"
+            for cask in casks:
+                (self.caskroom / cask).rmdir()
+            return True, ""
+        mock_run_brew.side_effect = uninstall
+
+        removed = homebrew_updater.uninstall_casks(ghosts, self.caskroom)
+
+        self.assertEqual(sorted(removed), [g for g in ghosts if g != "ghost-5"])
+        # 1 batch + 2 halves + 2 quarters + 2 singles instead of 8 serial runs
+        self.assertEqual(mock_run_brew.call_count, 7)
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_failed_batch_counts_casks_it_removed(self, mock_run_brew):
+        """Test that casks removed before a batch failed are reported, and the rest retried"""
+        for cask in ("ghost-a", "ghost-b"):
+            (self.caskroom / cask).mkdir()
+
+        def uninstall(args, check=True):
+            (self.caskroom / args[4]).rmdir()
+            return len(args) == 5 or not check, ""
+        mock_run_brew.side_effect = uninstall
+
+        removed = homebrew_updater.uninstall_casks(["ghost-a", "ghost-b"], self.caskroom)
+
+        self.assertEqual(removed, ["ghost-a", "ghost-b"])
+        self.assertEqual(mock_run_brew.call_args.args[0][4:], ["ghost-b"])
+
+    @patch('homebrew_updater.BREW_INFO_CHUNK_SIZE', 2)
+    @patch('homebrew_updater.run_brew_command')
+    def test_brew_info_is_chunked_and_degrades_per_chunk(self, mock_run_brew):
+        """Test that cask info is queried in chunks and a failed chunk loses only its casks"""
+        def brew_info(args, on_line=None, **kwargs):
+            casks = args[3:]
+            if "slow" in casks:
+                return False, "Command timed out"
+            stdout = json.dumps({"formulae": [], "casks": [api_cask(c, "1.0", apps=[f"{c}.app"])
+                                                           for c in casks]}, indent=2)
+            for line in stdout.splitlines():
+                on_line(line)
+            # stderr noise must not reach the JSON parser
+            return True, stdout + "\nWarning: Treating casks as outdated\n"
+        mock_run_brew.side_effect = brew_info
+
+        result = homebrew_updater._brew_info_cask_artifacts(["a", "b", "c", "slow", "e"])
+
+        self.assertEqual(mock_run_brew.call_count, 3)
+        self.assertEqual(sorted(result), ["a", "b", "e"])
+        self.assertEqual(result["e"], {"app": ["e.app"]})
+
+    @patch('homebrew_updater.run_brew_command', return_value=(True, ""))
+    def test_heal_leaves_partials_to_the_sweep(self, mock_run_brew):
+        """Test that healing does not remove *.upgrading partials itself"""
+        (self.caskroom / "firefox/120.0.upgrading").mkdir(parents=True)
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom), \
+                patch('homebrew_updater.load_api_index', return_value=None), \
+                patch('homebrew_updater._brew_info_cask_artifacts', return_value={}):
+            homebrew_updater.heal_ghost_casks()
+
+        self.assertTrue((self.caskroom / "firefox/120.0.upgrading").exists())
+
+    @patch('homebrew_updater.subprocess.run')
+    @patch('homebrew_updater.shutil.rmtree', side_effect=PermissionError("Operation not permitted"))
+    def test_remove_tree_falls_back_to_sudo(self, mock_rmtree, mock_run):
+        """Test that root-owned partials are removed with non-interactive sudo"""
+        mock_run.return_value = fake_process(returncode=0)
+
+        self.assertTrue(homebrew_updater.remove_tree(self.caskroom / "x.upgrading"))
+        self.assertEqual(mock_run.call_args.args[0][:3], ["sudo", "-n", "rm"])
+
+    @patch('homebrew_updater.run_brew_command')
+    @patch('homebrew_updater._brew_info_cask_artifacts', return_value={})
+    @patch('homebrew_updater.load_api_index', return_value=None)
+    def test_heal_dry_run_changes_nothing(self, mock_index, mock_info, mock_run_brew):
+        """Test that a dry run reports ghosts and partials without removing them"""
+        (self.caskroom / "ghost-cask").mkdir()
+        (self.caskroom / "zoom/1.0.upgrading").mkdir(parents=True)
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom):
+            would_remove = homebrew_updater.heal_ghost_casks(dry_run=True)
+
+        self.assertEqual(would_remove, ["ghost-cask"])
+        mock_run_brew.assert_not_called()
+        self.assertTrue((self.caskroom / "zoom/1.0.upgrading").exists())
+
+    def _artifact_dirs(self):
+        root = Path(self.tmp.name)
+        dirs = {"app": [root / "Applications"], "binary": [root / "bin"],
+                "font": [root / "Fonts"], "pkgutil": [root / "receipts"]}
+        for paths in dirs.values():
+            paths[0].mkdir()
+        (root / "Applications/Firefox.app").mkdir()
+        (root / "bin/gh").touch()
+        (root / "Fonts/FiraCode-Regular.ttf").touch()
+        (root / "receipts/com.microsoft.package.Microsoft_Word.app.plist").touch()
+        return dirs
+
+    def test_artifact_index_lookups(self):
+        """Test set lookups across artifact kinds, including pkgutil patterns"""
+        present = homebrew_updater.ArtifactIndex(self._artifact_dirs())
+
+        self.assertEqual(present.find({"app": ["Missing.app", "firefox.app"]}), "firefox.app")
+        self.assertEqual(present.find({"binary": ["gh"]}), "gh")
+        self.assertEqual(present.find({"pkgutil": ["com.microsoft.package.*"]}), "com.microsoft.package.*")
+        self.assertIsNone(present.find({"font": ["FiraCode-Bold.ttf"], "pkgutil": ["com.example.pkg"]}))
+        self.assertFalse(present.checkable({"pkg": ["Installer.pkg"], "app": []}))
+        self.assertTrue(present.checkable({"pkg": ["Installer.pkg"], "pkgutil": ["com.example.pkg"]}))
+
+    def test_artifact_index_is_fast_on_large_directories(self):
+        """Test that hundreds of lookups against thousands of entries stay set lookups"""
+        dirs = self._artifact_dirs()
+        root = Path(self.tmp.name)
+        for i in range(3000):
+            (root / f"receipts/com.example.pkg{i}.plist").touch()
+        for i in range(300):
+            (root / f"Applications/App {i}.app").mkdir()
+        present = homebrew_updater.ArtifactIndex(dirs)
+
+        start = time.monotonic()
+        for i in range(300):
+            self.assertEqual(present.find({"app": [f"app {i}.app"]}), f"app {i}.app")
+            self.assertEqual(present.find({"pkgutil": [f"com.example.pkg{i}"]}), f"com.example.pkg{i}")
+            self.assertIsNotNone(present.find({"pkgutil": ["com.microsoft.package.*"]}))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    @patch('homebrew_updater.run_brew_command')
+    @patch('homebrew_updater._brew_info_cask_artifacts')
+    @patch('homebrew_updater.load_api_index', return_value=None)
+    def test_heal_checks_all_artifact_kinds(self, mock_index, mock_info, mock_run_brew):
+        """Test that non-app casks are checked and uncheckable ones are left alone"""
+        for cask in ("firefox", "gh", "font-fira-code", "old-cli", "zoom-installer"):
+            (self.caskroom / cask / "1.0").mkdir(parents=True)
+        mock_info.return_value = {
+            "firefox": {"app": ["Firefox.app"]},
+            "gh": {"binary": ["gh"]},
+            "font-fira-code": {"font": ["FiraCode-Regular.ttf"]},
+            "old-cli": {"binary": ["old-cli"]},
+            "zoom-installer": {"pkg": ["Zoom.pkg"]},
+        }
+        mock_run_brew.return_value = (True, "")
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom), \
+             patch('homebrew_updater.ARTIFACT_DIRS', self._artifact_dirs()):
+            removed = homebrew_updater.heal_ghost_casks()
+
+        self.assertEqual(removed, ["old-cli"])
+
+    @patch('homebrew_updater.run_brew_command')
+    @patch('homebrew_updater._brew_info_cask_artifacts')
+    @patch('homebrew_updater.load_api_index', return_value=None)
+    def test_incremental_scan_skips_unchanged_casks(self, mock_index, mock_info, mock_run_brew):
+        """Test that only changed casks, or casks whose artifact vanished, are re-verified"""
+        for cask in ("firefox", "gh"):
+            (self.caskroom / cask / "1.0").mkdir(parents=True)
+        mock_info.side_effect = lambda casks: {c: {"firefox": {"app": ["Firefox.app"]},
+                                                   "gh": {"binary": ["gh"]}}[c] for c in casks}
+        mock_run_brew.return_value = (True, "")
+        artifact_dirs = self._artifact_dirs()
+
+        with patch('homebrew_updater.CASKROOM_PATH', self.caskroom), \
+             patch('homebrew_updater.ARTIFACT_DIRS', artifact_dirs):
+            self.assertEqual(homebrew_updater.heal_ghost_casks(), [])
+            self.assertEqual(mock_info.call_args.args[0], ["firefox", "gh"])
+
+            # Nothing changed: no artifact lookups at all
+            mock_info.reset_mock()
+            self.assertEqual(homebrew_updater.heal_ghost_casks(), [])
+            mock_info.assert_not_called()
+
+            # An upgrade touches the Caskroom entry; a deleted binary invalidates its record
+            (self.caskroom / "firefox" / "2.0").mkdir()
+            (Path(self.tmp.name) / "bin/gh").unlink()
+            removed = homebrew_updater.heal_ghost_casks()
+
+        self.assertEqual(sorted(mock_info.call_args.args[0]), ["firefox", "gh"])
+        self.assertEqual(removed, ["gh"])
+
+
+class TestStaleStateSweeper(unittest.TestCase):
+    """Test the stale-state sweep over a synthetic prefix"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prefix = Path(self.tmp.name)
+        self.patches = [patch('homebrew_updater.HOMEBREW_PREFIX', self.prefix),
+                        patch('homebrew_updater.CELLAR_PATH', self.prefix / "Cellar"),
+                        patch('homebrew_updater.CASKROOM_PATH', self.prefix / "Caskroom")]
+        for p in self.patches:
+            p.start()
+        for name in ("bin", "opt"):
+            (self.prefix / name).mkdir()
+
+        # Healthy: a keg with files, linked; an app cask whose installed version dir is empty
+        (self.prefix / "Cellar/git/2.43.0/bin").mkdir(parents=True)
+        (self.prefix / "opt/git").symlink_to("../Cellar/git/2.43.0")
+        (self.prefix / "bin/git").symlink_to("../Cellar/git/2.43.0/bin")
+        self._cask("firefox", "120.0", installed=True)
+
+        # Stale: leftover empty version, partial upgrade, empty keg, dangling links
+        self._cask("firefox", "119.0")
+        self._cask("slack", "4.35", installed=True)
+        (self.prefix / "Caskroom/slack/4.36.upgrading").mkdir()
+        (self.prefix / "Cellar/wget/1.21.4").mkdir(parents=True)
+        (self.prefix / "opt/wget").symlink_to("../Cellar/wget/1.21.3")
+        (self.prefix / "bin/wget").symlink_to("../Cellar/wget/1.21.3/bin/wget")
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def _cask(self, token, version, installed=False):
+        (self.prefix / "Caskroom" / token / version).mkdir(parents=True)
+        if installed:
+            (self.prefix / "Caskroom" / token / ".metadata" / version / "20240101000000.000").mkdir(parents=True)
+
+    def test_sweep_reports_without_changing_anything(self):
+        """Test that the sweep finds each kind of stale state and only reports it"""
+        report = homebrew_updater.sweep_stale_state(workers=4)
+
+        self.assertEqual(report.partials, [self.prefix / "Caskroom/slack/4.36.upgrading"])
+        self.assertEqual(report.empty_dirs, [self.prefix / "Caskroom/firefox/119.0",
+                                             self.prefix / "Cellar/wget/1.21.4"])
+        self.assertEqual(report.broken_links, [self.prefix / "bin/wget", self.prefix / "opt/wget"])
+        self.assertEqual(report.repaired, [])
+        self.assertTrue((self.prefix / "bin/wget").is_symlink())
+
+    def test_sweep_finds_partials_inside_a_version(self):
+        """Test that partials are found at both Caskroom levels"""
+        (self.prefix / "Caskroom/slack/4.35/Slack.app.upgrading").mkdir()
+
+        report = homebrew_updater.sweep_stale_state()
+
+        self.assertEqual(report.partials, [self.prefix / "Caskroom/slack/4.35/Slack.app.upgrading",
+                                           self.prefix / "Caskroom/slack/4.36.upgrading"])
+
+    def test_sweep_repairs_partials_only(self):
+        """Test that partial repair removes *.upgrading dirs and only reports the rest"""
+        report = homebrew_updater.sweep_stale_state(repair_partials=True)
+
+        self.assertEqual(report.repaired, [self.prefix / "Caskroom/slack/4.36.upgrading"])
+        self.assertFalse((self.prefix / "Caskroom/slack/4.36.upgrading").exists())
+        self.assertTrue((self.prefix / "Caskroom/firefox/119.0").exists())
+        self.assertTrue(os.path.lexists(self.prefix / "opt/wget"))
+
+    def test_sweep_repairs(self):
+        """Test that repair removes stale state and nothing else"""
+        report = homebrew_updater.sweep_stale_state(repair=True)
+
+        self.assertEqual(len(report.repaired), 5)
+        self.assertFalse((self.prefix / "Caskroom/slack/4.36.upgrading").exists())
+        self.assertFalse((self.prefix / "Caskroom/firefox/119.0").exists())
+        self.assertFalse(os.path.lexists(self.prefix / "opt/wget"))
+        # The installed (empty) app cask version and healthy links survive
+        self.assertTrue((self.prefix / "Caskroom/firefox/120.0").exists())
+        self.assertTrue((self.prefix / "bin/git").exists())
+        self.assertEqual(homebrew_updater.sweep_stale_state().found, 0)
+
+    def test_sweep_is_fast_on_a_large_prefix(self):
+        """Test that a prefix with hundreds of packages sweeps in well under a second"""
+        for i in range(300):
+            (self.prefix / f"Cellar/formula-{i}/1.0/bin").mkdir(parents=True)
+            (self.prefix / f"bin/tool-{i}").symlink_to(f"../Cellar/formula-{i}/1.0/bin")
+            self._cask(f"cask-{i}", "1.0", installed=True)
+
+        start = time.monotonic()
+        report = homebrew_updater.sweep_stale_state()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(report.found, 5)
+
+
+class TestInventory(unittest.TestCase):
+    """Test reading installed packages straight from a (synthetic) prefix"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.prefix = Path(self.tmp.name)
+        self.cellar = self.prefix / "Cellar"
+        self.caskroom = self.prefix / "Caskroom"
+        (self.prefix / "opt").mkdir()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _keg(self, name, version, time_=None, link=False):
+        keg = self.cellar / name / version
+        keg.mkdir(parents=True)
+        receipt = {"time": time_, "runtime_dependencies": []}
+        (keg / "INSTALL_RECEIPT.json").write_text(json.dumps(receipt))
+        if link:
+            (self.prefix / "opt" / name).symlink_to(f"../Cellar/{name}/{version}")
+
+    def _cask(self, token, version, stamp):
+        (self.caskroom / token / version).mkdir(parents=True, exist_ok=True)
+        (self.caskroom / token / ".metadata" / version / stamp / "Casks").mkdir(parents=True)
+
+    def test_reads_formulae_and_casks(self):
+        """Test versions, linked kegs and install times"""
+        self._keg("git", "2.42.0", time_=1700000000)
+        self._keg("git", "2.43.0", time_=1710000000, link=True)
+        self._keg("wget", "1.21.4", time_=1690000000)
+        self._cask("firefox", "119.0", "20231101120000.123")
+        self._cask("firefox", "120.0", "20231201090000.456")
+        (self.caskroom / "firefox" / "119.0").rmdir()
+        (self.cellar / ".keepme").mkdir()
+
+        with patch('homebrew_updater.HOMEBREW_PREFIX', self.prefix):
+            inventory = homebrew_updater.read_inventory(self.cellar, self.caskroom)
+
+        self.assertEqual(set(inventory.formulae), {"git", "wget"})
+        self.assertEqual(inventory.formulae["git"].version, "2.43.0")
+        self.assertEqual(inventory.formulae["git"].versions, ["2.42.0", "2.43.0"])
+        self.assertEqual(inventory.formulae["git"].installed_time, 1710000000)
+        self.assertEqual(inventory.formulae["wget"].version, "1.21.4")
+        firefox = inventory.casks["firefox"]
+        self.assertEqual(firefox.version, "120.0")
+        self.assertEqual(firefox.versions, ["120.0"])
+        self.assertEqual(firefox.installed_time, datetime(2023, 12, 1, 9, 0, 0).timestamp())
+
+    def test_missing_prefix_is_empty(self):
+        """Test that a machine without Homebrew yields an empty inventory"""
+        inventory = homebrew_updater.read_inventory(self.prefix / "nope", self.prefix / "nope")
+        self.assertEqual(inventory.formulae, {})
+        self.assertEqual(inventory.casks, {})
+
+
+def write_api_cache(api_dir: Path, formulae=(), casks=()):
+    """Write formula.jws.json / cask.jws.json the way Homebrew caches them"""
+    api_dir.mkdir(parents=True, exist_ok=True)
+    for name, items in (("formula", formulae), ("cask", casks)):
+        envelope = {"protected": "e30", "payload": json.dumps(list(items)), "signatures": []}
+        (api_dir / f"{name}.jws.json").write_text(json.dumps(envelope))
+
+
+def api_formula(name, version, revision=0, deps=()):
+    return {"name": name, "versions": {"stable": version, "bottle": True},
+            "revision": revision, "dependencies": list(deps)}
+
+
+def api_cask(token, version, apps=(), auto_updates=False, **artifacts):
+    entries = [{"app": list(apps)}] if apps else []
+    entries += [{kind: values} for kind, values in artifacts.items()]
+    return {"token": token, "version": version, "auto_updates": auto_updates, "artifacts": entries}
+
+
+class TestApiIndex(unittest.TestCase):
+    """Test the compact memory-mapped index over the API cache"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.api_dir = self.root / "api"
+        homebrew_updater._API_INDEXES.clear()
+        self.patches = [patch('homebrew_updater.HOMEBREW_API_CACHE', self.api_dir),
+                        patch('homebrew_updater.LOG_DIR', self.root)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        for index in homebrew_updater._API_INDEXES.values():
+            index.close()
+        homebrew_updater._API_INDEXES.clear()
+        self.tmp.cleanup()
+
+    def test_lookup_formula_and_cask(self):
+        """Test versions, dependencies and compacted artifacts"""
+        write_api_cache(
+            self.api_dir,
+            formulae=[api_formula("git", "2.43.0", deps=["gettext", "pcre2"]),
+                      api_formula("python@3.12", "3.12.1", revision=1)],
+            casks=[api_cask("firefox", "120.0", apps=["Firefox.app"]),
+                   api_cask("docker", "4.25.0", apps=["Docker.app"],
+                            binary=["$APPDIR/Docker.app/Contents/Resources/bin/docker",
+                                    {"target": "docker-cli"}],
+                            uninstall=[{"pkgutil": "com.docker.pkg", "quit": "com.docker.docker"}])]
+        )
+
+        formulae = homebrew_updater.load_api_index("formula")
+        casks = homebrew_updater.load_api_index("cask")
+
+        self.assertEqual(formulae.get("git")["version"], "2.43.0")
+        self.assertEqual(formulae.get("git")["deps"], ["gettext", "pcre2"])
+        self.assertEqual(formulae.get("python@3.12")["version"], "3.12.1_1")
+        self.assertIsNone(formulae.get("not-a-formula"))
+        docker = casks.get("docker")
+        self.assertEqual(docker["artifacts"]["app"], ["Docker.app"])
+        self.assertEqual(docker["artifacts"]["binary"], ["docker-cli"])
+        self.assertEqual(docker["artifacts"]["pkgutil"], ["com.docker.pkg"])
+        self.assertIn("firefox", casks)
+
+    def test_rebuilds_only_when_content_changes(self):
+        """Test that a touched but unchanged source is not re-parsed"""
+        write_api_cache(self.api_dir, casks=[api_cask("firefox", "120.0", apps=["Firefox.app"])])
+        source = self.api_dir / "cask.jws.json"
+
+        with patch('homebrew_updater.build_api_index', wraps=homebrew_updater.build_api_index) as build:
+            homebrew_updater.load_api_index("cask")
+            homebrew_updater.load_api_index("cask")
+            self.assertEqual(build.call_count, 1)
+
+            # Same content, new mtime: re-stamped, not rebuilt
+            os.utime(source, (time.time() + 10, time.time() + 10))
+            self.assertEqual(homebrew_updater.load_api_index("cask").get("firefox")["version"], "120.0")
+            self.assertEqual(build.call_count, 1)
+
+            # New content: rebuilt
+            write_api_cache(self.api_dir, casks=[api_cask("firefox", "121.0", apps=["Firefox.app"])])
+            os.utime(source, (time.time() + 20, time.time() + 20))
+            self.assertEqual(homebrew_updater.load_api_index("cask").get("firefox")["version"], "121.0")
+            self.assertEqual(build.call_count, 2)
+
+    def test_replaced_index_is_closed(self):
+        """Test that re-stamping or rebuilding closes the previous index's mapping"""
+        write_api_cache(self.api_dir, casks=[api_cask("firefox", "120.0", apps=["Firefox.app"])])
+        source = self.api_dir / "cask.jws.json"
+        first = homebrew_updater.load_api_index("cask")
+
+        os.utime(source, (time.time() + 10, time.time() + 10))
+        second = homebrew_updater.load_api_index("cask")
+        self.assertIsNot(second, first)
+        self.assertTrue(first._mmap.closed)
+
+        write_api_cache(self.api_dir, casks=[api_cask("firefox", "121.0", apps=["Firefox.app"])])
+        os.utime(source, (time.time() + 20, time.time() + 20))
+        third = homebrew_updater.load_api_index("cask")
+        self.assertTrue(second._mmap.closed)
+        self.assertEqual(third.get("firefox")["version"], "121.0")
+
+    def test_jws_payload_after_other_keys(self):
+        """Test that only the envelope's own payload key is decoded"""
+        packages = [api_cask("payload", "1.0", apps=['Quote "payload": App.app'])]
+        envelope = {"signatures": [{"protected": "e30"}], "payload": json.dumps(packages)}
+        self.api_dir.mkdir(parents=True)
+        (self.api_dir / "cask.jws.json").write_text(json.dumps(envelope))
+
+        casks = homebrew_updater.load_api_index("cask")
+
+        self.assertEqual(casks.get("payload")["artifacts"]["app"], ['Quote "payload": App.app'])
+
+    def test_no_api_cache(self):
+        """Test that a missing API cache yields no index"""
+        self.assertIsNone(homebrew_updater.load_api_index("formula"))
+
+    @patch('homebrew_updater._brew_info_cask_artifacts')
+    @patch('homebrew_updater.run_brew_command')
+    def test_ghost_scan_uses_index_without_brew_info(self, mock_run_brew, mock_brew_info):
+        """Test that ghost detection looks artifacts up in the index"""
+        write_api_cache(self.api_dir, casks=[api_cask("gone-app", "1.0", apps=["DefinitelyNotInstalled.app"])])
+        caskroom = self.root / "Caskroom"
+        (caskroom / "gone-app" / "1.0").mkdir(parents=True)
+        mock_run_brew.return_value = (True, "")
+
+        with patch('homebrew_updater.CASKROOM_PATH', caskroom), \
+             patch('homebrew_updater.GHOST_SCAN_STATE_FILE', self.root / ".ghost_scan.json"):
+            removed = homebrew_updater.heal_ghost_casks()
+
+        self.assertEqual(removed, ["gone-app"])
+        mock_brew_info.assert_not_called()
+
+
+class TestLocalOutdatedCheck(unittest.TestCase):
+    """Test the brew-free outdated comparison of inventory against the API index"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.prefix = self.root / "prefix"
+        homebrew_updater._API_INDEXES.clear()
+        self.patches = [patch('homebrew_updater.HOMEBREW_API_CACHE', self.root / "api"),
+                        patch('homebrew_updater.LOG_DIR', self.root),
+                        patch('homebrew_updater.HOMEBREW_PREFIX', self.prefix),
+                        patch('homebrew_updater.CELLAR_PATH', self.prefix / "Cellar"),
+                        patch('homebrew_updater.CASKROOM_PATH', self.prefix / "Caskroom")]
+        for p in self.patches:
+            p.start()
+        self._keg("git", "2.42.0")
+        self._keg("wget", "1.21.4")
+        self._keg("node", "20.1.0")
+        (self.prefix / "var/homebrew/pinned").mkdir(parents=True)
+        (self.prefix / "var/homebrew/pinned/node").symlink_to("../../../Cellar/node/20.1.0")
+        self._cask("firefox", "119.0")
+        self._cask("slack", "4.35.0")
+        self._cask("chrome", "119.0")
+        self._cask("vlc-nightly", "latest")
+        self.formulae = [api_formula("git", "2.43.0"), api_formula("wget", "1.21.4"),
+                         api_formula("node", "21.0.0")]
+        self.casks = [api_cask("firefox", "120.0"), api_cask("slack", "4.35.0"),
+                      api_cask("chrome", "120.0", auto_updates=True), api_cask("vlc-nightly", "latest")]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        for index in homebrew_updater._API_INDEXES.values():
+            index.close()
+        homebrew_updater._API_INDEXES.clear()
+        self.tmp.cleanup()
+
+    def _keg(self, name, version, tap="homebrew/core"):
+        keg = self.prefix / "Cellar" / name / version
+        keg.mkdir(parents=True)
+        (keg / "INSTALL_RECEIPT.json").write_text(json.dumps({"source": {"tap": tap}}))
+
+    def _cask(self, token, version):
+        (self.prefix / "Caskroom" / token / version).mkdir(parents=True)
+        (self.prefix / "Caskroom" / token / ".metadata" / version / "20240101000000.000").mkdir(parents=True)
+
+    def test_outdated_without_brew(self):
+        """Test version comparison, pins, greedy and latest casks"""
+        write_api_cache(self.root / "api", formulae=self.formulae, casks=self.casks)
+
+        outdated = homebrew_updater.compute_outdated_locally(greedy=True)
+
+        self.assertEqual(set(outdated.formulae), {"git", "node"})
+        self.assertTrue(outdated.formulae["node"].pinned)
+        self.assertEqual(outdated.formulae["git"].version_change, "2.42.0 → 2.43.0")
+        self.assertEqual(set(outdated.casks), {"firefox", "chrome", "vlc-nightly"})
+
+        outdated = homebrew_updater.compute_outdated_locally(greedy=False)
+        self.assertEqual(set(outdated.casks), {"firefox"})
+
+    def test_unknown_package_is_ambiguous(self):
+        """Test that a package missing from the API cache forces the brew fallback"""
+        self._keg("my-tap-tool", "1.0")
+        write_api_cache(self.root / "api", formulae=self.formulae, casks=self.casks)
+
+        self.assertIsNone(homebrew_updater.compute_outdated_locally())
+
+    def test_tapped_formula_is_ambiguous(self):
+        """Test that a tap formula sharing a core formula's name is not compared against core"""
+        self._keg("terraform", "1.5.7", tap="hashicorp/tap")
+        self.formulae.append(api_formula("terraform", "1.5.7"))
+        write_api_cache(self.root / "api", formulae=self.formulae, casks=self.casks)
+
+        self.assertIsNone(homebrew_updater.compute_outdated_locally())
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_get_outdated_prefers_local_check(self, mock_run_brew):
+        """Test that get_outdated does not spawn brew when the local answer is clear"""
+        write_api_cache(self.root / "api", formulae=self.formulae, casks=self.casks)
+
+        with patch('homebrew_updater.OUTDATED_SOURCE', 'auto'):
+            outdated = homebrew_updater.get_outdated()
+
+        self.assertIn("git", outdated.formulae)
+        mock_run_brew.assert_not_called()
+
+    @patch('homebrew_updater.run_brew_command')
+    def test_get_outdated_falls_back_to_brew(self, mock_run_brew):
+        """Test the fallback when there is no API cache"""
+        mock_run_brew.side_effect = scripted_brew((True, outdated_json(formulae=["git"])))
+
+        with patch('homebrew_updater.OUTDATED_SOURCE', 'auto'):
+            outdated = homebrew_updater.get_outdated()
+
+        self.assertEqual(list(outdated.formulae), ["git"])
+        mock_run_brew.assert_called_once()
+
+
+class TestRunMetrics(unittest.TestCase):
+    """Test per-phase and per-command timing"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.metrics_file = Path(self.tmp.name) / "run.metrics.json"
+        self.patcher = patch('homebrew_updater.METRICS_FILE', self.metrics_file)
+        self.patcher.start()
+        homebrew_updater.start_metrics()
+
+    def tearDown(self):
+        homebrew_updater.stop_metrics()
+        self.patcher.stop()
+        self.tmp.cleanup()
+
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_phases_and_brew_commands_are_recorded(self, mock_popen):
+        """Phases reported as running are timed and count the brew commands they ran"""
+        mock_popen.side_effect = [fake_process(stdout="ok"), fake_process(stderr="boom", returncode=1)]
+
+        homebrew_updater.report_progress("Update", "running")
+        homebrew_updater.run_brew_command(["update"])
+        homebrew_updater.run_brew_command(["doctor"], check=False)
+        homebrew_updater.report_progress("Update", "done")
+        homebrew_updater.report_progress("Cleanup", "skipped")
+
+        data = homebrew_updater.RUN_METRICS.to_dict()
+        self.assertEqual([p["name"] for p in data["phases"]], ["Update"])
+        phase = data["phases"][0]
+        self.assertEqual((phase["state"], phase["brew_commands"]), ("done", 2))
+        self.assertGreaterEqual(phase["wall"], 0)
+        self.assertEqual(phase["peak_rss"], 0)  # stand-in processes report no usage
+        self.assertEqual([(c["command"], c["success"]) for c in data["commands"]],
+                         [("update", True), ("doctor", False)])
+        self.assertEqual(data["brew"]["spawns"], 2)
+
+    def test_real_commands_are_measured_individually(self):
+        """Each command's peak RSS is its own, and a phase's peak is the largest of its commands"""
+        with tempfile.TemporaryDirectory() as tmp:
+            stub = Path(tmp) / "brew"
+            stub.write_text(f"#!{sys.executable}\n"
+                            "import sys\nblob = bytearray(int(sys.argv[1]) * 2 ** 20)\nprint(len(blob))\n")
+            stub.chmod(0o755)
+            with patch('homebrew_updater.BREW_PATH', str(stub)):
+                homebrew_updater.report_progress("Upgrade casks", "running")
+                homebrew_updater.run_brew_command(["200"])
+                homebrew_updater.report_progress("Upgrade casks", "done")
+                homebrew_updater.report_progress("Doctor", "running")
+                homebrew_updater.run_brew_command(["1"])
+                homebrew_updater.report_progress("Doctor", "done")
+
+        metrics = homebrew_updater.RUN_METRICS
+        big, small = (c["peak_rss"] for c in metrics.commands)
+        self.assertGreater(big, 200 * 2 ** 20)
+        self.assertLess(small, 100 * 2 ** 20)
+        self.assertEqual(metrics.phases["Upgrade casks"]["peak_rss"], big)
+        self.assertEqual(metrics.phases["Doctor"]["peak_rss"], small)
+
+    def test_metrics_file_written_on_stop(self):
+        """stop_metrics writes the run's metrics as JSON"""
+        homebrew_updater.report_progress("Doctor", "running")
+        homebrew_updater.report_progress("Doctor", "done")
+        homebrew_updater.stop_metrics()
+
+        data = json.loads(self.metrics_file.read_text())
+        self.assertEqual(data["phases"][0]["name"], "Doctor")
+        self.assertIsNone(homebrew_updater.RUN_METRICS)
+
+    def test_render_timing_section(self):
+        """The summary's timing section lists each phase"""
+        metrics = homebrew_updater.RUN_METRICS
+        metrics.phases["Upgrade casks"] = {"state": "done", "wall": 130.4, "cpu": 42.0,
+                                           "peak_rss": 300 * 2 ** 20, "brew_commands": 3}
+        text = metrics.render()
+        self.assertTrue(text.startswith("⏱️ **Timing ("))
+        self.assertIn("  • Upgrade casks: 2m 10s (cpu 42s, peak 300 MB)", text)
+
+    def test_webhook_latency_is_recorded(self):
+        """Webhook round trips are counted per host"""
+        stand_in = WebhookStandIn()
+        client = homebrew_updater.WebhookClient(timeout=5)
+        try:
+            client.post(f"{stand_in.url}/hook", {"content": "x"})
+            client.post(f"{stand_in.url}/hook", {"content": "y"})
+        finally:
+            client.close()
+            stand_in.close()
+
+        stats = homebrew_updater.RUN_METRICS.webhooks["127.0.0.1"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertGreater(stats["seconds"], 0)
+
+    def test_prometheus_textfile(self):
+        """Update runs publish their metrics atomically for the textfile collector"""
+        prom_dir = Path(self.tmp.name) / "textfile"
+        prom_dir.mkdir()
+        cache = Path(self.tmp.name) / "cache"
+        (cache / "downloads").mkdir(parents=True)
+        (cache / "downloads/firefox.dmg").write_bytes(b"x" * 1000)
+
+        metrics = homebrew_updater.RUN_METRICS
+        homebrew_updater.report_progress("Upgrade casks", "running")
+        homebrew_updater.report_progress("Upgrade casks", "done")
+        metrics.record_webhook("discord.com", 0.25)
+        metrics.record_outcome(homebrew_updater.RunSummary(upgraded_casks={"firefox": ["1", "2"]},
+                                                           failed_formulae=["node"]))
+        with patch('homebrew_updater.PROMETHEUS_TEXTFILE_DIR', str(prom_dir)), \
+                patch.dict(homebrew_updater.BREW_ENV, {"HOMEBREW_CACHE": str(cache)}):
+            homebrew_updater.stop_metrics()
+
+        self.assertEqual([p.name for p in prom_dir.iterdir()], ["homebrew_updater.prom"])
+        lines = (prom_dir / "homebrew_updater.prom").read_text().splitlines()
+        self.assertIn("homebrew_updater_last_run_success 1", lines)
+        self.assertIn('homebrew_updater_packages{kind="cask",result="upgraded"} 1', lines)
+        self.assertIn('homebrew_updater_packages{kind="formula",result="failed"} 1', lines)
+        self.assertIn('homebrew_updater_webhook_latency_seconds_count{host="discord.com"} 1', lines)
+        self.assertIn("homebrew_updater_cache_size_bytes 1000", lines)
+        self.assertIn("homebrew_updater_brew_spawns 0", lines)
+        self.assertTrue(any(line.startswith('homebrew_updater_phase_duration_seconds{phase="upgrade_casks"} ')
+                            for line in lines))
+        timestamp = next(line for line in lines if line.startswith("homebrew_updater_last_run_timestamp_seconds"))
+        self.assertAlmostEqual(float(timestamp.split()[1]), time.time(), delta=60)
+
+    def test_fetch_only_run_is_not_exported(self):
+        """Runs started without export leave the textfile alone"""
+        homebrew_updater.start_metrics(export=False)
+        with patch('homebrew_updater.PROMETHEUS_TEXTFILE_DIR', self.tmp.name):
+            homebrew_updater.stop_metrics()
+        self.assertFalse((Path(self.tmp.name) / "homebrew_updater.prom").exists())
 
 
 class TestLogging(unittest.TestCase):
@@ -340,33 +1999,124 @@ class TestLogging(unittest.TestCase):
 
     def test_log_function(self):
         """Test that log function writes to file and stdout"""
-        with patch('builtins.open', mock_open()) as mock_file:
-            with patch('sys.stdout', new_callable=StringIO):
-                homebrew_updater.log("Test message", "INFO")
-
-                # Verify file was written to
-                mock_file.assert_called()
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = homebrew_updater.LogWriter(Path(tmp) / "run.log")
+            with patch('homebrew_updater.LOG_WRITER', writer):
+                with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                    homebrew_updater.log("Test message", "INFO")
+                    homebrew_updater.shutdown_logging()
+
+                    self.assertIn("[INFO] Test message", mock_stdout.getvalue())
+            self.assertIn("[INFO] Test message", (Path(tmp) / "run.log").read_text())
+
+    def test_log_writer_keeps_single_handle(self):
+        """Test that the log file is opened once for many lines"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "run.log"
+            writer = homebrew_updater.LogWriter(path, mirror_stdout=False)
+            with patch('builtins.open', wraps=open) as mock_file:
+                for i in range(100):
+                    writer.write(f"line {i}")
+                writer.close()
+
+            mock_file.assert_called_once()
+            self.assertEqual(len(path.read_text().splitlines()), 100)
+
+    def test_log_writer_flushes_errors_immediately(self):
+        """Test that ERROR lines reach disk before the writer is closed"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "run.log"
+            writer = homebrew_updater.LogWriter(path, mirror_stdout=False, flush_interval=3600)
+            writer.write("buffered line")
+            writer.write("something broke", "ERROR")
+
+            contents = path.read_text()
+            self.assertIn("buffered line", contents)
+            self.assertIn("[ERROR] something broke", contents)
+            writer.close()
+
+    def test_log_writer_flushes_a_burst_without_further_writes(self):
+        """Test that buffered lines reach disk after the flush interval even if the log goes quiet"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "run.log"
+            writer = homebrew_updater.LogWriter(path, mirror_stdout=False, flush_interval=0.2)
+            writer.write("first line")
+            writer.write("second line")
+            time.sleep(0.6)
+
+            contents = path.read_text()
+            self.assertIn("first line", contents)
+            self.assertIn("second line", contents)
+            writer.close()
+
+    def test_log_writer_background_thread(self):
+        """Test that the background writer drains all lines on close"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "run.log"
+            writer = homebrew_updater.LogWriter(path, mirror_stdout=False, background=True)
+            for i in range(500):
+                writer.write(f"line {i}")
+            writer.close()
+
+            lines = path.read_text().splitlines()
+            self.assertEqual(len(lines), 500)
+            self.assertTrue(lines[-1].endswith("line 499"))
 
 
 class TestMainFlow(unittest.TestCase):
     """Test main execution flow"""
 
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.prefix = self.root / "prefix"
+        self.state_file = self.root / ".run_state.json"
+        self.patches = [patch('homebrew_updater.RUN_STATE_FILE', self.state_file),
+                        patch('homebrew_updater.NOTIFICATION_OUTBOX_FILE', self.root / "outbox.json"),
+                        patch('homebrew_updater.METRICS_FILE', self.root / "run.metrics.json"),
+                        patch('homebrew_updater.HOMEBREW_PREFIX', self.prefix),
+                        patch('homebrew_updater.CELLAR_PATH', self.prefix / "Cellar"),
+                        patch('homebrew_updater.CASKROOM_PATH', self.prefix / "Caskroom"),
+                        patch('homebrew_updater.HOMEBREW_API_CACHE', self.root / "api"),
+                        patch('homebrew_updater.APPLICATION_DIRS', [self.root / "Applications"])]
+        for p in self.patches:
+            p.start()
+        (self.prefix / "Cellar/git/2.43.0").mkdir(parents=True)
+        (self.root / "Applications").mkdir()
+        tap = self.prefix / "Library/Taps/homebrew/homebrew-core/.git"
+        (tap / "refs/heads").mkdir(parents=True)
+        (tap / "HEAD").write_text("ref: refs/heads/main\n")
+        (tap / "refs/heads/main").write_text("a" * 40 + "\n")
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def _save_state(self, **overrides):
+        state = {"fingerprint": homebrew_updater.compute_fingerprint(), "outdated_count": 0,
+                 "last_update": time.time(), "last_full_run": time.time()}
+        state.update(overrides)
+        self.state_file.write_text(json.dumps(state))
+
     @patch('homebrew_updater.cleanup_old_logs')
     @patch('homebrew_updater.send_notification')
     @patch('homebrew_updater.brew_update')
     @patch('homebrew_updater.heal_ghost_casks')
+    @patch('homebrew_updater.get_outdated')
     @patch('homebrew_updater.brew_upgrade_formulae')
     @patch('homebrew_updater.brew_upgrade_casks')
     @patch('homebrew_updater.brew_cleanup')
     @patch('homebrew_updater.brew_doctor')
     def test_main_success(self, mock_doctor, mock_cleanup, mock_upgrade_casks,
-                          mock_upgrade_formulae, mock_heal, mock_update,
+                          mock_upgrade_formulae, mock_get_outdated, mock_heal, mock_update,
                           mock_notification, mock_cleanup_logs):
         """Test main flow when all operations succeed"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={}, casks={})
         mock_update.return_value = True
         mock_heal.return_value = ["ghost-cask"]
-        mock_upgrade_formulae.return_value = (True, ["pkg1", "pkg2", "pkg3", "pkg4", "pkg5"])
-        mock_upgrade_casks.return_value = (True, ["cask1", "cask2", "cask3"], [])  # No warnings
+        mock_upgrade_formulae.return_value = (True, ["pkg1", "pkg2", "pkg3", "pkg4", "pkg5"], [])
+        mock_upgrade_casks.return_value = (True, ["cask1", "cask2", "cask3"], [], [])  # No warnings or failures
 
         result = homebrew_updater.main()
 
@@ -377,6 +2127,213 @@ class TestMainFlow(unittest.TestCase):
         mock_upgrade_formulae.assert_called_once()
         mock_upgrade_casks.assert_called_once()
         mock_cleanup.assert_called_once()
+        # Outdated packages are discovered once and shared by both upgrade phases
+        mock_get_outdated.assert_called_once()
+        self.assertIs(mock_upgrade_formulae.call_args.args[0], mock_get_outdated.return_value)
+        self.assertIs(mock_upgrade_casks.call_args.args[0], mock_get_outdated.return_value)
+        # The run state records what this run saw for the next run's fast path
+        state = json.loads(self.state_file.read_text())
+        self.assertEqual(state["outdated_count"], 0)
+        self.assertEqual(state["fingerprint"], homebrew_updater.compute_fingerprint())
+        # Each phase is timed in the run's metrics file and the summary
+        metrics = json.loads((self.root / "run.metrics.json").read_text())
+        self.assertEqual([p["name"] for p in metrics["phases"]],
+                         ["Update", "Heal ghost casks", "Check outdated", "Upgrade formulae",
+                          "Upgrade casks", "Cleanup", "Doctor"])
+        self.assertIn("⏱️ **Timing (", mock_notification.call_args.args[0])
+
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update', return_value=True)
+    @patch('homebrew_updater.heal_ghost_casks', return_value=[])
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_formulae', return_value=(True, [], []))
+    @patch('homebrew_updater.brew_upgrade_casks', return_value=(True, [], [], []))
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    def test_main_removes_partials_by_default(self, mock_doctor, mock_cleanup, mock_upgrade_casks,
+                                              mock_upgrade_formulae, mock_get_outdated, mock_heal,
+                                              mock_update, mock_notification, mock_cleanup_logs):
+        """Test that an unattended run repairs partial upgrades like brew-upgrade-all.sh did"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={}, casks={})
+        (self.prefix / "Caskroom/zoom/5.16.upgrading").mkdir(parents=True)
+        (self.prefix / "Caskroom/zoom/5.15").mkdir()
+
+        self.assertEqual(homebrew_updater.main(), 0)
+
+        self.assertFalse((self.prefix / "Caskroom/zoom/5.16.upgrading").exists())
+        # Other stale state is only reported unless STALE_STATE_SWEEP=repair
+        self.assertTrue((self.prefix / "Caskroom/zoom/5.15").exists())
+
+    @patch('homebrew_updater.NOTIFICATION_MODE', 'digest')
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update', return_value=True)
+    @patch('homebrew_updater.heal_ghost_casks', return_value=[])
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_formulae', return_value=(True, ["git"], []))
+    @patch('homebrew_updater.brew_upgrade_casks', return_value=(True, [], [], []))
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    def test_main_digest_mode(self, mock_doctor, mock_cleanup, mock_upgrade_casks,
+                              mock_upgrade_formulae, mock_get_outdated, mock_heal, mock_update,
+                              mock_notification, mock_cleanup_logs):
+        """Digest mode records a clean run quietly instead of posting it"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={
+            "git": homebrew_updater.OutdatedPackage("git", ["2.42.0"], "2.43.0")}, casks={})
+
+        with patch('homebrew_updater.DIGEST_STORE_FILE', self.root / "digest.json"):
+            self.assertEqual(homebrew_updater.main(), 0)
+            digest = homebrew_updater.load_digest()
+
+        mock_notification.assert_not_called()
+        self.assertEqual(digest["runs"], 1)
+        self.assertEqual(digest["formulae"], {"git": ["2.42.0", "2.43.0"]})
+
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update', return_value=True)
+    @patch('homebrew_updater.heal_ghost_casks')
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_formulae', return_value=(True, [], []))
+    @patch('homebrew_updater.brew_upgrade_casks', return_value=(True, [], [], []))
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    def test_main_no_heal_no_greedy_no_cleanup(self, mock_doctor, mock_cleanup, mock_upgrade_casks,
+                                               mock_upgrade_formulae, mock_get_outdated, mock_heal,
+                                               mock_update, mock_notification, mock_cleanup_logs):
+        """Test the modifiers carried over from brew-upgrade-all.sh"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={}, casks={})
+
+        result = homebrew_updater.main(["--no-heal", "--no-greedy", "--no-cleanup"])
+
+        self.assertEqual(result, 0)
+        mock_heal.assert_not_called()
+        mock_cleanup.assert_not_called()
+        mock_get_outdated.assert_called_once_with(False)
+        self.assertEqual(mock_upgrade_casks.call_args.args, (mock_get_outdated.return_value, False))
+        self.assertIn("Cleanup:** Skipped", mock_notification.call_args.args[0])
+
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update')
+    @patch('homebrew_updater.heal_ghost_casks', return_value=["ghost-cask"])
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_casks')
+    def test_main_dry_run(self, mock_upgrade_casks, mock_get_outdated, mock_heal, mock_update,
+                          mock_notification, mock_cleanup_logs):
+        """Test that a dry run only reports"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={}, casks={})
+
+        result = homebrew_updater.main(["--dry-run"])
+
+        self.assertEqual(result, 0)
+        mock_heal.assert_called_once_with(dry_run=True)
+        mock_get_outdated.assert_called_once_with(True)
+        mock_update.assert_not_called()
+        mock_upgrade_casks.assert_not_called()
+        mock_notification.assert_not_called()
+
+    def test_fingerprint_tracks_taps_and_installed_packages(self):
+        """Tap commits, kegs and casks all change the fingerprint"""
+        before = homebrew_updater.compute_fingerprint()
+        self.assertEqual(before, homebrew_updater.compute_fingerprint())
+
+        ref = self.prefix / "Library/Taps/homebrew/homebrew-core/.git/refs/heads/main"
+        ref.write_text("b" * 40 + "\n")
+        after_tap = homebrew_updater.compute_fingerprint()
+        self.assertNotEqual(before, after_tap)
+
+        (self.prefix / "Caskroom/firefox/120.0").mkdir(parents=True)
+        self.assertNotEqual(after_tap, homebrew_updater.compute_fingerprint())
+
+    @patch('homebrew_updater.BREW_UPDATE_TTL_HOURS', 24)
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update')
+    @patch('homebrew_updater.get_outdated')
+    def test_main_noop_fast_path(self, mock_get_outdated, mock_update, mock_notification,
+                                 mock_cleanup_logs):
+        """Nothing changed and brew update is throttled: exit before doing any work"""
+        self._save_state()
+
+        result = homebrew_updater.main()
+
+        self.assertEqual(result, 0)
+        mock_update.assert_not_called()
+        mock_get_outdated.assert_not_called()
+        mock_notification.assert_not_called()
+
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.subprocess.Popen')
+    def test_main_noop_fast_path_spawns_no_brew_by_default(self, mock_popen, mock_notification,
+                                                           mock_cleanup_logs):
+        """With the default settings a rerun of an unchanged system never starts brew"""
+        self._save_state(last_update=time.time() - 3600)
+
+        self.assertEqual(homebrew_updater.main(), 0)
+
+        mock_popen.assert_not_called()
+        mock_notification.assert_not_called()
+
+    @patch('homebrew_updater.BREW_UPDATE_TTL_HOURS', 24)
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.NOTIFICATION_PLATFORM', 'discord')
+    @patch('homebrew_updater.DISCORD_WEBHOOK_URL', "https://discord.com/api/webhooks/test/test")
+    @patch('homebrew_updater._send_discord', return_value=True)
+    def test_main_noop_fast_path_flushes_outbox(self, mock_discord, mock_cleanup_logs):
+        """Leftover notifications are retried even when the run takes the fast path"""
+        self._save_state()
+        homebrew_updater.outbox_add("discord", "yesterday's report")
+        entries = json.loads((self.root / "outbox.json").read_text())
+        entries[0]["next_attempt"] = 0
+        (self.root / "outbox.json").write_text(json.dumps(entries))
+
+        self.assertEqual(homebrew_updater.main(), 0)
+
+        mock_discord.assert_called_once_with("yesterday's report", False)
+        self.assertEqual(json.loads((self.root / "outbox.json").read_text()), [])
+
+    @patch('homebrew_updater.BREW_UPDATE_TTL_HOURS', 24)
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update')
+    @patch('homebrew_updater.heal_ghost_casks', return_value=[])
+    @patch('homebrew_updater.get_outdated')
+    @patch('homebrew_updater.brew_upgrade_formulae', return_value=(True, [], []))
+    @patch('homebrew_updater.brew_upgrade_casks', return_value=(True, [], [], []))
+    @patch('homebrew_updater.brew_cleanup')
+    @patch('homebrew_updater.brew_doctor')
+    def test_main_full_run_when_last_run_left_packages_outdated(
+            self, mock_doctor, mock_cleanup, mock_upgrade_casks, mock_upgrade_formulae,
+            mock_get_outdated, mock_heal, mock_update, mock_notification, mock_cleanup_logs):
+        """A previous failure means the run cannot be skipped, but brew update stays throttled"""
+        mock_get_outdated.return_value = homebrew_updater.OutdatedSet(formulae={}, casks={})
+        self._save_state(outdated_count=2)
+
+        result = homebrew_updater.main()
+
+        self.assertEqual(result, 0)
+        mock_update.assert_not_called()
+        mock_get_outdated.assert_called_once()
+        self.assertEqual(json.loads(self.state_file.read_text())["outdated_count"], 0)
+
+    @patch('homebrew_updater.cleanup_old_logs')
+    @patch('homebrew_updater.send_notification')
+    @patch('homebrew_updater.brew_update', return_value=True)
+    @patch('homebrew_updater.get_outdated')
+    def test_main_skips_when_update_changed_nothing(self, mock_get_outdated, mock_update,
+                                                    mock_notification, mock_cleanup_logs):
+        """brew update ran but left taps and the API cache untouched"""
+        self._save_state(last_update=0)
+
+        result = homebrew_updater.main()
+
+        self.assertEqual(result, 0)
+        mock_update.assert_called_once()
+        mock_get_outdated.assert_not_called()
+        self.assertGreater(json.loads(self.state_file.read_text())["last_update"], 0)
 
     @patch('homebrew_updater.cleanup_old_logs')
     @patch('homebrew_updater.send_notification')